@@ -0,0 +1,261 @@
+#Micro-benchmarks for the game data structures and the command dispatcher
+import json, platform, random, sys, time
+from deck import Deck, DEAD
+from player import Player, PlayerQueue
+from vote import Vote
+from room import RoomManager
+from timer import TimerScheduler
+from ratelimit import TokenBucket, UNLIMITED
+from server import CoupGame, CoupConnectionHandler
+
+#Each measurement runs for at least this long, and the best of REPEAT measurements is kept
+MIN_TIME = 0.1
+REPEAT = 3
+#The whole suite is measured this many times, one benchmark after another, so a slow spell on the machine
+#hits one round of every benchmark rather than every round of one. The fastest round is the result, and
+#how far the slowest strays from it is the benchmark's noise
+ROUNDS = 5
+#A benchmark this much slower than the baseline, plus the noise of either run, counts as a regression.
+#Anything that looks like one is measured for another ROUNDS before it fails the run
+REGRESSION = 1.10
+
+'''
+Stands in for a client socket: counts what is sent to it instead of sending it
+'''
+class FakeConnection(object):
+    #Speaks the telnet text protocol (see protocol.StructuredConnection)
+    structured = False
+    #Belongs to no event loop: nothing here is sent from another thread
+    loop = None
+
+    def __init__(self, name="bench"):
+        self.address = (name, 0)
+        self.sent = 0
+
+    def sendall(self, data):
+        self.sent += len(data)
+
+    def close(self):
+        pass
+
+#name -> function that sets a benchmark up and returns the operation to time
+BENCHMARKS = {}
+
+def benchmark(name):
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+def makeQueue():
+    queue = PlayerQueue()
+    deck = Deck()
+    for i in range(6):
+        queue.addPlayer(Player(FakeConnection(str(i)), "player{}".format(i), deck.deal(), deck.deal()))
+    return queue
+
+@benchmark("PlayerQueue.getPlayer")
+def benchGetPlayer():
+    queue = makeQueue()
+    conn = queue.listPlayers()[3].conn
+    return lambda: queue.getPlayer(conn)
+
+@benchmark("PlayerQueue.getPlayerByName")
+def benchGetPlayerByName():
+    queue = makeQueue()
+    return lambda: queue.getPlayerByName("player3")
+
+@benchmark("PlayerQueue.advanceTurn")
+def benchAdvanceTurn():
+    queue = makeQueue()
+    return queue.advanceTurn
+
+@benchmark("PlayerQueue.getCurrentPlayer")
+def benchGetCurrentPlayer():
+    queue = makeQueue()
+    return queue.getCurrentPlayer
+
+@benchmark("Deck.shuffle")
+def benchShuffle():
+    deck = Deck()
+    rng = random.Random(1)
+    return lambda: deck.shuffle(rng)
+
+@benchmark("Deck.deal+addCard")
+def benchDeal():
+    deck = Deck()
+    def op():
+        deck.addCard(deck.deal())
+    return op
+
+@benchmark("Deck.swapCard")
+def benchSwapCard():
+    deck = Deck()
+    rng = random.Random(1)
+    player = Player(None, "player", deck.deal(), deck.deal())
+    return lambda: deck.swapCard(player, 0, rng)
+
+@benchmark("Player.getHand (unchanged)")
+def benchGetHand():
+    deck = Deck()
+    player = Player(None, "player", deck.deal(), deck.deal())
+    return lambda: player.getHand(True)
+
+@benchmark("Player.getHand (changed)")
+def benchGetHandChanged():
+    deck = Deck()
+    player = Player(None, "player", deck.deal(), deck.deal())
+    def op():
+        player.cards[0] ^= DEAD
+        player.getHand(True)
+    return op
+
+@benchmark("Vote.vote (5 voters to conclusion)")
+def benchVote():
+    voters = makeQueue().listPlayers()[1:]
+    def op():
+        vote = Vote("challenge", voters, 100.0 / len(voters), 20)
+        for voter in voters:
+            if vote.vote(voter, False) is not None:
+                break
+    return op
+
+@benchmark("Vote.checkResults")
+def benchCheckResults():
+    voters = makeQueue().listPlayers()[1:]
+    vote = Vote("challenge", voters, 100.0 / len(voters), 20)
+    vote.vote(voters[0], False)
+    return vote.checkResults
+
+@benchmark("TokenBucket.take")
+def benchTokenBucket():
+    bucket = TokenBucket(10.0, 20, 0.0)
+    now = [0.0]
+    def op():
+        now[0] += 0.1
+        bucket.take(now[0])
+    return op
+
+def makeHandlers(count):
+    rooms = RoomManager(CoupGame, TimerScheduler())
+    handlers = []
+    for i in range(count):
+        handler = CoupConnectionHandler(rooms, FakeConnection(str(i)))
+        handler.processMessage("/register player{}".format(i))
+        handlers.append(handler)
+    return handlers
+
+def parseBenchmark(message):
+    def setup():
+        handler = makeHandlers(4)[1]
+        player = handler.cg.players.getPlayer(handler.request)
+        #Measures the commands themselves, not how quickly they are shed
+        handler.limits = handler.room.limits = UNLIMITED
+        return lambda: handler.parseRequest(player, message)
+    return setup
+
+#The parsing handler's player isn't the one to move, so /income measures a rejected command
+for message in ("/coins", "/hand", "/players", "/say hello", "/income", "/nosuchcommand"):
+    benchmark("parseRequest {}".format(message))(parseBenchmark(message))
+
+'''Returns how many calls of op take at least MIN_TIME'''
+def calibrate(op):
+    number = 1
+    while True:
+        start = time.time()
+        for i in xrange(number):
+            op()
+        if time.time() - start >= MIN_TIME:
+            return number
+        number *= 4
+
+'''Returns the best time per call of op in seconds, over REPEAT measurements of number calls'''
+def measure(op, number):
+    best = None
+    for i in range(REPEAT):
+        start = time.time()
+        for j in xrange(number):
+            op()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best / number
+
+'''Returns the names of the benchmarks that contain one of the filters (all of them by default)'''
+def select(filters=None):
+    return [name for name in sorted(BENCHMARKS) if not filters or any(text in name for text in filters)]
+
+'''Runs the named benchmarks'''
+def run(names):
+    ops = dict((name, BENCHMARKS[name]()) for name in names)
+    numbers = dict((name, calibrate(ops[name])) for name in names)
+    rounds = dict((name, []) for name in names)
+    for i in range(ROUNDS):
+        for name in names:
+            rounds[name].append(measure(ops[name], numbers[name]) * 1e9)
+
+    results = {}
+    for name in names:
+        results[name] = summarize(min(rounds[name]), max(rounds[name]), numbers[name])
+        print "{0:<40}{1:>12.1f} ns  +{2:.1f}%".format(name, results[name]["ns"], results[name]["noise"] * 100)
+    return {"python": platform.python_version(), "machine": platform.platform(), "time": time.time(), "results": results}
+
+def summarize(fastest, slowest, number):
+    return {"ns": fastest, "slowest": slowest, "noise": slowest / fastest - 1, "number": number}
+
+'''Adds the rounds of a second run of some benchmarks to current'''
+def merge(current, again):
+    for name, result in again["results"].items():
+        first = current["results"][name]
+        current["results"][name] = summarize(min(first["ns"], result["ns"]), max(first["slowest"], result["slowest"]),
+                                             result["number"])
+
+'''
+Prints the change from baseline for each benchmark. Returns the names that regressed: those slower than
+REGRESSION allows even after the noise measured in either run is added to it
+'''
+def compare(baseline, current):
+    regressions = []
+    print "\n{0:<40}{1:>12}{2:>12}{3:>10}{4:>10}".format("BENCHMARK", "BASE (ns)", "NOW (ns)", "CHANGE", "LIMIT")
+    for name in sorted(current["results"]):
+        now = current["results"][name]
+        base = baseline["results"].get(name)
+        if base is None:
+            print "{0:<40}{1:>12}{2:>12.1f}".format(name, "-", now["ns"])
+            continue
+        ratio = now["ns"] / base["ns"]
+        #Baselines written before noise was measured count as noiseless
+        limit = REGRESSION + max(base.get("noise", 0.0), now["noise"])
+        flag = ""
+        if ratio > limit:
+            flag = "  SLOWER"
+            regressions.append(name)
+        print "{0:<40}{1:>12.1f}{2:>12.1f}{3:>+9.1f}%{4:>+9.1f}%{5}".format(
+            name, base["ns"], now["ns"], (ratio - 1) * 100, (limit - 1) * 100, flag)
+    return regressions
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print "Usage: python bench.py [results.json] [baseline.json] [benchmark name filters...]"
+        sys.exit(2)
+    OUTPUT = sys.argv[1]
+    BASELINE = sys.argv[2] if len(sys.argv) > 2 and sys.argv[2] != "-" else None
+
+    current = run(select(sys.argv[3:]))
+    regressions = []
+    if BASELINE:
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, current)
+        if regressions:
+            #A slow spell can outlast a run, so make sure before failing
+            print "\nMeasuring {} benchmarks again".format(len(regressions))
+            merge(current, run(regressions))
+            regressions = compare(baseline, current)
+
+    with open(OUTPUT, 'w') as f:
+        json.dump(current, f, indent=2, sort_keys=True)
+    if regressions:
+        print "\n{0} benchmarks are slower than the baseline by more than {1:.0f}% plus their noise".format(
+            len(regressions), (REGRESSION - 1) * 100)
+        sys.exit(1)
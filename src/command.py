@@ -0,0 +1,112 @@
+#Table-driven command dispatch
+import time
+from error import *
+from metrics import Histogram
+from ratelimit import COMMAND
+
+'''
+A single client command.
+handler is called as handler(requestHandler, player, parts).
+args is the number of arguments the command needs after its name.
+registered, myTurn, notExchanging and admin are the preconditions checked before the handler runs.
+budget is the rate limit the command spends from (see ratelimit.py).
+'''
+class Command(object):
+    __slots__ = ('name', 'handler', 'args', 'registered', 'myTurn', 'notExchanging', 'admin', 'budget')
+
+    def __init__(self, name, handler, args=0, registered=False, myTurn=False, notExchanging=False, admin=False,
+                 budget=COMMAND):
+        self.name = name
+        self.budget = budget
+        self.handler = handler
+        self.args = args
+        #Being the current player or exchanging both imply being registered
+        self.registered = registered or myTurn or notExchanging
+        self.myTurn = myTurn
+        self.notExchanging = notExchanging
+        self.admin = admin
+
+    '''Raises the matching error if the command can't be run by player right now'''
+    def check(self, requestHandler, player, parts):
+        if self.admin and not requestHandler.admin:
+            raise NotAdminError()
+        if self.registered and player is None:
+            raise UnregisteredPlayerError()
+        if self.myTurn and not requestHandler.cg.players.isPlayersTurn(player):
+            raise NotYourTurnError()
+        if self.notExchanging and len(player.cards) > 2:
+            raise AlreadyExchangingError()
+        if len(parts) - 1 < self.args:
+            raise NotEnoughArguments()
+
+'''Call count, latency totals and latency histogram for one command'''
+class CommandStats(object):
+    __slots__ = ('count', 'errors', 'totalTime', 'maxTime', 'latency')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.totalTime = 0.0
+        self.maxTime = 0.0
+        self.latency = Histogram()
+
+    def record(self, elapsed, failed):
+        self.count += 1
+        if failed:
+            self.errors += 1
+        self.totalTime += elapsed
+        if elapsed > self.maxTime:
+            self.maxTime = elapsed
+        self.latency.observe(elapsed)
+
+    def meanTime(self):
+        if self.count == 0:
+            return 0.0
+        return self.totalTime / self.count
+
+'''
+Maps command names to Commands, checks their preconditions and times every dispatch
+'''
+class CommandRegistry(object):
+    def __init__(self):
+        self.commands = {}
+        self.stats = {}
+
+    def add(self, name, handler, **preconditions):
+        self.commands[name] = Command(name, handler, **preconditions)
+        self.stats[name] = CommandStats()
+
+    '''Returns the Command called name, or None'''
+    def get(self, name):
+        return self.commands.get(name)
+
+    def names(self):
+        return sorted(self.commands)
+
+    '''
+    Checks the command's preconditions and runs it.
+    Errors raised by the preconditions or the handler stop here, and their message is sent to the client.
+    Returns False if the command failed.
+    '''
+    def dispatch(self, command, requestHandler, player, parts):
+        start = time.time()
+        failed = False
+        try:
+            command.check(requestHandler, player, parts)
+            command.handler(requestHandler, player, parts)
+        except CoupError as e:
+            failed = True
+            requestHandler.sendError(e.message)
+        finally:
+            self.stats[command.name].record(time.time() - start, failed)
+        return not failed
+
+    '''Returns a table of per-command counts and latencies'''
+    def report(self):
+        lines = ["{0:<14}{1:>8}{2:>8}{3:>12}{4:>12}\n".format("COMMAND", "CALLS", "ERRORS", "MEAN (ms)", "MAX (ms)")]
+        for name in self.names():
+            stats = self.stats[name]
+            if stats.count:
+                lines.append("{0:<14}{1:>8}{2:>8}{3:>12.3f}{4:>12.3f}\n".format(name, stats.count, stats.errors,
+                             stats.meanTime() * 1000, stats.maxTime * 1000))
+        return "".join(lines)
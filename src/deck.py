@@ -1,73 +1,84 @@
 import random
 
-class Card(object):
-    def __init__(self, type):
-        self.type = type
-        self.alive = True
-
-    '''Sets a card as 'flipped' '''
-    def kill(self):
-        self.alive = False
-
-    '''
-    Displays a card in ascii art form
-    Reveal is a boolean used to determine if the card should be shown or not
-    '''
-    def renderCard(self, reveal):
-        status = ""
-        if self.alive:
-            status = "ALIVE"
-        else:
-            status = "DEAD"
-
-        if not self.alive or reveal:
-            return "______\n|     |\n|{0}.| ({1})\n|     |\n|_____|\n".format(self.type[:4], status)
-
-        else:
-            return "______\n|     | ({0})\n|     |\n|     |\n|_____|\n".format(status)
+#Role codes. A card is stored as its role code, with DEAD set once it has been killed
+ROLES = ('Contessa', 'Duke', 'Captain', 'Assassin', 'Ambassador')
+CONTESSA, DUKE, CAPTAIN, ASSASSIN, AMBASSADOR = range(len(ROLES))
+COPIES = 3
+DEAD = 0x80
+ROLE_MASK = 0x7f
 
+#Every card of a new deck, in role order
+FULL_DECK = bytes(bytearray(role for role in range(len(ROLES)) for i in range(COPIES)))
+
+def roleOf(card):
+    return card & ROLE_MASK
+
+def roleName(card):
+    return ROLES[card & ROLE_MASK]
+
+def roleCode(name):
+    return ROLES.index(name)
+
+def isAlive(card):
+    return not card & DEAD
+
+'''Builds the ascii art for one card. Only used to fill CARD_ART'''
+def drawCard(card, reveal):
+    status = ""
+    if isAlive(card):
+        status = "ALIVE"
+    else:
+        status = "DEAD"
+
+    if not isAlive(card) or reveal:
+        return "______\n|     |\n|{0}.| ({1})\n|     |\n|_____|\n".format(roleName(card)[:4], status)
+
+    else:
+        return "______\n|     | ({0})\n|     |\n|     |\n|_____|\n".format(status)
+
+#The art for every card code, drawn once: CARD_ART[reveal][card]
+CARD_ART = tuple(dict((card | dead, drawCard(card | dead, reveal)) for card in range(len(ROLES)) for dead in (0, DEAD))
+                 for reveal in (False, True))
+
+'''
+Displays a card in ascii art form
+Reveal is a boolean used to determine if the card should be shown or not
+The art is looked up rather than formatted on every call
+'''
+def renderCard(card, reveal):
+    return CARD_ART[reveal][card]
+
+'''
+The draw pile, held as a bytearray of role codes so dealing and returning cards allocates nothing
+'''
 class Deck(object):
+    __slots__ = ('cards',)
+
     def __init__(self):
-        self.cards = [
-        Card('Contessa'),
-        Card('Contessa'),
-        Card('Contessa'),
-        Card('Duke'),
-        Card('Duke'),
-        Card('Duke'),
-        Card('Captain'),
-        Card('Captain'),
-        Card('Captain'),
-        Card('Assassin'),
-        Card('Assassin'),
-        Card('Assassin'),
-        Card('Ambassador'),
-        Card('Ambassador'),
-        Card('Ambassador')]
-        self.numCards = len(self.cards)
-
-    '''Shuffles all of the cards'''
-    def shuffle(self):
-        random.seed()
-        random.shuffle(self.cards)
+        self.cards = bytearray(FULL_DECK)
+
+    '''Shuffles all of the cards, using rng (a random.Random) if one is given'''
+    def shuffle(self, rng=None):
+        if rng is None:
+            random.seed()
+            rng = random
+        rng.shuffle(self.cards)
 
     '''Pops a card from the deck'''
     def deal(self):
-        self.numCards -= 1
-        print "Dealing Card: numCards = ", self.numCards
         return self.cards.pop()
 
     '''Shows all of the cards in the deck'''
     def fanUp(self):
-        for i, card in enumerate(self.cards):
-                print card.renderCard(True)
+        for card in self.cards:
+            print renderCard(card, True)
+
     '''Adds a card to the deck'''
     def addCard(self, card):
-        self.numCards += 1
-        self.cards.append(card)
-        print "Returning Card: numCards = ", self.numCards
+        self.cards.append(card & ROLE_MASK)
 
-    def swapCard(self, player, card):
+    '''Returns the player's card at index to the deck and deals them a replacement'''
+    def swapCard(self, player, card, rng=None):
         self.addCard(player.cards[card])
-        self.shuffle()
+        self.shuffle(rng)
         player.cards[card] = self.deal()
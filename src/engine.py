@@ -0,0 +1,457 @@
+#The rules of COUP, with no sockets or timers involved
+import random, unicodedata
+from deck import Deck, isAlive, roleName
+from player import Player, PlayerQueue
+from vote import Vote, FAILED
+from error import *
+
+STARTING_TREASURY = 50
+#Players with this many coins have to Coup
+MUST_COUP = 10
+ASSASSINATE_COST = 3
+COUP_COST = 7
+CHALLENGE_TIMEOUT = 20
+
+#Events that are only shown to the player they are about (event[1])
+PRIVATE_EVENTS = frozenset(['hand', 'exchangePrompt'])
+
+'''
+The complete state of one table: deck, players in turn order, treasury and any open vote.
+Rules update it in place. rng drives every shuffle and card loss, so a game is reproducible from its seed.
+'''
+class GameState(object):
+    def __init__(self, seed=None):
+        if seed is None:
+            seed = random.SystemRandom().getrandbits(64)
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.deck = Deck()
+        self.players = PlayerQueue()
+        self.treasury = STARTING_TREASURY
+        self.winner = None
+        self.deck.shuffle(self.rng)
+
+    '''Returns the whole state as plain tuples, lists and strings (marshal-able)'''
+    def snapshot(self):
+        players = [(player.name, player.coins, str(player.cards), player.ready) for player in self.players.listPlayers()]
+        votes = []
+        for vote in self.players.ongoingVotes.values():
+            votes.append((vote.name, [voter.name for voter in vote.playerList], [voter.name for voter in vote.yesList],
+                          [voter.name for voter in vote.noList], vote.passThreshold, vote.timeout, vote.claim, vote.concluded))
+        return (self.seed, self.rng.getstate(), str(self.deck.cards), self.treasury, self.winner, players, votes)
+
+    '''Replaces the state with one returned by snapshot(). Players come back without connections'''
+    def restore(self, data):
+        self.seed, rngState, deck, self.treasury, self.winner, players, votes = data
+        self.rng.setstate(rngState)
+        self.deck.cards = bytearray(deck)
+        self.players = PlayerQueue()
+        for name, coins, cards, ready in players:
+            player = Player(None, name, 0, 0)
+            player.coins, player.cards, player.ready = coins, bytearray(cards), ready
+            self.players.addPlayer(player)
+
+        byName = self.players.getPlayerByName
+        for name, voters, yesList, noList, passThreshold, timeout, claim, concluded in votes:
+            vote = Vote(name, [byName(voter) for voter in voters], passThreshold, timeout, claim=tuple(claim))
+            vote.yesList = [byName(voter) for voter in yesList]
+            vote.noList = [byName(voter) for voter in noList]
+            vote.concluded = concluded
+            self.players.ongoingVotes[name] = vote
+
+'''
+Applies action to state and returns the list of events it produced.
+An action is a tuple (kind, playerName, argument); an event is a tuple whose first item is its kind.
+Illegal actions raise a CoupError and leave the state untouched.
+'''
+def apply(state, action):
+    rule = RULES.get(action[0])
+    if rule is None:
+        raise InvalidCommandError("Unrecognized action {}.\n".format(action[0]))
+    events = []
+    rule(state, action, events)
+    return events
+
+'''Returns the player called name, or raises UnregisteredPlayerError'''
+def getActor(state, name):
+    player = state.players.getPlayerByName(name)
+    if player is None:
+        raise UnregisteredPlayerError()
+    return player
+
+def requireTurn(state, player):
+    if state.winner is not None:
+        raise InvalidCommandError("The game is over, {} has won.\n".format(state.winner))
+    if not state.players.isPlayersTurn(player):
+        raise NotYourTurnError()
+    if state.players.ongoingVotes:
+        raise InvalidCommandError("Wait for the current vote to finish.\n")
+
+def requireNotExchanging(player):
+    if len(player.cards) > 2:
+        raise AlreadyExchangingError()
+
+def requireNoCoup(player):
+    if player.coins >= MUST_COUP:
+        raise MustCoupError()
+
+def requireTreasury(state, coins):
+    if state.treasury < coins:
+        raise NotEnoughTreasuryCoinsError()
+
+'''Returns the player called name if they are the one to move and can start a new action'''
+def startAction(state, name):
+    player = getActor(state, name)
+    requireTurn(state, player)
+    requireNotExchanging(player)
+    return player
+
+'''Looks up the player named in a targeted action'''
+def getTarget(state, player, name):
+    if name == player.name:
+        raise InvalidCommandError("You cannot target yourself.\n")
+    target = state.players.getPlayerByName(name)
+    if target is None:
+        raise NoSuchPlayerError(name)
+    if not target.isAlive():
+        raise InvalidCommandError("{} is already out of the game.\n".format(name))
+    return target
+
+'''Moves coins from the treasury to player'''
+def collect(state, player, coins):
+    coins = min(coins, state.treasury)
+    player.coins += coins
+    state.treasury -= coins
+    return coins
+
+'''Moves coins from player to the treasury'''
+def pay(state, player, coins):
+    if player.coins < coins:
+        raise NotEnoughCoinsError("")
+    player.coins -= coins
+    state.treasury += coins
+
+'''Passes the turn to the next player who is still in the game'''
+def advanceTurn(state, events):
+    queue = state.players
+    if queue.numPlayers() == 0:
+        return
+    for i in range(queue.numPlayers()):
+        queue.advanceTurn()
+        if queue.getCurrentPlayer().isAlive():
+            break
+    events.append(('turn', queue.getCurrentPlayer().name))
+
+def loseCard(state, player, events):
+    card = player.killCardInHand(state.rng)
+    if card is None:
+        return
+    events.append(('cardLost', player.name, roleName(card)))
+    if not player.isAlive():
+        events.append(('eliminated', player.name))
+        checkWinner(state, events)
+
+'''Declares the winner once only one player is still in the game'''
+def checkWinner(state, events):
+    alive = [other for other in state.players.listPlayers() if other.isAlive()]
+    if len(alive) == 1 and state.winner is None:
+        state.winner = alive[0].name
+        events.append(('winner', state.winner))
+
+'''
+True if the UTF-8 name has no spaces or control characters, so it prints cleanly and
+can be typed back as a command argument
+'''
+def isPrintableName(name):
+    try:
+        text = name.decode('utf-8')
+    except UnicodeDecodeError:
+        return False
+    return all(unicodedata.category(char)[0] not in "CZ" for char in text)
+
+def join(state, action, events):
+    name = action[1]
+    if len(name) <= 0 or len(name) >= 20:
+        raise InvalidCommandError("Name must be between 1 and 20 characters in length.\n")
+    if not isPrintableName(name):
+        raise InvalidCommandError("Names can only use printable characters, without spaces.\n")
+    if state.players.getPlayerByName(name):
+        raise InvalidCommandError("A user with this name is already registered.\n")
+    if state.players.isFull():
+        raise InvalidCommandError("This game is full.\n")
+    player = Player(None, name, state.deck.deal(), state.deck.deal())
+    state.treasury -= player.coins
+    state.players.addPlayer(player)
+    events.append(('joined', name))
+
+'''Takes a player out of the game, returning their living cards and coins'''
+def leave(state, action, events):
+    player = getActor(state, action[1])
+    wasCurrent = state.players.isPlayersTurn(player)
+    wasAlive = player.isAlive()
+    for card in player.cards:
+        if isAlive(card):
+            state.deck.addCard(card)
+    state.deck.shuffle(state.rng)
+    state.treasury += player.coins
+    state.players.removePlayer(player)
+    events.append(('left', player.name))
+
+    vote = state.players.getVote('challenge')
+    if vote is not None:
+        if vote.claim[0] == player.name:
+            closeVote(state, vote, events)
+        elif player in vote.playerList:
+            vote.playerList.remove(player)
+            for votes in (vote.yesList, vote.noList):
+                if player in votes:
+                    votes.remove(player)
+            result = vote.checkResults()
+            if not vote.playerList:
+                result = FAILED
+            if result is not None:
+                resolveChallenge(state, vote, result, events)
+
+    if wasAlive:
+        checkWinner(state, events)
+    if wasCurrent and state.players.numPlayers() > 0:
+        #The queue closed over the leaver's place, so one advance reaches whoever would have been next
+        advanceTurn(state, events)
+
+def ready(state, action, events):
+    player = getActor(state, action[1])
+    player.ready = not player.ready
+    events.append(('ready', player.name, player.ready))
+
+def income(state, action, events):
+    takeCoins(state, action, events, 'income', 1)
+
+def foreignAid(state, action, events):
+    takeCoins(state, action, events, 'aid', 2)
+
+def takeCoins(state, action, events, kind, coins):
+    player = startAction(state, action[1])
+    requireNoCoup(player)
+    requireTreasury(state, coins)
+    collect(state, player, coins)
+    events.append((kind, player.name, coins))
+    advanceTurn(state, events)
+
+'''
+Duke TAX. The other players get a chance to challenge the claim before the coins are paid out.
+'''
+def tax(state, action, events):
+    player = startAction(state, action[1])
+    requireNoCoup(player)
+    requireTreasury(state, 3)
+    events.append(('tax', player.name, 3))
+
+    voters = [voter for voter in state.players.listPlayers() if voter is not player and voter.isAlive()]
+    if not voters:
+        events.append(('unchallenged', player.name, collect(state, player, 3)))
+        advanceTurn(state, events)
+        return
+
+    #A single challenger is enough to call the bluff
+    vote = Vote('challenge', voters, 100.0 / len(voters), CHALLENGE_TIMEOUT, claim=(player.name, 'Duke', 3))
+    state.players.ongoingVotes[vote.name] = vote
+    events.append(('voteOpened', vote.name, player.name, vote.timeout))
+
+def challenge(state, action, events):
+    castVote(state, action, events, True)
+
+def passChallenge(state, action, events):
+    castVote(state, action, events, False)
+
+def castVote(state, action, events, vote):
+    player = getActor(state, action[1])
+    currentVote = state.players.getVote('challenge')
+    if currentVote is None:
+        raise InvalidCommandError("There is nothing to challenge right now.\n")
+    result = currentVote.vote(player, vote)
+    if result is not None:
+        resolveChallenge(state, currentVote, result, events)
+
+'''Sent when a vote runs out of time: nobody challenged, so the vote fails'''
+def timeout(state, action, events):
+    vote = state.players.getVote(action[2])
+    if vote is None:
+        return
+    vote.concluded = True
+    resolveChallenge(state, vote, FAILED, events)
+
+def closeVote(state, vote, events):
+    vote.concluded = True
+    if state.players.getVote(vote.name) is vote:
+        del state.players.ongoingVotes[vote.name]
+    events.append(('voteClosed', vote.name))
+
+'''
+Settles a challenged claim. Without challengers the claim simply succeeds.
+Otherwise the first challenger loses a card if the claimant holds the role (which is swapped for a new card),
+and the claimant loses a card if they were bluffing.
+'''
+def resolveChallenge(state, vote, result, events):
+    closeVote(state, vote, events)
+    name, role, coins = vote.claim
+    claimant = state.players.getPlayerByName(name)
+    if claimant is None:
+        return
+
+    if result == FAILED:
+        events.append(('unchallenged', name, collect(state, claimant, coins)))
+    else:
+        challenger = vote.yesList[0]
+        card = claimant.checkForCard(role)
+        if card != -1:
+            state.deck.swapCard(claimant, card, state.rng)
+            events.append(('challengeFailed', name, role, challenger.name, collect(state, claimant, coins)))
+            loseCard(state, challenger, events)
+        else:
+            events.append(('challengeSucceeded', name))
+            loseCard(state, claimant, events)
+    advanceTurn(state, events)
+
+'''Stealing, CAPTAIN ability'''
+def steal(state, action, events):
+    player = startAction(state, action[1])
+    requireNoCoup(player)
+    target = getTarget(state, player, action[2])
+    if target.coins < 2:
+        raise NotEnoughCoinsError(target.name)
+
+    #TODO:Challenge and block
+    player.coins += 2
+    target.coins -= 2
+    events.append(('steal', player.name, target.name, 2))
+    advanceTurn(state, events)
+
+'''Exchanging cards with deck, AMBASSADOR ability'''
+def exchange(state, action, events):
+    player = startAction(state, action[1])
+    requireNoCoup(player)
+    if len(state.deck.cards) < 2:
+        raise InvalidCommandError("There are not enough cards left in the deck.\n")
+
+    events.append(('exchange', player.name))
+    player.cards.append(state.deck.deal())
+    player.cards.append(state.deck.deal())
+    events.append(('hand', player.name))
+    events.append(('exchangeDealt', player.name))
+    events.append(('exchangePrompt', player.name, len(player.cards)))
+
+'''
+Second half of the Ambassador ability: the argument names the two cards to return, e.g. "23"
+'''
+def remove(state, action, events):
+    player = getActor(state, action[1])
+    requireTurn(state, player)
+    if len(player.cards) <= 2:
+        raise CannotRemoveError()
+
+    try:
+        card1 = int(action[2]) % 10 - 1
+        card2 = int(action[2]) / 10 - 1
+    except (TypeError, ValueError):
+        raise InvalidCommandError("Cards to remove must be given as numbers. Ex. /remove 23\n")
+    if card1 == card2 or not (0 <= card1 < len(player.cards) and 0 <= card2 < len(player.cards)):
+        raise InvalidCommandError("Select two different cards between 1 and {}.\n".format(len(player.cards)))
+    if not (isAlive(player.cards[card1]) and isAlive(player.cards[card2])):
+        raise InvalidCommandError("You can only return living cards to the deck.\n")
+
+    state.deck.addCard(player.cards[card1])
+    state.deck.addCard(player.cards[card2])
+    #Delete the higher index first so the lower one still points at the right card
+    for card in sorted((card1, card2), reverse=True):
+        del player.cards[card]
+    state.deck.shuffle(state.rng)
+
+    events.append(('hand', player.name))
+    events.append(('exchangeDone', player.name))
+    advanceTurn(state, events)
+
+def assassinate(state, action, events):
+    player = startAction(state, action[1])
+    requireNoCoup(player)
+    destroy(state, player, action, events, 'assassinate', ASSASSINATE_COST)
+
+def coup(state, action, events):
+    player = startAction(state, action[1])
+    destroy(state, player, action, events, 'coup', COUP_COST)
+
+'''Performs card destruction (coup, assassination)'''
+def destroy(state, player, action, events, kind, coins):
+    target = getTarget(state, player, action[2])
+    pay(state, player, coins)
+    #TODO: ADD CHALLENGE/PROTECTION CHANCE HERE
+    events.append((kind, player.name, target.name))
+    loseCard(state, target, events)
+    advanceTurn(state, events)
+
+def endturn(state, action, events):
+    player = getActor(state, action[1])
+    requireTurn(state, player)
+    events.append(('endturn', player.name))
+    advanceTurn(state, events)
+
+RULES = {
+    'join': join,
+    'leave': leave,
+    'ready': ready,
+    'income': income,
+    'aid': foreignAid,
+    'tax': tax,
+    'challenge': challenge,
+    'pass': passChallenge,
+    'timeout': timeout,
+    'steal': steal,
+    'exchange': exchange,
+    'remove': remove,
+    'assassinate': assassinate,
+    'coup': coup,
+    'endturn': endturn,
+}
+
+'''
+Lists the actions the named player could legally take right now, for bots and simulations
+'''
+def legalActions(state, name):
+    player = state.players.getPlayerByName(name)
+    if player is None or state.winner is not None or not player.isAlive():
+        return []
+
+    vote = state.players.getVote('challenge')
+    if vote is not None:
+        if player in vote.playerList and player not in vote.yesList and player not in vote.noList:
+            return [('challenge', name, None), ('pass', name, None)]
+        return []
+
+    if not state.players.isPlayersTurn(player):
+        return []
+
+    if len(player.cards) > 2:
+        alive = [i + 1 for i, card in enumerate(player.cards) if isAlive(card)]
+        return [('remove', name, str(second * 10 + first)) for first in alive for second in alive if first < second]
+
+    targets = [other.name for other in state.players.listPlayers() if other is not player and other.isAlive()]
+    if player.coins >= COUP_COST:
+        actions = [('coup', name, target) for target in targets]
+        if player.coins >= MUST_COUP:
+            return actions
+    else:
+        actions = []
+
+    if state.treasury >= 1:
+        actions.append(('income', name, None))
+    if state.treasury >= 2:
+        actions.append(('aid', name, None))
+    if state.treasury >= 3:
+        actions.append(('tax', name, None))
+    if len(state.deck.cards) >= 2:
+        actions.append(('exchange', name, None))
+    for target in targets:
+        if state.players.getPlayerByName(target).coins >= 2:
+            actions.append(('steal', name, target))
+        if player.coins >= ASSASSINATE_COST:
+            actions.append(('assassinate', name, target))
+    return actions
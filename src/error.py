@@ -1,58 +1,60 @@
+'''
+Base class for errors in a client's command.
+Errors carry the message for the client instead of sending it themselves, so the
+game rules can raise them without a socket; the command dispatcher reports them.
+'''
+class CoupError(Exception):
+    message = ""
 
-class UnregisteredPlayerError(Exception):
-    def __init__(self, conn):
-        self.conn = conn
-        conn.sendall("Please register yourself with /register <name> before you can join.\n")
-
-class AlreadyRegisteredPlayerError(Exception):
-    def __init__(self, conn):
-        self.conn = conn
-        conn.sendall("You have already registered.\n")
-
-class NotYourTurnError(Exception):
-    def __init__(self, conn):
-        self.conn = conn
-        conn.sendall("It is not your turn to move yet.\n")
-
-class NoSuchPlayerError(Exception):
-    def __init__(self, conn, name):
-        self.conn = conn
-        conn.sendall("Failed to find a player with the name {}.\n".format(name))
-
-class NotEnoughTreasuryCoinsError(Exception):
-    def __init__(self, conn):
-        self.conn = conn
-        conn.sendall("There are not enough coins in the treasury to perform this action.\n")
-
-class InvalidCommandError(Exception):
-    def __init__(self, conn, message):
-        self.conn = conn
-        conn.sendall(message)
-
-class NotEnoughCoinsError(Exception):
-    def __init__(self, conn, name):
-        self.conn = conn
+    def __init__(self, message=None):
+        if message is not None:
+            self.message = message
+        Exception.__init__(self, self.message)
+
+class UnregisteredPlayerError(CoupError):
+    message = "Please register yourself with /register <name> before you can join.\n"
+
+class AlreadyRegisteredPlayerError(CoupError):
+    message = "You have already registered.\n"
+
+class NotYourTurnError(CoupError):
+    message = "It is not your turn to move yet.\n"
+
+class NoSuchPlayerError(CoupError):
+    def __init__(self, name):
+        CoupError.__init__(self, "Failed to find a player with the name {}.\n".format(name))
+
+class NotEnoughTreasuryCoinsError(CoupError):
+    message = "There are not enough coins in the treasury to perform this action.\n"
+
+class InvalidCommandError(CoupError):
+    pass
+
+class NotEnoughCoinsError(CoupError):
+    def __init__(self, name):
         if name == "":
-            conn.sendall("You do not have enough coins.\n")
+            CoupError.__init__(self, "You do not have enough coins.\n")
         else:
-            conn.sendall(name + " does not have enough coins.\n")
-
-class MustCoupError(Exception):
-    def __init__(self, conn):
-	self.conn = conn
-	conn.sendall("You have 10 or more coins, you must Coup.\n")
-
-class CannotRemoveError(Exception):
-    def __init__(self, conn):
-	self.conn = conn
-	conn.sendall("You are not currently using the Ambassador ability.\n")
-
-class AlreadyExchangingError(Exception):
-    def __init__(self, conn):
-	self.conn = conn
-	conn.sendall("You are already exchanging cards.\n")
-
-class NotEnoughArguments(Exception):
-    def __init__(self, conn):
-	self.conn = conn
-	conn.sendall("Not enough arguments.\n")
+            CoupError.__init__(self, name + " does not have enough coins.\n")
+
+class MustCoupError(CoupError):
+    message = "You have 10 or more coins, you must Coup.\n"
+
+class CannotRemoveError(CoupError):
+    message = "You are not currently using the Ambassador ability.\n"
+
+class AlreadyExchangingError(CoupError):
+    message = "You are already exchanging cards.\n"
+
+class NotEnoughArguments(CoupError):
+    message = "Not enough arguments.\n"
+
+class NoSuchRoomError(CoupError):
+    def __init__(self, name):
+        CoupError.__init__(self, "Failed to find a room with the name {}.\n".format(name))
+
+class NotAdminError(CoupError):
+    message = "Only server administrators can use this command.\n"
+
+class RateLimitedError(CoupError):
+    message = "You are sending commands too fast. Slow down.\n"
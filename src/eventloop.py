@@ -0,0 +1,308 @@
+#Single-threaded, non-blocking server core for COUP
+import errno, fcntl, os, socket, traceback
+from poller import Poller, WOULD_BLOCK
+from outbound import OutboundQueue, DEFAULT_LIMIT, DEFAULT_POLICY
+
+'''
+Raises the open file limit as high as the hard limit allows, so that one process can hold thousands of sockets.
+Returns the resulting soft limit (or None on platforms without the resource module).
+'''
+def raiseFileLimit():
+    try:
+        import resource
+    except ImportError:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError):
+            pass
+    return soft
+
+#TCP keepalive probes: after this many idle seconds, every this many seconds, giving up after this many
+KEEPALIVE_IDLE = 60
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 3
+
+'''
+Sets up a client socket of either server.
+Output is written a whole action at a time, so there is nothing for Nagle's algorithm to merge.
+Keepalive probes let the kernel notice a peer that vanished without closing the connection
+(a laptop lid, a NAT timeout) within a couple of minutes, even if the client never sends anything.
+'''
+def tuneClientSocket(sock):
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for option, value in (('TCP_KEEPIDLE', KEEPALIVE_IDLE), ('TCP_KEEPINTVL', KEEPALIVE_INTERVAL), ('TCP_KEEPCNT', KEEPALIVE_COUNT)):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+'''
+A non-blocking client connection.
+It exposes the same sendall/close interface as a socket so the existing command handlers can use it unchanged.
+Output that the kernel won't take right away is kept in a bounded OutboundQueue and flushed when the socket
+becomes writable; the server's overflow policy decides what happens to a client that falls too far behind.
+'''
+class Connection(object):
+    __slots__ = ('sock', 'fd', 'address', 'loop', 'handler', 'outbox', 'closed', '__weakref__')
+    #Speaks the telnet text protocol (see protocol.StructuredConnection)
+    structured = False
+
+    def __init__(self, loop, sock, address):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.address = address
+        self.loop = loop
+        self.handler = None
+        #Only allocated while there is unsent output, so idle connections stay small
+        self.outbox = None
+        self.closed = False
+
+    def fileno(self):
+        return self.fd
+
+    '''Queues data for the client, writing as much as possible immediately'''
+    def sendall(self, data):
+        if self.closed:
+            return
+        if self.outbox is None:
+            sent = self.send(data)
+            if sent is None or sent == len(data):
+                return
+            data = data[sent:]
+            self.queueOutput()
+        if not self.outbox.push(data):
+            self.close()
+
+    '''Starts buffering output until the socket is writable again'''
+    def queueOutput(self):
+        self.outbox = OutboundQueue(self.loop.outboundLimit, self.loop.overflowPolicy)
+        self.loop.wantWrite(self, True)
+
+    '''Sends as much of data as the socket accepts. Returns the byte count, or None if the connection died'''
+    def send(self, data):
+        try:
+            return self.sock.send(data)
+        except socket.error as e:
+            if e.args[0] in WOULD_BLOCK:
+                return 0
+            self.close()
+            return None
+
+    '''Called by the loop when the socket is writable'''
+    def flush(self):
+        while self.outbox:
+            sent = self.send(self.outbox.peek())
+            if not sent:
+                return
+            self.outbox.consume(sent)
+        self.outbox = None
+        self.loop.wantWrite(self, False)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.outbox = None
+        self.loop.dropConnection(self)
+
+'''
+Accepts clients and reads their commands from a single thread.
+handlerFactory(conn) is called for every new Connection and must return an object with
+processData(data) and disconnect() methods.
+outboundLimit and overflowPolicy bound the output buffered for each client (see outbound.py).
+If a TimerScheduler is given, its timers run on the loop thread between socket events.
+A handler that raises is logged and only its own connection is closed; the loop keeps serving everyone else.
+listener is a socket that is already listening, such as one inherited from the process
+this one replaced (see handoff.py); server_address is ignored if it is given.
+'''
+class CoupEventServer(object):
+    def __init__(self, server_address, handlerFactory, backlog=socket.SOMAXCONN,
+                 outboundLimit=DEFAULT_LIMIT, overflowPolicy=DEFAULT_POLICY, scheduler=None, listener=None):
+        self.handlerFactory = handlerFactory
+        self.scheduler = scheduler
+        self.outboundLimit = outboundLimit
+        self.overflowPolicy = overflowPolicy
+        if listener is not None:
+            self.socket = listener
+        else:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                self.socket.bind(server_address)
+                self.socket.listen(backlog)
+            except socket.error:
+                self.socket.close()
+                raise
+        self.socket.setblocking(0)
+        self.server_address = self.socket.getsockname()
+
+        self.poller = Poller()
+        self.poller.register(self.socket.fileno(), self.poller.READ)
+        self.connections = {}
+        self.running = False
+        #Functions to run on the loop thread, queued by signal handlers and other threads
+        self.requests = []
+        #requestCall() writes to this pipe to interrupt the loop's wait
+        self.wakeRead, self.wakeWrite = os.pipe()
+        for fd in (self.wakeRead, self.wakeWrite):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.poller.register(self.wakeRead, self.poller.READ)
+
+    '''Runs the event loop until shutdown() is called'''
+    def serve_forever(self):
+        self.running = True
+        listenFd = self.socket.fileno()
+        readMask = self.poller.READ | self.poller.ERROR
+        writeMask = self.poller.WRITE
+        while self.running:
+            timeout = None
+            if self.scheduler is not None:
+                timeout = self.scheduler.nextTimeout()
+            for fd, mask in self.poller.poll(timeout):
+                if fd == listenFd:
+                    self.acceptConnections()
+                    continue
+                if fd == self.wakeRead:
+                    self.drainWakeups()
+                    continue
+                conn = self.connections.get(fd)
+                if conn is None:
+                    continue
+                if mask & writeMask:
+                    conn.flush()
+                if mask & readMask and not conn.closed:
+                    self.readConnection(conn)
+            if self.scheduler is not None:
+                self.scheduler.runDue()
+            while self.requests:
+                try:
+                    self.requests.pop(0)()
+                except Exception:
+                    traceback.print_exc()
+
+    def shutdown(self):
+        self.running = False
+
+    '''
+    Runs func on the loop thread once the current event has been handled.
+    Safe to call from a signal handler or another thread: either way the loop's wait is interrupted.
+    '''
+    def requestCall(self, func):
+        self.requests.append(func)
+        try:
+            os.write(self.wakeWrite, "x")
+        except OSError as e:
+            #A full pipe already holds a wakeup
+            if e.errno not in WOULD_BLOCK:
+                raise
+
+    def drainWakeups(self):
+        try:
+            while os.read(self.wakeRead, 4096):
+                pass
+        except OSError as e:
+            if e.errno not in WOULD_BLOCK:
+                raise
+
+    '''Closes the listening socket and every client connection'''
+    def server_close(self):
+        for conn in self.connections.values():
+            conn.close()
+        self.poller.unregister(self.socket.fileno())
+        self.socket.close()
+        self.poller.unregister(self.wakeRead)
+        os.close(self.wakeRead)
+        os.close(self.wakeWrite)
+
+    '''
+    Opens an outgoing connection that is served by this loop alongside the accepted clients.
+    Anything sent before the connect completes is held in the outbox.
+    '''
+    def connect(self, address, handlerFactory):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        err = sock.connect_ex(address)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            raise socket.error(err, os.strerror(err))
+        conn = Connection(self, sock, address)
+        self.connections[conn.fd] = conn
+        self.poller.register(conn.fd, self.poller.READ)
+        if err != 0:
+            #Buffer output until the socket becomes writable, which is when the connect completes
+            conn.queueOutput()
+        conn.handler = handlerFactory(conn)
+        return conn
+
+    def acceptConnections(self):
+        while True:
+            try:
+                sock, address = self.socket.accept()
+            except socket.error as e:
+                if e.args[0] in WOULD_BLOCK or e.args[0] in (errno.ECONNABORTED, errno.EMFILE, errno.ENFILE):
+                    return
+                raise
+            self.adopt(sock, address)
+
+    '''
+    Serves a connected client socket, accepted by this loop or inherited.
+    Returns its Connection, or None if the handler could not be set up
+    '''
+    def adopt(self, sock, address):
+        sock.setblocking(0)
+        tuneClientSocket(sock)
+        conn = Connection(self, sock, address)
+        self.connections[conn.fd] = conn
+        self.poller.register(conn.fd, self.poller.READ)
+        try:
+            conn.handler = self.handlerFactory(conn)
+        except Exception:
+            traceback.print_exc()
+            conn.close()
+            return None
+        return conn
+
+    def readConnection(self, conn):
+        try:
+            data = conn.sock.recv(4096)
+        except socket.error as e:
+            if e.args[0] in WOULD_BLOCK:
+                return
+            data = ""
+        if not data:
+            conn.close()
+            return
+        self.callHandler(conn, conn.handler.processData, data)
+
+    '''Calls func(*args) for conn's handler. If it raises, the error is logged and only conn is closed'''
+    def callHandler(self, conn, func, *args):
+        try:
+            func(*args)
+        except Exception:
+            traceback.print_exc()
+            conn.close()
+
+    '''Turns interest in writability on or off for a connection'''
+    def wantWrite(self, conn, enabled):
+        if conn.closed:
+            return
+        mask = self.poller.READ
+        if enabled:
+            mask |= self.poller.WRITE
+        self.poller.modify(conn.fd, mask)
+
+    '''Forgets a connection that has been closed, and tells its handler'''
+    def dropConnection(self, conn):
+        if self.connections.pop(conn.fd, None) is None:
+            return
+        self.poller.unregister(conn.fd)
+        try:
+            conn.sock.close()
+        except socket.error:
+            pass
+        if conn.handler is not None:
+            self.callHandler(conn, conn.handler.disconnect)
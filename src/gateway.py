@@ -0,0 +1,418 @@
+#Connection gateway that spreads COUP rooms over several worker processes
+import json, multiprocessing, socket, sys, time
+from collections import deque
+from eventloop import CoupEventServer, raiseFileLimit
+from room import RoomManager
+from linebuffer import LineBuffer
+from protocol import SYNC, encode, encodeText
+
+#Commands the gateway has to look at to decide where a client's room lives
+ROUTED_COMMANDS = ("/rooms", "/create", "/join", "/leave")
+#Lines kept from a client while the gateway waits on its worker. Any more are dropped
+MAX_HELD_LINES = 256
+
+'''
+Decides which worker hosts each room.
+A new room goes to the worker with the fewest connected clients, and a room is
+forgotten once its last client leaves, so load evens out as rooms open and close.
+'''
+class RoomRouter(object):
+    def __init__(self, workers, defaultRoom):
+        self.workers = list(workers)
+        self.defaultRoom = defaultRoom
+        #room name -> worker index
+        self.rooms = {}
+        #room name -> number of gateway clients in the room
+        self.clients = {}
+        #worker index -> number of gateway clients on the worker
+        self.load = [0] * len(self.workers)
+        self.assign(defaultRoom)
+
+    '''Returns the index of the worker hosting name, or None'''
+    def lookup(self, name):
+        return self.rooms.get(name)
+
+    '''Places a new room on the least loaded worker and returns that worker's index'''
+    def assign(self, name):
+        if name in self.rooms:
+            return self.rooms[name]
+        worker = min(range(len(self.workers)), key=lambda i: self.load[i])
+        self.rooms[name] = worker
+        self.clients[name] = 0
+        return worker
+
+    def enter(self, name):
+        self.clients[name] += 1
+        self.load[self.rooms[name]] += 1
+
+    def leave(self, name):
+        self.clients[name] -= 1
+        self.load[self.rooms[name]] -= 1
+        self.release(name)
+
+    '''Forgets name if no client is in it, such as a room that was reserved but never created'''
+    def release(self, name):
+        if self.clients.get(name) == 0 and name != self.defaultRoom:
+            del self.clients[name]
+            del self.rooms[name]
+
+    '''Returns (name, clients) pairs sorted by name for easy listing'''
+    def listRooms(self):
+        return [(name, self.clients[name]) for name in sorted(self.rooms)]
+
+'''
+The worker side of a GatewayClient: relays everything the worker says back to the client,
+except the replies to the gateway's sync lines, which go to the client object instead
+'''
+class BackendLink(object):
+    def __init__(self, client, conn):
+        self.client = client
+        self.conn = conn
+        self.detached = False
+        #Set while the gateway is setting up the client on a new worker, whose replies the client didn't ask for
+        self.muted = False
+        #The start of a sync reply cut off at the end of a read
+        self.carry = ""
+
+    def processData(self, data):
+        if self.carry:
+            data = self.carry + data
+            self.carry = ""
+        while "\x00" in data:
+            start = data.index("\x00")
+            if start:
+                self.forward(data[:start])
+            end = data.find("\n", start)
+            if end < 0:
+                self.carry = data[start:]
+                return
+            line, data = data[start:end], data[end + 1:]
+            if line.startswith(SYNC + " "):
+                self.client.synced(self, line[len(SYNC) + 1:].split(" "))
+            else:
+                self.forward(line + "\n")
+        if data:
+            self.forward(data)
+
+    def forward(self, data):
+        if not self.detached and not self.muted:
+            self.client.conn.sendall(data)
+
+    def sendall(self, data):
+        self.conn.sendall(data)
+
+    def close(self):
+        self.detached = True
+        self.conn.close()
+
+    def disconnect(self):
+        if not self.detached:
+            self.client.backendLost()
+
+'''
+One telnet client of the gateway.
+Commands are relayed to the worker hosting the client's room; room commands are
+intercepted so the client can be moved to a different worker when it changes rooms.
+Before a room command is handled, the gateway syncs with the worker (see protocol.SYNC), so that
+the worker's replies to earlier lines reach the client first. Later lines are held until it is done,
+and the router only records a move once the worker reports the client in the new room.
+The worker also reports the client's protocol and admin status, which a move to another worker takes along.
+'''
+class GatewayClient(object):
+    def __init__(self, gateway, conn):
+        self.gateway = gateway
+        self.router = gateway.router
+        self.conn = conn
+        self.lines = LineBuffer()
+        #Lines that arrived while waiting for a sync, and (link, callback) for that sync
+        self.held = deque()
+        self.waiting = None
+        #As the worker last reported them, and the token of the client's last /admin command
+        self.structured = False
+        self.admin = False
+        self.adminToken = None
+        self.room = self.router.defaultRoom
+        self.router.enter(self.room)
+        self.worker = self.router.lookup(self.room)
+        self.backend = None
+        try:
+            self.backend = self.connect(self.worker)
+        except socket.error:
+            self.backendLost()
+
+    def processData(self, data):
+        lines = self.lines.feed(data)
+        if self.waiting is not None:
+            self.hold(lines)
+        else:
+            self.run(lines)
+
+    def hold(self, lines):
+        room = MAX_HELD_LINES - len(self.held)
+        self.held.extend(lines[:max(room, 0)])
+
+    def run(self, lines):
+        forward = []
+        for i, line in enumerate(lines):
+            if line.startswith("\x00"):
+                #Only the gateway may sync with a worker
+                continue
+            parts = line.strip().split(' ', 1)
+            self.watch(parts, line)
+            if parts[0] in ROUTED_COMMANDS:
+                self.relay(forward)
+                forward = []
+                self.sync(self.backend, lambda room, parts=parts, line=line: self.route(parts, line))
+                return self.hold(lines[i + 1:])
+            forward.append(line)
+        self.relay(forward)
+
+    '''Remembers the token of an /admin command in either protocol, to log the client in again on another worker'''
+    def watch(self, parts, line):
+        if parts[0] == "/admin" and len(parts) > 1:
+            self.adminToken = parts[1].strip()
+        elif "admin" in line and line.lstrip().startswith(("{", "[")):
+            try:
+                requests = json.loads(line)
+            except ValueError:
+                return
+            for request in requests if isinstance(requests, list) else [requests]:
+                if (isinstance(request, dict) and request.get("cmd") in ("/admin", "admin")
+                        and isinstance(request.get("args"), basestring)):
+                    self.adminToken = request["args"].strip().encode('utf-8')
+
+    '''Returns a command line for the worker in the client's protocol'''
+    def command(self, name, args=None):
+        if self.structured:
+            return encode({"id": None, "cmd": name, "args": args}).rstrip("\n")
+        return name if args is None else "{0} {1}".format(name, args)
+
+    '''Sends text of the gateway's own to the client, in its protocol'''
+    def tell(self, text):
+        self.conn.sendall(encodeText(text) if self.structured else text)
+
+    '''Sends a run of lines to the worker in a single write'''
+    def relay(self, lines):
+        if lines and self.backend is not None:
+            self.backend.sendall("\n".join(lines) + "\n")
+
+    '''Calls callback(room) once link has answered everything sent to it so far'''
+    def sync(self, link, callback):
+        self.waiting = (link, callback)
+        link.sendall(SYNC + "\n")
+
+    '''Called by a BackendLink with what its worker says about the client: its room, protocol and admin status'''
+    def synced(self, link, fields):
+        if self.waiting is None or self.waiting[0] is not link:
+            return
+        room = fields[0]
+        if len(fields) >= 3:
+            self.structured = fields[1] == "json"
+            self.admin = fields[2] == "admin"
+        callback = self.waiting[1]
+        self.waiting = None
+        callback(room)
+        if self.waiting is None and self.held:
+            lines = list(self.held)
+            self.held.clear()
+            self.run(lines)
+
+    '''Handles a room command once the worker has answered every line before it'''
+    def route(self, parts, line):
+        command = parts[0]
+        name = parts[1].strip() if len(parts) >= 2 else ""
+        #The client's own line, in the protocol the worker expects from it
+        line = self.command(command, name or None)
+
+        if command == "/rooms":
+            message = "ROOMS:\n"
+            for room, clients in self.router.listRooms():
+                message += "{0} ({1} connected)\n".format(room, clients)
+            self.tell(message)
+
+        elif command == "/create":
+            if len(name) <= 0 or len(name) >= 20:
+                self.relay([line])
+            elif self.router.lookup(name) is not None:
+                self.tell("A room named {} already exists.\n".format(name))
+            else:
+                #Reserved now, so nobody else can create it on another worker in the meantime
+                self.moveTo(self.router.assign(name), name, line)
+
+        elif command == "/join":
+            if self.router.lookup(name) is None or name == self.room:
+                self.relay([line])
+            else:
+                self.moveTo(self.router.lookup(name), name, line)
+
+        elif command == "/leave":
+            if self.room == self.router.defaultRoom:
+                self.relay([line])
+            else:
+                self.moveTo(self.router.lookup(self.router.defaultRoom), self.router.defaultRoom, line)
+
+    '''
+    Sends line to worker and records where the worker says the client ended up. If the room lives
+    on another worker, the line goes over a new connection to it, and the old connection (and the
+    client's place there) is only given up once the new worker confirms the move.
+    '''
+    def moveTo(self, worker, room, line):
+        if worker == self.worker:
+            self.relay([line])
+            return self.sync(self.backend, lambda actual: self.moved(room, actual, None))
+        try:
+            link = self.connect(worker)
+        except socket.error:
+            return self.backendLost()
+        self.prepare(link, lambda actual: self.enterOn(link, worker, room, line))
+
+    '''
+    Gives a new worker connection the client's protocol and admin status, then calls callback(room).
+    The worker's answers to this are the gateway's business, not the client's
+    '''
+    def prepare(self, link, callback):
+        lines = []
+        if self.structured:
+            lines.append("/protocol json")
+        if self.admin and self.adminToken is not None:
+            lines.append(self.command("/admin", self.adminToken))
+        if not lines:
+            return callback(None)
+        link.muted = True
+        link.sendall("\n".join(lines) + "\n")
+        self.sync(link, callback)
+
+    def enterOn(self, link, worker, room, line):
+        link.muted = False
+        if room != self.router.defaultRoom:
+            #A fresh worker connection already starts out in the default room
+            link.sendall(line + "\n")
+        self.sync(link, lambda actual: self.moved(room, actual, (worker, link)))
+
+    def moved(self, room, actual, switch):
+        if switch is not None:
+            worker, link = switch
+            if actual != room:
+                #The worker refused (and has said why): stay where we were
+                link.close()
+                self.router.release(room)
+                return
+            self.dropBackend()
+            self.worker, self.backend = worker, link
+            if room == self.router.defaultRoom:
+                self.tell("You are now in room {}.\n".format(room))
+        if actual != self.room:
+            self.router.leave(self.room)
+            self.room = actual
+            self.router.enter(actual)
+        self.router.release(room)
+
+    def connect(self, worker):
+        return self.gateway.server.connect(self.router.workers[worker], lambda conn: BackendLink(self, conn)).handler
+
+    def dropBackend(self):
+        backend = self.backend
+        self.backend = None
+        if backend is not None:
+            backend.close()
+
+    '''Called when the worker connection dies underneath the client'''
+    def backendLost(self):
+        self.backend = None
+        self.tell("Lost connection to the game server.\n")
+        self.disconnect()
+        self.conn.close()
+
+    def disconnect(self):
+        self.dropBackend()
+        if self.waiting is not None:
+            self.waiting[0].close()
+            self.waiting = None
+        if self.room is not None:
+            self.router.leave(self.room)
+            self.room = None
+
+'''
+Accepts telnet clients and routes each of them to the worker that hosts their room.
+workers is a list of (host, port) addresses of CoupEventServer workers; they may live on other hosts.
+'''
+class CoupGateway(object):
+    def __init__(self, address, workers):
+        self.router = RoomRouter(workers, RoomManager.DEFAULT_ROOM)
+        self.server = CoupEventServer(address, self.createClient)
+        self.server_address = self.server.server_address
+
+    def createClient(self, conn):
+        return GatewayClient(self, conn)
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def shutdown(self):
+        self.server.shutdown()
+
+    def server_close(self):
+        self.server.server_close()
+
+def runWorker(address):
+    #Imported here so the gateway itself doesn't pull in the game modules
+    from server import serve_worker
+    serve_worker(address)
+
+'''
+Starts count local worker processes listening on consecutive ports after basePort.
+Returns their processes and addresses.
+'''
+def spawnWorkers(host, basePort, count):
+    processes, addresses = [], []
+    for i in range(count):
+        address = (host, basePort + 1 + i)
+        process = multiprocessing.Process(target=runWorker, args=(address,))
+        process.daemon = True
+        process.start()
+        processes.append(process)
+        addresses.append(address)
+    return processes, addresses
+
+'''Blocks until every worker accepts connections, or timeout seconds pass'''
+def waitForWorkers(addresses, timeout=10):
+    deadline = time.time() + timeout
+    for address in addresses:
+        while True:
+            try:
+                socket.create_connection(address, 1).close()
+                break
+            except socket.error:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.05)
+
+'''
+Parses the [workers] argument: either a number of local workers to spawn,
+or a comma separated list of host:port addresses of workers that are already running.
+'''
+def parseWorkers(arg, host, port):
+    if arg.isdigit():
+        return spawnWorkers(host, port, int(arg))
+    addresses = []
+    for item in arg.split(","):
+        workerHost, workerPort = item.rsplit(":", 1)
+        addresses.append((workerHost, int(workerPort)))
+    return [], addresses
+
+if __name__ == "__main__":
+    print "Welcome to the COUP gateway!\n"
+    HOST, PORT = sys.argv[1], int(sys.argv[2])
+    WORKERS = sys.argv[3] if len(sys.argv) > 3 else str(multiprocessing.cpu_count())
+
+    processes, addresses = parseWorkers(WORKERS, '127.0.0.1', PORT)
+    waitForWorkers(addresses)
+    print "Workers:", ", ".join("{0}:{1}".format(*address) for address in addresses)
+
+    gateway = CoupGateway((HOST, PORT), addresses)
+    print "Open file limit:", raiseFileLimit()
+    try:
+        gateway.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    gateway.server_close()
@@ -0,0 +1,89 @@
+#Hot restart: a new server process takes over the listening socket, the clients and the rooms of the old one
+import fcntl, marshal, os, socket, sys, tempfile
+
+#Names the file holding the state handed to the new process
+HANDOFF_ENV = "COUP_HANDOFF"
+
+'''Lets fd survive exec()'''
+def inherit(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) & ~fcntl.FD_CLOEXEC)
+
+'''Closes every other file descriptor on exec(), so pipes and ports that aren't handed off are released'''
+def closeOthersOnExec(keep):
+    try:
+        fds = [int(name) for name in os.listdir("/proc/self/fd")]
+    except OSError:
+        fds = range(3, os.sysconf("SC_OPEN_MAX"))
+    for fd in fds:
+        if fd > 2 and fd not in keep:
+            try:
+                fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+            except IOError:
+                pass
+
+'''
+Replaces the running event loop server with a fresh copy of the program, started with the same arguments.
+The listening socket and every client socket stay open across exec(), and a file describes them
+along with each client's room, seat, protocol and unread input, and the rooms themselves
+(unless a journal holds them). Clients see nothing but a pause.
+'''
+def restart(server, rooms, journal=None):
+    clients = []
+    for conn in server.connections.values():
+        if conn.closed or conn.handler is None:
+            continue
+        clients.append(conn.handler.handoffState())
+    state = {
+        "listener": server.socket.fileno(),
+        "clients": clients,
+        "rooms": rooms.snapshot() if journal is None else None,
+    }
+    if journal is not None:
+        #Everything the new process needs from the journal has to be on disk first
+        journal.close()
+
+    fd, path = tempfile.mkstemp(prefix="coup-handoff-")
+    with os.fdopen(fd, 'wb') as f:
+        marshal.dump(state, f)
+
+    keep = set([state["listener"]] + [client[0] for client in clients])
+    for fd in keep:
+        inherit(fd)
+    closeOthersOnExec(keep)
+    sys.stdout.flush()
+    os.environ[HANDOFF_ENV] = path
+    os.execv(sys.executable, [sys.executable] + sys.argv)
+
+'''Returns the state handed over by the process this one replaced, or None for a normal start'''
+def load():
+    path = os.environ.pop(HANDOFF_ENV, None)
+    if path is None:
+        return None
+    try:
+        with open(path, 'rb') as f:
+            state = marshal.load(f)
+    finally:
+        os.remove(path)
+    return state
+
+def fromFd(fd):
+    sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+    #fromfd() duplicates the descriptor
+    os.close(fd)
+    return sock
+
+'''Returns the inherited listening socket'''
+def listener(state):
+    return fromFd(state["listener"])
+
+'''Serves the inherited clients from server, putting each back in its room and seat'''
+def resume(server, state):
+    for client in state["clients"]:
+        fd, address = client[0], client[1]
+        try:
+            sock = fromFd(fd)
+        except socket.error:
+            continue
+        conn = server.adopt(sock, address)
+        if conn is not None:
+            server.callHandler(conn, conn.handler.resumeClient, *client[2:])
@@ -0,0 +1,315 @@
+#Append-only journal of game actions, with periodic snapshots, for crash recovery
+import marshal, os, struct, threading, time
+from error import CoupError
+
+#When the writer thread forces journal writes to disk
+FSYNC_ALWAYS = "always"         #after every batch of records
+FSYNC_INTERVAL = "interval"     #at most once every interval seconds
+FSYNC_NEVER = "never"           #leave it to the operating system
+FSYNC_POLICIES = (FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_NEVER)
+
+DEFAULT_FSYNC = FSYNC_INTERVAL
+DEFAULT_INTERVAL = 1.0
+#Records between snapshots
+DEFAULT_SNAPSHOT_EVERY = 5000
+
+SNAPSHOT_FILE = "snapshot"
+LOG_PREFIX = "log."
+#Every log record is a little-endian length followed by that many bytes of marshal data
+HEADER = struct.Struct('<I')
+
+#Kinds of work queued for the writer thread
+RECORD = 0
+BEGIN = 1       #a snapshot has started, of the rooms named
+CAPTURE = 2     #one room's state for that snapshot
+
+def frame(data):
+    return HEADER.pack(len(data)) + data
+
+'''Reads the framed records in data, stopping at a record cut short by a crash'''
+def unframe(data):
+    records = []
+    offset = 0
+    while offset + HEADER.size <= len(data):
+        size = HEADER.unpack_from(data, offset)[0]
+        offset += HEADER.size
+        if offset + size > len(data):
+            break
+        try:
+            records.append(marshal.loads(data[offset:offset + size]))
+        except (EOFError, ValueError, TypeError):
+            break
+        offset += size
+    return records
+
+'''
+Records every change to every room, so a restarted server can put its rooms back the way they were.
+A snapshot of all rooms starts each generation of the journal; the log that follows it holds the
+records made since (room creation and closing, and every action applied to a game).
+Callers never touch the disk: records are queued and a writer thread batches them into the log,
+syncing according to the fsync policy.
+Rooms don't stop for a snapshot. Each room's state is taken on the thread that runs the room, between two of
+its records (see RoomManager.beginSnapshot), and each record lands on one side of it: the records queued after
+their room's capture, or for rooms created since the snapshot began, start the next generation's log.
+'''
+class Journal(object):
+    def __init__(self, path, fsync=DEFAULT_FSYNC, interval=DEFAULT_INTERVAL, snapshotEvery=DEFAULT_SNAPSHOT_EVERY):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("Unknown fsync policy {}".format(fsync))
+        self.path = path
+        self.fsync = fsync
+        self.interval = interval
+        self.snapshotEvery = snapshotEvery
+        #Taken after the rooms' lock, never before
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.pending = []
+        self.sinceSnapshot = 0
+        #True from the start of a snapshot until the writer has written it
+        self.snapshotting = False
+        #The snapshot the writer thread is putting together (see Snapshot)
+        self.building = None
+        self.rooms = None
+        self.thread = None
+        self.closing = False
+        self.generation = 0
+        self.log = None
+        self.lastSync = 0.0
+        self.dirty = False
+
+    '''
+    Queues a record of a change to the room called record[1]. Does nothing until recover() has started the journal.
+    Once snapshotEvery records have piled up, the caller starts a snapshot
+    '''
+    def record(self, *record):
+        if self.thread is None:
+            return
+        data = frame(marshal.dumps(record))
+        with self.lock:
+            self.pending.append((RECORD, record, data))
+            self.sinceSnapshot += 1
+            due = self.sinceSnapshot >= self.snapshotEvery and not self.snapshotting
+            if due:
+                self.snapshotting = True
+            self.wakeup.notify()
+        if due:
+            self.rooms.beginSnapshot(self)
+
+    '''Starts a snapshot of every room, which begins a new generation of the journal'''
+    def snapshot(self):
+        with self.lock:
+            if self.snapshotting:
+                return
+            self.snapshotting = True
+        self.rooms.beginSnapshot(self)
+
+    '''Called by the rooms, under their lock, with the names of the rooms about to be captured'''
+    def begin(self, names):
+        with self.lock:
+            self.pending.append((BEGIN, names, None))
+            self.sinceSnapshot = 0
+            self.wakeup.notify()
+
+    '''
+    Called with a room's state for the snapshot (or None if the room has closed) by the thread that runs the room.
+    The state is built of immutable pieces, so the writer thread can serialize it later
+    '''
+    def capture(self, name, state):
+        with self.lock:
+            self.pending.append((CAPTURE, name, state))
+            self.wakeup.notify()
+
+    '''
+    Restores rooms from the latest snapshot and log, then starts journaling.
+    The recovered state is snapshotted straight away so each generation is replayed at most once.
+    '''
+    def recover(self, rooms):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.generation, snapshot, records = self.load()
+        if snapshot is not None:
+            rooms.restore(snapshot)
+        for record in records:
+            replay(rooms, record)
+        for room in rooms.listRooms():
+            room.game.resume()
+
+        self.rooms = rooms
+        self.log = open(self.logPath(self.generation), 'ab')
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        self.snapshot()
+        return len(records)
+
+    '''Returns the generation, snapshot and log records found on disk'''
+    def load(self):
+        try:
+            with open(os.path.join(self.path, SNAPSHOT_FILE), 'rb') as f:
+                data = f.read()
+        except IOError:
+            return 0, None, []
+        generation, snapshot = marshal.loads(data)
+        try:
+            with open(self.logPath(generation), 'rb') as f:
+                records = unframe(f.read())
+        except IOError:
+            records = []
+        return generation, snapshot, records
+
+    def logPath(self, generation):
+        return os.path.join(self.path, LOG_PREFIX + str(generation))
+
+    '''Writes out everything queued and stops the writer thread'''
+    def close(self):
+        if self.thread is None:
+            return
+        with self.lock:
+            self.closing = True
+            self.wakeup.notify()
+        self.thread.join()
+        self.thread = None
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.pending and not self.closing:
+                    #Wake up to sync records that are still only in the page cache
+                    if self.dirty and self.fsync == FSYNC_INTERVAL:
+                        self.wakeup.wait(max(0.0, self.lastSync + self.interval - time.time()))
+                        break
+                    self.wakeup.wait()
+                items, self.pending = self.pending, []
+                closing = self.closing
+
+            batch = []
+            for kind, item, data in items:
+                if kind == RECORD:
+                    batch.append(data)
+                    if self.building is not None:
+                        self.building.record(item, data)
+                    continue
+                self.append(batch)
+                batch = []
+                if kind == BEGIN:
+                    self.building = Snapshot(item)
+                else:
+                    self.building.capture(item, data)
+                if self.building.complete():
+                    self.writeSnapshot(self.building.states(), self.building.carried)
+                    self.building = None
+                    with self.lock:
+                        self.snapshotting = False
+            self.append(batch)
+            self.sync(closing)
+
+            if closing:
+                self.log.close()
+                return
+
+    def append(self, batch):
+        if batch:
+            self.log.write("".join(batch))
+            self.dirty = True
+
+    def sync(self, force):
+        if not self.dirty:
+            return
+        self.log.flush()
+        now = time.time()
+        if self.fsync == FSYNC_ALWAYS or force or (self.fsync == FSYNC_INTERVAL and now - self.lastSync >= self.interval):
+            if self.fsync != FSYNC_NEVER:
+                os.fsync(self.log.fileno())
+            self.lastSync = now
+            self.dirty = False
+
+    '''
+    Writes a snapshot, and the records that follow it, as the start of the next generation and retires the previous log.
+    The new log is on disk before the snapshot that points to it
+    '''
+    def writeSnapshot(self, rooms, carried):
+        previous = self.generation
+        self.generation += 1
+        log = open(self.logPath(self.generation), 'wb')
+        log.write("".join(carried))
+        log.flush()
+        if self.fsync != FSYNC_NEVER:
+            os.fsync(log.fileno())
+        temporary = os.path.join(self.path, SNAPSHOT_FILE + ".tmp")
+        with open(temporary, 'wb') as f:
+            marshal.dump((self.generation, rooms), f)
+            f.flush()
+            if self.fsync != FSYNC_NEVER:
+                os.fsync(f.fileno())
+        os.rename(temporary, os.path.join(self.path, SNAPSHOT_FILE))
+        if self.fsync != FSYNC_NEVER:
+            directory = os.open(self.path, os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+
+        #Everything in the old log is covered by the snapshot and the new log now
+        self.log.close()
+        self.log = log
+        self.dirty = False
+        try:
+            os.remove(self.logPath(previous))
+        except OSError:
+            pass
+
+'''
+A snapshot being put together by the writer thread, from the rooms named when it began.
+Records of those rooms are covered by the snapshot until the room is captured (or closes);
+the records after that, and those of rooms created since, are carried over to the next log.
+'''
+class Snapshot(object):
+    def __init__(self, names):
+        #Rooms whose capture is still to come, and the captures still to arrive
+        self.open = set(names)
+        self.remaining = len(names)
+        self.captured = {}
+        self.carried = []
+
+    def record(self, record, data):
+        if record[1] not in self.open:
+            self.carried.append(data)
+        elif record[0] == 'close':
+            #The room is captured as closed; a room of the same name after this is a new one
+            self.open.discard(record[1])
+
+    '''Adds a room's state, or None if it closed first'''
+    def capture(self, name, state):
+        if name in self.open:
+            self.open.discard(name)
+            if state is not None:
+                self.captured[name] = state
+        self.remaining -= 1
+
+    '''True once every room is in'''
+    def complete(self):
+        return self.remaining <= 0
+
+    def states(self):
+        return [(name, self.captured[name]) for name in sorted(self.captured)]
+
+'''Applies one journal record to rooms'''
+def replay(rooms, record):
+    kind, name = record[0], record[1]
+    if kind == 'create':
+        rooms.createRoom(name, record[2])
+    elif kind == 'close':
+        room = rooms.getRoom(name)
+        if room is not None:
+            rooms.closeRoom(room)
+    elif kind == 'action':
+        room = rooms.getRoom(name)
+        if room is None:
+            #As with a rejected action, only a journal out of step with itself (or a bug) gets here
+            print "Journal action {0} is for room {1}, which doesn't exist on replay".format(record[2], name)
+            return
+        try:
+            room.game.apply(record[2])
+        except CoupError as e:
+            #Only a journal that doesn't match the rules (or a bug) gets here: say so rather than guess
+            print "Journal action {0} in room {1} was rejected on replay: {2}".format(record[2], name, e.message.strip())
@@ -0,0 +1,37 @@
+#Line framing for client input
+
+'''
+Collects the bytes a client sends and splits them into complete lines.
+A read may hold several commands, or only part of one; feed() returns every line
+completed so far and keeps the rest until the next read.
+Lines longer than maxLength are dropped rather than buffered without bound.
+'''
+class LineBuffer(object):
+    __slots__ = ('pending', 'maxLength', 'discarding')
+
+    def __init__(self, maxLength=4096):
+        self.pending = ""
+        self.maxLength = maxLength
+        #True while skipping the rest of an overlong line
+        self.discarding = False
+
+    '''Adds data to the buffer and returns the list of complete lines, without their line endings'''
+    def feed(self, data):
+        if "\n" not in data:
+            if not self.discarding:
+                self.pending += data
+                if len(self.pending) > self.maxLength:
+                    self.pending = ""
+                    self.discarding = True
+            return []
+
+        lines = (self.pending + data).split("\n")
+        self.pending = lines.pop()
+        if self.discarding:
+            #The first piece is the tail of the line we are skipping
+            lines.pop(0)
+            self.discarding = False
+        if len(self.pending) > self.maxLength:
+            self.pending = ""
+            self.discarding = True
+        return [line.rstrip("\r") for line in lines]
@@ -0,0 +1,378 @@
+#Load generator: a swarm of scripted clients playing COUP against a running server
+import errno, os, random, re, socket, sys, time
+from poller import Poller, WOULD_BLOCK
+from linebuffer import LineBuffer
+from eventloop import raiseFileLimit
+from messages import TEXT
+
+#Seconds without progress before a table is considered stuck and restarted
+STALL_TIMEOUT = 10.0
+#New connections opened per pass of the loop, so the server's accept backlog isn't flooded
+CONNECTS_PER_TICK = 200
+#Chance that a bot chats before moving, and that it challenges a TAX
+CHAT_RATE = 0.2
+CHALLENGE_RATE = 0.1
+
+#Broadcasts that announce a move, used to time command-to-broadcast latency
+MOVES = frozenset(['income', 'aid', 'tax', 'steal', 'coup', 'assassinate'])
+
+def templatePattern(template):
+    pattern = re.escape(template.rstrip("\n"))
+    return re.compile("^" + re.sub(r"\\\{(\d)\\\}", r"(?P<a\1>.+?)", pattern) + "$")
+
+#The server's own message templates, turned back into (kind, regex) pairs for parsing
+PATTERNS = [(kind, templatePattern(TEXT[kind])) for kind in sorted(TEXT)]
+PLAYER_LINE = re.compile(r"^(.+) \((\d+) Coins\)$")
+
+'''Returns (kind, arguments) for a line the server broadcasts, or None'''
+def parseLine(line):
+    if not line or line[0] in "_| \n":
+        return None
+    for kind, pattern in PATTERNS:
+        match = pattern.match(line)
+        if match is not None:
+            groups = match.groupdict()
+            return kind, [groups[key] for key in sorted(groups)]
+    match = PLAYER_LINE.match(line)
+    if match is not None:
+        return 'player', [match.group(1), match.group(2)]
+    return None
+
+'''Returns (resident set size in bytes, cpu seconds) of process pid, from /proc'''
+def processUsage(pid):
+    try:
+        with open("/proc/{}/status".format(pid)) as f:
+            rss = [int(line.split()[1]) * 1024 for line in f if line.startswith("VmRSS:")][0]
+        with open("/proc/{}/stat".format(pid)) as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        ticks = float(os.sysconf('SC_CLK_TCK'))
+        return rss, (int(fields[11]) + int(fields[12])) / ticks
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+'''
+One scripted client. Everything it reads goes to its Table, which decides what it says.
+'''
+class Bot(object):
+    __slots__ = ('swarm', 'table', 'name', 'sock', 'fd', 'lines', 'outbox', 'connected', 'connectStart', 'seen')
+
+    def __init__(self, swarm, table, name):
+        self.swarm = swarm
+        self.table = table
+        self.name = name
+        self.lines = LineBuffer()
+        self.outbox = ""
+        self.connected = False
+        self.seen = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.setblocking(0)
+        self.fd = self.sock.fileno()
+        self.connectStart = time.time()
+        error = self.sock.connect_ex(swarm.address)
+        if error not in (0, errno.EINPROGRESS) + WOULD_BLOCK:
+            raise socket.error(error, "connect failed")
+        swarm.add(self)
+
+    def send(self, line):
+        self.outbox += line + "\n"
+        if self.connected:
+            self.flush()
+
+    def flush(self):
+        while self.outbox:
+            try:
+                sent = self.sock.send(self.outbox)
+            except socket.error as e:
+                if e.args[0] in WOULD_BLOCK:
+                    break
+                return self.swarm.lost(self)
+            self.outbox = self.outbox[sent:]
+        self.swarm.wantWrite(self, bool(self.outbox))
+
+    def onWritable(self):
+        if not self.connected:
+            error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                return self.swarm.lost(self)
+            self.connected = True
+            self.swarm.onConnected(self)
+        self.flush()
+
+    def onReadable(self):
+        try:
+            data = self.sock.recv(65536)
+        except socket.error as e:
+            if e.args[0] in WOULD_BLOCK:
+                return
+            data = ""
+        if not data:
+            return self.swarm.lost(self)
+        for line in self.lines.feed(data):
+            self.table.receive(self, line)
+
+    def close(self):
+        self.swarm.remove(self)
+        self.sock.close()
+
+'''
+The bots sharing one room. bots[0] observes the game on everyone's behalf: it tracks coins,
+the treasury and who is still in, and tells whoever's turn it is what to do, so every move is legal.
+Each game is played in a fresh room; when it ends the bots disconnect and a new set connects.
+'''
+class Table(object):
+    def __init__(self, swarm, index, size):
+        self.swarm = swarm
+        self.index = index
+        self.size = size
+        self.round = 0
+        self.bots = []
+
+    def start(self):
+        self.round += 1
+        self.room = "load{0}-{1}".format(self.index, self.round)
+        self.joined = set()
+        self.started = False
+        self.finished = False
+        self.coins = {}
+        self.alive = set()
+        self.treasury = 50
+        self.actor = None
+        self.sentAt = 0.0
+        self.seq = 0
+        self.lastProgress = time.time()
+        self.bots = [Bot(self.swarm, self, "p{}".format(i)) for i in range(self.size)]
+        self.byName = dict((bot.name, bot) for bot in self.bots)
+
+    def onConnected(self, bot):
+        bot.send("/create " + self.room)
+        bot.send("/join " + self.room)
+        bot.send("/register " + bot.name)
+        bot.send("/ready")
+
+    def receive(self, bot, line):
+        parsed = parseLine(line)
+        if parsed is None:
+            return
+        kind, args = parsed
+
+        if kind in MOVES and args[0] == self.actor and bot.seen != self.seq:
+            bot.seen = self.seq
+            self.swarm.latencies.append(time.time() - self.sentAt)
+
+        if kind == 'joined':
+            self.joined.add(args[0])
+            if len(self.joined) == self.size and not self.started:
+                #The player list starts with whoever moves first
+                self.bots[0].send("/players")
+            return
+        if bot is not self.bots[0] or self.finished:
+            return
+        self.lastProgress = time.time()
+
+        if kind == 'player':
+            if not self.started:
+                self.started = True
+                self.coins = dict((name, 2) for name in self.byName)
+                self.alive = set(self.byName)
+                self.treasury = 50 - 2 * self.size
+                self.act(args[0])
+        elif kind == 'turn':
+            self.act(args[0])
+        elif kind in ('income', 'aid'):
+            self.gain(args[0], 1 if kind == 'income' else 2)
+        elif kind == 'unchallenged':
+            self.gain(args[0], int(args[1]))
+        elif kind == 'challengeFailed':
+            self.gain(args[0], int(args[3]))
+        elif kind == 'tax':
+            for name in self.alive:
+                if name != args[0]:
+                    voter = self.byName[name]
+                    voter.send("/challenge" if self.swarm.rng.random() < CHALLENGE_RATE else "/pass")
+        elif kind == 'steal':
+            self.coins[args[0]] += 2
+            self.coins[args[1]] -= 2
+        elif kind in ('coup', 'assassinate'):
+            self.gain(args[0], -7 if kind == 'coup' else -3)
+        elif kind == 'eliminated':
+            self.alive.discard(args[0])
+        elif kind == 'winner':
+            self.finish()
+
+    def gain(self, name, coins):
+        self.coins[name] += coins
+        self.treasury -= coins
+
+    '''Picks a legal move for name and has their bot send it'''
+    def act(self, name):
+        bot = self.byName.get(name)
+        if bot is None:
+            return
+        rng = self.swarm.rng
+        coins = self.coins[name]
+        targets = [other for other in self.alive if other != name]
+        if not targets:
+            return
+
+        if coins >= 10 or (coins >= 7 and rng.random() < 0.5):
+            command = "/coup " + rng.choice(targets)
+        else:
+            options = []
+            if self.treasury >= 1:
+                options.append("/income")
+            if self.treasury >= 3:
+                options.append("/tax")
+            options.extend("/steal " + target for target in targets if self.coins[target] >= 2)
+            if not options:
+                options.append("/endturn")
+            command = rng.choice(options)
+
+        if rng.random() < CHAT_RATE:
+            bot.send("/say good luck everyone")
+        self.seq += 1
+        self.actor = name
+        self.sentAt = time.time()
+        self.swarm.commands += 1
+        bot.send(command)
+
+    def finish(self):
+        self.finished = True
+        self.swarm.games += 1
+        self.restart()
+
+    def restart(self):
+        for bot in self.bots:
+            bot.close()
+        self.bots = []
+        if not self.swarm.stopping:
+            self.start()
+
+'''
+Runs every bot from one thread on a Poller and collects the numbers for the report
+'''
+class Swarm(object):
+    def __init__(self, address, clients, tableSize=4, pid=None, seed=None):
+        self.address = address
+        self.pid = pid
+        #Server (rss, cpu) usage before connecting, with every client connected, and at the end
+        self.usage = [None, None, None]
+        self.rng = random.Random(seed)
+        self.poller = Poller()
+        self.bots = {}
+        self.tables = [Table(self, i, tableSize) for i in range(max(1, clients // tableSize))]
+        self.stopping = False
+        self.latencies = []
+        self.connects = 0
+        self.connectTimes = []
+        self.lostCount = 0
+        self.stalls = 0
+        self.games = 0
+        self.commands = 0
+
+    def add(self, bot):
+        self.bots[bot.fd] = bot
+        self.poller.register(bot.fd, self.poller.READ | self.poller.WRITE)
+
+    def remove(self, bot):
+        if self.bots.get(bot.fd) is bot:
+            del self.bots[bot.fd]
+            self.poller.unregister(bot.fd)
+
+    def wantWrite(self, bot, write):
+        if self.bots.get(bot.fd) is bot:
+            self.poller.modify(bot.fd, self.poller.READ | (self.poller.WRITE if write else 0))
+
+    def onConnected(self, bot):
+        self.connects += 1
+        self.connectTimes.append(time.time() - bot.connectStart)
+        bot.table.onConnected(bot)
+
+    def lost(self, bot):
+        self.lostCount += 1
+        bot.table.restart()
+
+    '''Opens every table (ramping up the connections), then plays for the given number of seconds'''
+    def run(self, seconds):
+        start = time.time()
+        if self.pid:
+            self.usage[0] = processUsage(self.pid)
+        waiting = list(self.tables)
+        self.rampTime = None
+        lastCheck = start
+        while time.time() - start < seconds:
+            opened = 0
+            while waiting and opened < CONNECTS_PER_TICK:
+                table = waiting.pop()
+                table.start()
+                opened += table.size
+            if self.rampTime is None and not waiting and self.connects >= len(self.tables) * self.tables[0].size:
+                self.rampTime = time.time() - start
+                if self.pid:
+                    self.usage[1] = processUsage(self.pid)
+
+            for fd, mask in self.poller.poll(0 if waiting else 0.05):
+                bot = self.bots.get(fd)
+                if bot is None:
+                    continue
+                if mask & self.poller.WRITE:
+                    bot.onWritable()
+                if mask & (self.poller.READ | self.poller.ERROR) and self.bots.get(fd) is bot:
+                    bot.onReadable()
+
+            now = time.time()
+            if now - lastCheck >= 1.0:
+                lastCheck = now
+                for table in self.tables:
+                    if table.bots and now - table.lastProgress > STALL_TIMEOUT:
+                        self.stalls += 1
+                        table.restart()
+        self.stopping = True
+        if self.pid:
+            self.usage[2] = processUsage(self.pid)
+        for table in self.tables:
+            for bot in table.bots:
+                bot.close()
+        return time.time() - start
+
+'''Prints the results of a run, with the server's CPU and memory if its pid is known'''
+def report(swarm, elapsed, clients):
+    latencies = sorted(swarm.latencies)
+    print "Clients:            {0} in {1} tables".format(clients, len(swarm.tables))
+    if swarm.rampTime:
+        print "Connect rate:       {0:.0f} connections/s ({1:.2f} s to connect all clients)".format(
+            clients / swarm.rampTime, swarm.rampTime)
+    print "Connections made:   {0}, lost: {1}, stalled tables: {2}".format(swarm.connects, swarm.lostCount, swarm.stalls)
+    print "Games finished:     {0} ({1:.1f}/s)".format(swarm.games, swarm.games / elapsed)
+    print "Moves:              {0} ({1:.0f}/s)".format(swarm.commands, swarm.commands / elapsed)
+    print "Broadcast latency:  p50 {0:.2f} ms, p99 {1:.2f} ms, max {2:.2f} ms over {3} deliveries".format(
+        percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000,
+        (latencies[-1] if latencies else 0.0) * 1000, len(latencies))
+
+    before, connected, after = swarm.usage
+    if before and after:
+        cpu = after[1] - before[1]
+        print "Server CPU:         {0:.2f} s ({1:.0f}% of one core), {2:.2f} ms per client".format(
+            cpu, cpu / elapsed * 100, cpu / clients * 1000)
+    if before and connected:
+        print "Server RSS:         {0:.1f} MB with every client connected, {1:.1f} KB per client".format(
+            connected[0] / 1048576.0, (connected[0] - before[0]) / 1024.0 / clients)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4:
+        print "Usage: python loadtest.py [host] [port] [clients] [seconds] [table size] [server pid]"
+        sys.exit(2)
+    HOST, PORT, CLIENTS = sys.argv[1], int(sys.argv[2]), int(sys.argv[3])
+    SECONDS = float(sys.argv[4]) if len(sys.argv) > 4 else 30.0
+    TABLE_SIZE = int(sys.argv[5]) if len(sys.argv) > 5 else 4
+    PID = int(sys.argv[6]) if len(sys.argv) > 6 else None
+
+    raiseFileLimit()
+    swarm = Swarm((socket.gethostbyname(HOST), PORT), CLIENTS, TABLE_SIZE, PID)
+    elapsed = swarm.run(SECONDS)
+    report(swarm, elapsed, len(swarm.tables) * TABLE_SIZE)
@@ -0,0 +1,64 @@
+#Turns engine events, and the chat events the server adds, into the text sent to telnet clients
+from engine import PRIVATE_EVENTS
+
+#Events with nothing to show; the server acts on them instead
+SILENT_EVENTS = frozenset(['voteOpened', 'voteClosed'])
+
+TEXT = {
+    'joined': "{0} joined the game!\n",
+    'left': "{0} left the game.\n",
+    'turn': "It is now {0}'s turn to move.\n",
+    'income': "{0} called INCOME.\n",
+    'aid': "{0} receieved FOREIGN AID.\n",
+    'tax': "{0} called TAX, the Duke ability, and will get {1} coins. Other players type \"/challenge\" or \"/pass\" to continue.\n",
+    'unchallenged': "No challengers, {0} has gained {1} coins.\n",
+    'challengeFailed': "Challenge failed! {0} reveals a {1} from his hand, exchanges it with the deck, and still gains {3} coins. {2} loses a card.\n",
+    'challengeSucceeded': "Challenge succeeded! {0} loses a card.\n",
+    'cardLost': "{0}'s {1} was just killed!\n",
+    'eliminated': "{0} is out of the game!\n",
+    'winner': "{0} has won the game!\n",
+    'steal': "{0} is claiming CAPTAIN, stealing from {1}.\n",
+    'exchange': "{0} is claiming AMBASSADOR, exchanging cards with the deck.\n",
+    'exchangeDealt': "{0} has been dealt two cards to exchange.\n",
+    'exchangePrompt': "Select cards to remove (1 to {1}, where 1 is the top card)" \
+                      "from least to greatest without a space. Ex. /remove 23\n",
+    'exchangeDone': "{0} has returned 2 cards to the deck.\n",
+    'assassinate': "{0} will ASSASSINATE {1}.\n",
+    'coup': "{0} called a COUP on {1}.\n",
+    'endturn': "{0} ended his turn.\n",
+}
+
+def renderReady(state, event):
+    if event[2]:
+        return "{} is READY!\n".format(event[1])
+    return "{} is NOT READY!\n".format(event[1])
+
+def renderChat(state, event):
+    return "{0}: {1}\n".format(event[1] or "Anonymous", event[2])
+
+def renderHand(state, event):
+    player = state.players.getPlayerByName(event[1])
+    if player is None:
+        return None
+    return player.getHand(True)
+
+#Events whose text depends on more than the event itself
+RENDERERS = {
+    'ready': renderReady,
+    'hand': renderHand,
+    'chat': renderChat,
+}
+
+'''Returns the text for event, or None if it has nothing to show'''
+def render(state, event):
+    kind = event[0]
+    if kind in SILENT_EVENTS:
+        return None
+    renderer = RENDERERS.get(kind)
+    if renderer is not None:
+        return renderer(state, event)
+    return TEXT[kind].format(*event[1:])
+
+'''Returns true if event should only be sent to the player it is about'''
+def isPrivate(event):
+    return event[0] in PRIVATE_EVENTS
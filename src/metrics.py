@@ -0,0 +1,132 @@
+#In-process metrics, served as plain text (Prometheus exposition format) on their own port
+import BaseHTTPServer, SocketServer, bisect, threading
+
+#Latency buckets in seconds, from 50 microseconds to 1 second
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+def formatLabels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(key, str(value).replace('"', '\\"')) for key, value in labels) + "}"
+
+'''
+A count of events. Updated without a lock: under load, an increment lost to a thread race is
+an acceptable price for keeping collection cheap.
+'''
+class Counter(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def add(self, amount=1):
+        self.value += amount
+
+    def samples(self, name):
+        return [(name, (), self.value)]
+
+'''
+Counts observations in fixed buckets, with their sum, so percentiles can be estimated by the collector
+'''
+class Histogram(object):
+    __slots__ = ('bounds', 'counts', 'total', 'count')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def samples(self, name, labels=()):
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            samples.append((name + "_bucket", labels + (("le", repr(bound)),), cumulative))
+        samples.append((name + "_bucket", labels + (("le", "+Inf"),), self.count))
+        samples.append((name + "_sum", labels, self.total))
+        samples.append((name + "_count", labels, self.count))
+        return samples
+
+'''
+A value read when the metrics are collected, so keeping it costs nothing in between
+'''
+class Gauge(object):
+    __slots__ = ('func',)
+
+    def __init__(self, func):
+        self.func = func
+
+    def samples(self, name):
+        return [(name, (), self.func())]
+
+'''
+Named metrics for one server. Collectors are functions returning (name, type, help, samples)
+tuples for metrics that are easier to build at collection time, such as per-command statistics.
+'''
+class MetricsRegistry(object):
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def add(self, name, kind, help, metric):
+        self.metrics.append((name, kind, help, metric))
+        return metric
+
+    def counter(self, name, help):
+        return self.add(name, "counter", help, Counter())
+
+    def histogram(self, name, help, bounds=LATENCY_BUCKETS):
+        return self.add(name, "histogram", help, Histogram(bounds))
+
+    def gauge(self, name, help, func):
+        return self.add(name, "gauge", help, Gauge(func))
+
+    def addCollector(self, func):
+        self.collectors.append(func)
+
+    '''Returns every metric in the Prometheus text format'''
+    def render(self):
+        families = [(name, kind, help, metric.samples(name)) for name, kind, help, metric in self.metrics]
+        for collector in self.collectors:
+            families.extend(collector())
+        lines = []
+        for name, kind, help, samples in families:
+            lines.append("# HELP {0} {1}\n# TYPE {0} {2}\n".format(name, help, kind))
+            for sampleName, labels, value in samples:
+                lines.append("{0}{1} {2}\n".format(sampleName, formatLabels(labels), value))
+        return "".join(lines)
+
+class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.server.registry.render()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+'''
+Serves the registry over HTTP from a background thread: "curl http://localhost:[port]/metrics"
+'''
+class MetricsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, registry):
+        BaseHTTPServer.HTTPServer.__init__(self, address, MetricsRequestHandler)
+        self.registry = registry
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
@@ -0,0 +1,77 @@
+#Card odds for players and bots, worked out exactly from the cards an observer cannot see
+from deck import ROLES, FULL_DECK, isAlive, roleOf
+
+#Number of copies of each role in a full deck, in ROLES order
+COMPOSITION = tuple(FULL_DECK.count(chr(role)) for role in range(len(ROLES)))
+#Cards an exchange draws from the deck
+EXCHANGE_DRAW = 2
+
+'''
+Counts the cards of each role that observer cannot see: the deck plus the other players' living cards.
+Dead cards are face up, so they are known to everyone. observer may be None for a spectator.
+'''
+def unseenCounts(state, observer):
+    counts = list(COMPOSITION)
+    for player in state.players.listPlayers():
+        for card in player.cards:
+            if not isAlive(card) or player is observer:
+                counts[roleOf(card)] -= 1
+    return counts
+
+'''
+The chance that picks cards taken at random from the unseen cards include at least one card of role.
+unseen is the per-role counts (ROLES order) and role a role code (index into ROLES).
+'''
+def exactChance(unseen, picks, role):
+    total = sum(unseen)
+    others = total - unseen[role]
+    picks = min(picks, total)
+    #Chance that every card taken is some other role
+    miss = 1.0
+    for i in range(picks):
+        miss *= float(others - i) / (total - i)
+        if miss <= 0:
+            return 1.0
+    return 1.0 - miss
+
+'''
+exactChance for every scenario in a batch, such as a bot weighing many hypothetical decks at once.
+unseen - one row of per-role counts (ROLES order) per scenario
+picks - the number of cards taken in each scenario (an int, or one per scenario)
+role - the role code looked for (an int, or one per scenario)
+The answer only depends on how many cards are unseen, how many of them are role and how many are taken,
+so each distinct combination is worked out once however many scenarios share it. Returns a list of probabilities.
+'''
+def chanceOfRole(unseen, picks, role):
+    scenarios = len(unseen)
+    if isinstance(picks, int):
+        picks = [picks] * scenarios
+    if isinstance(role, int):
+        role = [role] * scenarios
+    known = {}
+    result = []
+    for counts, taken, wanted in zip(unseen, picks, role):
+        key = (sum(counts), counts[wanted], taken)
+        chance = known.get(key)
+        if chance is None:
+            chance = known[key] = exactChance(counts, taken, wanted)
+        result.append(chance)
+    return result
+
+'''Chance, as seen by observer, that the deck still holds a card of the named role'''
+def deckOdds(state, observer, roleName):
+    return scenarioOdds(state, observer, len(state.deck.cards), roleName)
+
+'''Chance, as seen by observer, that an exchange draws a card of the named role'''
+def exchangeOdds(state, observer, roleName):
+    return scenarioOdds(state, observer, min(EXCHANGE_DRAW, len(state.deck.cards)), roleName)
+
+'''Chance, as seen by observer, that target really holds the role they claim. Useful before a challenge'''
+def claimOdds(state, observer, target, roleName):
+    if target is observer:
+        return 1.0 if target.checkForCard(roleName) >= 0 else 0.0
+    hidden = sum(1 for card in target.cards if isAlive(card))
+    return scenarioOdds(state, observer, hidden, roleName)
+
+def scenarioOdds(state, observer, picks, roleName):
+    return exactChance(unseenCounts(state, observer), picks, ROLES.index(roleName))
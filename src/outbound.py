@@ -0,0 +1,212 @@
+#Bounded, non-blocking output buffers for client connections
+import fcntl, os, socket, threading
+from collections import deque
+from poller import Poller, WOULD_BLOCK
+
+#What to do when a client's outbound buffer is full
+DROP = "drop"               #discard the new message
+DISCONNECT = "disconnect"   #close the client's connection
+COALESCE = "coalesce"       #merge the buffer, keeping only the newest output that fits
+POLICIES = (DROP, DISCONNECT, COALESCE)
+
+DEFAULT_LIMIT = 256 * 1024
+DEFAULT_POLICY = DISCONNECT
+
+#Lets a send on a blocking socket return instead of waiting, where the platform supports it
+MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
+
+'''
+Output waiting to be written to one client, capped at limit bytes.
+push() applies the overflow policy and returns False if the client should be disconnected.
+'''
+class OutboundQueue(object):
+    __slots__ = ('chunks', 'size', 'limit', 'policy', 'dropped')
+
+    def __init__(self, limit=DEFAULT_LIMIT, policy=DEFAULT_POLICY):
+        if policy not in POLICIES:
+            raise ValueError("Unknown overflow policy {}".format(policy))
+        self.chunks = deque()
+        self.size = 0
+        self.limit = limit
+        self.policy = policy
+        #Bytes thrown away by the drop and coalesce policies
+        self.dropped = 0
+
+    def __len__(self):
+        return self.size
+
+    def push(self, data):
+        if self.size + len(data) <= self.limit:
+            self.chunks.append(data)
+            self.size += len(data)
+            return True
+
+        if self.policy == DROP:
+            self.dropped += len(data)
+            return True
+
+        if self.policy == COALESCE:
+            joined = "".join(self.chunks) + data
+            kept = joined[-self.limit:]
+            if len(kept) < len(joined):
+                #Start on a whole line so the client doesn't see half a message
+                newline = kept.find("\n")
+                if newline >= 0:
+                    kept = kept[newline + 1:]
+            self.dropped += len(joined) - len(kept)
+            self.chunks = deque([kept])
+            self.size = len(kept)
+            return True
+
+        return False
+
+    '''Returns the next chunk to write'''
+    def peek(self):
+        return self.chunks[0]
+
+    '''Removes count bytes that have been written from the front of the queue'''
+    def consume(self, count):
+        first = self.chunks[0]
+        if count >= len(first):
+            self.chunks.popleft()
+        else:
+            self.chunks[0] = first[count:]
+        self.size -= count
+
+'''
+Wraps a blocking client socket of the threaded server so that sendall never blocks the calling thread.
+Whatever the kernel won't take immediately is queued and written by the SendPump.
+'''
+class BufferedSocket(object):
+    #Speaks the telnet text protocol (see protocol.StructuredConnection)
+    structured = False
+
+    def __init__(self, pump, sock):
+        self.pump = pump
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.lock = threading.Lock()
+        self.outbox = None
+        self.closed = False
+
+    def fileno(self):
+        return self.fd
+
+    def recv(self, size):
+        return self.sock.recv(size)
+
+    def sendall(self, data):
+        overflow = False
+        with self.lock:
+            if self.closed:
+                return
+            if self.outbox is None:
+                sent = self.send(data)
+                if sent is None or sent == len(data):
+                    return
+                data = data[sent:]
+                self.outbox = OutboundQueue(self.pump.limit, self.pump.policy)
+                self.pump.schedule(self)
+            overflow = not self.outbox.push(data)
+        if overflow:
+            self.close()
+
+    '''Sends without blocking. Returns the byte count, or None if the socket has failed'''
+    def send(self, data):
+        try:
+            return self.sock.send(data, MSG_DONTWAIT)
+        except socket.error as e:
+            if e.args[0] in WOULD_BLOCK:
+                return 0
+            self.outbox = None
+            return None
+
+    '''Writes queued output. Called from the pump thread; returns True while output is still pending'''
+    def flush(self):
+        with self.lock:
+            while self.outbox:
+                sent = self.send(self.outbox.peek())
+                if not sent:
+                    return self.outbox is not None
+                self.outbox.consume(sent)
+            self.outbox = None
+            return False
+
+    '''Closes the socket; a handler thread blocked in recv() wakes up and cleans up after the client'''
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.outbox = None
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+        self.pump.schedule(self)
+
+'''
+Drains the queued output of every BufferedSocket from a single background thread.
+Other threads hand sockets over with schedule(); only the pump thread touches its poller.
+'''
+class SendPump(object):
+    def __init__(self, limit=DEFAULT_LIMIT, policy=DEFAULT_POLICY):
+        if policy not in POLICIES:
+            raise ValueError("Unknown overflow policy {}".format(policy))
+        self.limit = limit
+        self.policy = policy
+        self.lock = threading.Lock()
+        self.incoming = []
+        #fd -> BufferedSocket with pending output, owned by the pump thread
+        self.waiting = {}
+        self.poller = Poller()
+        self.wakeRead, self.wakeWrite = os.pipe()
+        fcntl.fcntl(self.wakeWrite, fcntl.F_SETFL, fcntl.fcntl(self.wakeWrite, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.poller.register(self.wakeRead, self.poller.READ)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def wrap(self, sock):
+        return BufferedSocket(self, sock)
+
+    def schedule(self, bsock):
+        with self.lock:
+            self.incoming.append(bsock)
+        try:
+            os.write(self.wakeWrite, "x")
+        except OSError as e:
+            if e.errno not in WOULD_BLOCK:
+                raise
+
+    def run(self):
+        while True:
+            for fd, mask in self.poller.poll(None):
+                if fd == self.wakeRead:
+                    os.read(self.wakeRead, 4096)
+                    self.addIncoming()
+                    continue
+                bsock = self.waiting.get(fd)
+                if bsock is not None and not bsock.flush():
+                    self.forget(bsock)
+
+    def addIncoming(self):
+        with self.lock:
+            items, self.incoming = self.incoming, []
+        for bsock in items:
+            current = self.waiting.get(bsock.fd)
+            if bsock.closed:
+                if current is bsock:
+                    self.forget(bsock)
+                continue
+            if current is bsock:
+                continue
+            if current is not None:
+                self.forget(current)
+            self.waiting[bsock.fd] = bsock
+            self.poller.register(bsock.fd, self.poller.WRITE)
+
+    def forget(self, bsock):
+        del self.waiting[bsock.fd]
+        self.poller.unregister(bsock.fd)
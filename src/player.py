@@ -1,12 +1,19 @@
+import random
 from collections import deque
+from deck import DEAD, isAlive, renderCard, roleCode
 
+'''A player at the table. cards is a bytearray of card codes (see deck.py)'''
 class Player(object):
+    __slots__ = ('name', 'coins', 'cards', 'ready', 'conn', 'hands')
+
     def __init__(self, conn, name, card1, card2):
         self.name = name
         self.coins = 2
-        self.cards = [card1, card2]
+        self.cards = bytearray((card1, card2))
         self.ready = False
         self.conn = conn
+        #Last rendered hand for each value of reveal, as (cards it was built from, text)
+        self.hands = [None, None]
 
     '''Sets the player as "READY or "NOT READY" so that the game can begin'''
     def toggleReady(self):
@@ -16,87 +23,105 @@ class Player(object):
         else:
             return "{} is NOT READY!\n".format(self.name)
 
-    '''Calls renderCard on each string and returns the result'''
+    '''Joins the art of each card. The result is reused until the hand changes'''
     def getHand(self, reveal):
-        hand = "\n{0}'s hand:\n".format(self.name)
-        for card in self.cards:
-            hand += card.renderCard(reveal)
+        cards = str(self.cards)
+        cached = self.hands[reveal]
+        if cached is not None and cached[0] == cards:
+            return cached[1]
+        hand = "\n{0}'s hand:\n".format(self.name) + "".join([renderCard(card, reveal) for card in self.cards])
+        self.hands[reveal] = (cards, hand)
         return hand
 
+    '''Returns the index of a living card of type cardName in the hand, or -1'''
     def checkForCard(self, cardName):
-        i = 0
+        #A living card's code is just its role code
+        return self.cards.find(chr(roleCode(cardName)))
+
+    '''Returns true while the player has a living card'''
+    def isAlive(self):
         for card in self.cards:
-            if card == cardName:
-                return i
-            i = i + 1
-        return -1
+            if isAlive(card):
+                return True
+        return False
 
-    def killCardInHand(self):
+    '''Kills one of the player's living cards and returns its code, or None if there are none left'''
+    def killCardInHand(self, rng=random):
         alivecards = []
-        for card in self.cards:
-            if card.alive:
-                alivecards.append(card)
+        for i, card in enumerate(self.cards):
+            if isAlive(card):
+                alivecards.append(i)
         if alivecards == []:
-            return "{} has no living cards!\n".format(self.name)
+            return None
         #TODO: Choice is not random, player chooses
-        choice = random.choice(alivecards)
-        choice.kill()
-        return "{0}'s {1} was just killed!\n".format(self.name, choice.type)
+        choice = rng.choice(alivecards)
+        self.cards[choice] |= DEAD
+        return self.cards[choice]
 
 #A data structure containing a list of player objects
 #Used to keep track of players and turns
+#Players are also indexed by connection and by name so lookups don't scan the queue
 class PlayerQueue():
-    def __init__(self):
+    def __init__(self, maxPlayers=6):
         #Initialize a queue structure that contains players
-        self.players = deque([],maxlen=6)
+        self.players = deque([],maxlen=maxPlayers)
+        self.byConn = {}
+        self.byName = {}
         self.ongoingVotes = {}
 
     def getVote(self, name):
-        if name in self.ongoingVotes.keys():
-            return self.ongoingVotes[name]
-        return None
+        return self.ongoingVotes.get(name)
 
     '''Add a player to the turn queue'''
     def addPlayer(self, player):
+        if self.isFull():
+            #The deque drops its leftmost player to make room, so drop it from the indexes too
+            self.unindex(self.players[0])
         self.players.append(player)
+        if player.conn is not None:
+            self.byConn[player.conn] = player
+        self.byName[player.name] = player
         return "{} joined the game!\n".format(player.name)
 
 
     '''Remove a player from the turn queue'''
     def removePlayer(self, player):
         self.players.remove(player)
+        self.unindex(player)
+
+    '''Associates a connection with a player who joined without one'''
+    def bindConnection(self, player, conn):
+        player.conn = conn
+        self.byConn[conn] = player
+
+    def unindex(self, player):
+        if self.byConn.get(player.conn) is player:
+            del self.byConn[player.conn]
+        if self.byName.get(player.name) is player:
+            del self.byName[player.name]
 
     '''Returns true if the client has registered, false otherwise'''
     def isClientRegistered(self, conn):
-        for player in self.players:
-            if conn == player.conn:
-                return True
-        return False
+        return conn in self.byConn
 
     '''Returns the player at the front of the turn queue. This player will move next'''
     def getCurrentPlayer(self):
-        if self.numPlayers > 0:
-            return list(self.players)[0]
+        if self.players:
+            return self.players[0]
         else:
             return None
 
     '''Returns true if it is player's turn to move. False otherwise.'''
     def isPlayersTurn(self, player):
-        return player == self.getCurrentPlayer()
+        return player is not None and player is self.getCurrentPlayer()
 
     '''Returns the player with the matching connection identifier'''
     def getPlayer(self, conn):
-        for player in self.players:
-            if conn == player.conn:
-                return player
-        return None
+        return self.byConn.get(conn)
 
     '''Returns the player with the matching name'''
     def getPlayerByName(self, name):
-        for player in self.players:
-            if name == player.name:
-                return player
-        return None
+        return self.byName.get(name)
 
     '''Returns the queue in list form for easy iteration'''
     def listPlayers(self):
@@ -111,4 +136,7 @@ class PlayerQueue():
     '''Gets the current number of players in the turn queue'''
     def numPlayers(self):
         return len(self.players)
-        
+
+    '''Returns true if no more players can join'''
+    def isFull(self):
+        return len(self.players) == self.players.maxlen
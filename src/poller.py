@@ -0,0 +1,49 @@
+#Readiness polling shared by the event loop and the send pump
+import errno, select
+
+#Errors that only mean "try again later" on a non-blocking socket
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+'''
+A thin wrapper around epoll (or poll where epoll is missing).
+Unlike select(), neither has an FD_SETSIZE cap on the number of sockets we can watch.
+'''
+class Poller(object):
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self.impl = select.epoll()
+            self.READ = select.EPOLLIN | select.EPOLLPRI
+            self.WRITE = select.EPOLLOUT
+            self.ERROR = select.EPOLLERR | select.EPOLLHUP
+            self.scale = 1.0
+        else:
+            self.impl = select.poll()
+            self.READ = select.POLLIN | select.POLLPRI
+            self.WRITE = select.POLLOUT
+            self.ERROR = select.POLLERR | select.POLLHUP | select.POLLNVAL
+            self.scale = 1000.0
+
+    def register(self, fd, mask):
+        self.impl.register(fd, mask)
+
+    def modify(self, fd, mask):
+        self.impl.modify(fd, mask)
+
+    def unregister(self, fd):
+        try:
+            self.impl.unregister(fd)
+        except (KeyError, IOError, OSError, ValueError):
+            pass
+
+    '''Waits up to timeout seconds (forever if None) and returns a list of (fd, mask) pairs'''
+    def poll(self, timeout):
+        if timeout is None:
+            timeout = -1
+        else:
+            timeout = timeout * self.scale
+        try:
+            return self.impl.poll(timeout)
+        except (IOError, OSError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
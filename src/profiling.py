@@ -0,0 +1,121 @@
+#Profiling a live server for a set time, switched on by an admin command or a signal
+import collections, cProfile, os, re, signal, sys, threading, time
+
+#Where profiles are written, and how long a profile started by a signal runs
+PROFILE_DIR = os.environ.get("COUP_PROFILE_DIR", ".")
+SIGNAL_SECONDS = 30
+MAX_SECONDS = 600
+#Seconds between samples of every thread's stack
+SAMPLE_INTERVAL = 0.005
+
+def profilePath(scope, extension):
+    #Room names come from clients, so anything that could leave PROFILE_DIR is replaced
+    scope = re.sub(r"[^A-Za-z0-9_-]", "_", scope)
+    name = "coup-{0}-{1}-{2}.{3}".format(scope, os.getpid(), time.strftime("%Y%m%d-%H%M%S"), extension)
+    return os.path.join(PROFILE_DIR, name)
+
+'''True if profiles can be written to PROFILE_DIR'''
+def canWrite():
+    return os.path.isdir(PROFILE_DIR) and os.access(PROFILE_DIR, os.W_OK | os.X_OK)
+
+'''Calls report(message) if there is someone to tell, and prints message either way'''
+def announce(report, message):
+    print message.rstrip("\n")
+    if report is not None:
+        try:
+            report(message)
+        except Exception:
+            pass
+
+'''
+Runs cProfile over the commands and timers of one room. The room's game holds it in game.profiler
+only while it runs, so rooms that aren't being profiled pay for nothing but that attribute check.
+A profile can only follow one thread at a time, so calls made while it runs are serialized by a lock.
+The result is a pstats file: "python -m pstats [file]". report(message) is told where it went, or why it failed, from the profiler's own thread.
+'''
+class RoomProfiler(object):
+    def __init__(self, room, seconds, report=None):
+        self.room = room
+        self.seconds = seconds
+        self.report = report
+        self.path = profilePath("room-" + room.name, "prof")
+        self.profile = cProfile.Profile()
+        self.lock = threading.Lock()
+
+    def start(self, scheduler):
+        self.room.game.profiler = self
+        scheduler.schedule(self.seconds, self.finish)
+
+    '''Calls func(*args) under the profiler'''
+    def run(self, func, *args):
+        with self.lock:
+            return self.profile.runcall(func, *args)
+
+    def finish(self):
+        with self.lock:
+            self.room.game.profiler = None
+            try:
+                self.profile.dump_stats(self.path)
+            except (IOError, OSError) as e:
+                return announce(self.report, "Profile of room {0} could not be written: {1}\n".format(self.room.name, e))
+        announce(self.report, "Profile of room {0} written to {1}\n".format(self.room.name, self.path))
+
+'''
+Samples the stack of every thread in the process from a background thread: handler threads,
+the event loop, the timer and journal threads alike. Nothing runs while it is off.
+The result has one line per distinct stack, "outermost;...;innermost count", the input
+format of flame graph tools. report(message) is told where it went, or why it failed, from the profiler's own thread.
+'''
+class Sampler(object):
+    def __init__(self, seconds, interval=SAMPLE_INTERVAL, report=None):
+        self.seconds = seconds
+        self.report = report
+        self.interval = interval
+        self.path = profilePath("process", "txt")
+        self.stacks = collections.Counter()
+        self.samples = 0
+
+    def start(self):
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def run(self):
+        me = threading.current_thread().ident
+        names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+        deadline = time.time() + self.seconds
+        while time.time() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident != me:
+                    self.stacks[self.collapse(names.get(ident, "thread"), frame)] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+            if self.samples % 200 == 0:
+                names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+        self.write()
+
+    def collapse(self, threadName, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append("{0} ({1}:{2})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        stack.append(threadName)
+        stack.reverse()
+        return ";".join(stack)
+
+    def write(self):
+        try:
+            with open(self.path, 'w') as f:
+                for stack, count in self.stacks.most_common():
+                    f.write("{0} {1}\n".format(stack, count))
+        except (IOError, OSError) as e:
+            return announce(self.report, "Process profile could not be written: {}\n".format(e))
+        announce(self.report, "Process profile ({0} samples) written to {1}\n".format(self.samples, self.path))
+
+'''Profiles every thread for SIGNAL_SECONDS when the process gets signal, e.g. "kill -USR1 [pid]"'''
+def installSignal(signum):
+    def handler(signum, frame):
+        Sampler(SIGNAL_SECONDS).start()
+    signal.signal(signum, handler)
@@ -0,0 +1,116 @@
+#The JSON-lines protocol for bots, offered alongside the telnet text
+import json
+from deck import isAlive, roleName
+
+VERSION = 1
+
+#The gateway sends a worker this line, and waits for SYNC followed by the client's room, protocol ("json" or "text")
+#and "admin" or "player", separated by spaces, to learn that everything sent before it has been answered.
+#Clients can't type the NUL, and the gateway drops it from them
+SYNC = "\x00sync"
+
+#The names of each event's fields, in the order they follow the event kind in the engine's tuples
+FIELDS = {
+    'joined': ('player',),
+    'left': ('player',),
+    'ready': ('player', 'ready'),
+    'turn': ('player',),
+    'income': ('player', 'coins'),
+    'aid': ('player', 'coins'),
+    'tax': ('player', 'coins'),
+    'voteOpened': ('vote', 'claimant', 'timeout'),
+    'voteClosed': ('vote',),
+    'unchallenged': ('player', 'coins'),
+    'challengeFailed': ('player', 'role', 'challenger', 'coins'),
+    'challengeSucceeded': ('player',),
+    'cardLost': ('player', 'role'),
+    'eliminated': ('player',),
+    'winner': ('player',),
+    'steal': ('player', 'target', 'coins'),
+    'exchange': ('player',),
+    'hand': ('player',),
+    'exchangeDealt': ('player',),
+    'exchangePrompt': ('player', 'cards'),
+    'exchangeDone': ('player',),
+    'assassinate': ('player', 'target'),
+    'coup': ('player', 'target'),
+    'endturn': ('player',),
+    'chat': ('player', 'text'),
+}
+
+def encode(obj):
+    return json.dumps(obj, separators=(',', ':')) + "\n"
+
+'''Returns a player's cards as dicts. Living cards of other players are hidden unless reveal is set'''
+def describeCards(player, reveal):
+    cards = []
+    for card in player.cards:
+        alive = isAlive(card)
+        cards.append({"role": roleName(card) if reveal or not alive else None, "alive": alive})
+    return cards
+
+'''Returns the line for an event, with its fields named'''
+def encodeEvent(state, event):
+    message = dict(zip(FIELDS[event[0]], event[1:]))
+    message["event"] = event[0]
+    if event[0] == 'hand':
+        player = state.players.getPlayerByName(event[1])
+        if player is not None:
+            message["cards"] = describeCards(player, True)
+    return encode(message)
+
+'''Returns the line for text that has no event behind it, such as a server notice'''
+def encodeText(text):
+    return encode({"event": "message", "text": text})
+
+'''
+Stands in for the connection of a client that has switched to the JSON protocol.
+Events are sent to it as lines by sendLine(). Anything sent with sendall() while a request
+is running is collected as that request's reply; at other times it is sent as a "message" event.
+'''
+class StructuredConnection(object):
+    structured = True
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.replyText = None
+        self.replyData = None
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    @property
+    def outbox(self):
+        return self.conn.outbox
+
+    def sendall(self, text):
+        if self.replyText is not None:
+            self.replyText.append(text)
+        else:
+            self.conn.sendall(encodeText(text))
+
+    def sendLine(self, line):
+        self.conn.sendall(line)
+
+    def close(self):
+        self.conn.close()
+
+    '''Starts collecting the reply to a request'''
+    def beginReply(self):
+        self.replyText = []
+        self.replyData = {}
+
+    '''Adds typed fields to the reply to the current request'''
+    def addReply(self, fields):
+        self.replyData.update(fields)
+
+    '''Stops collecting and returns the reply to the request with the given id'''
+    def endReply(self, id, ok):
+        reply = self.replyData
+        reply["id"] = id
+        reply["ok"] = ok
+        text = "".join(self.replyText)
+        if text:
+            reply["error" if not ok else "text"] = text
+        self.replyText = self.replyData = None
+        return reply
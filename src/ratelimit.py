@@ -0,0 +1,106 @@
+#Token bucket rate limits for each connection and each room, checked before a command runs
+import collections
+
+#Budgets: every command spends from one, and error replies from their own
+CHAT = "chat"
+GAME = "game"
+COMMAND = "command"
+ERRORS = "errors"
+
+#budget -> (tokens added per second, bucket size). Rooms only limit what is broadcast to every member;
+#a budget missing from a scope isn't limited there
+CONNECTION_BUDGETS = {CHAT: (1.0, 5), GAME: (20.0, 40), COMMAND: (10.0, 20), ERRORS: (2.0, 5)}
+ROOM_BUDGETS = {CHAT: (10.0, 30), GAME: (100.0, 200)}
+
+#Chat is cut to this many characters before it is broadcast, so one short command can't become a flood of output
+MAX_CHAT = 256
+
+#Lines a client may have waiting to run: queued for its room's worker (threaded server), or read in one
+#chunk (event loop). Any more are dropped as they are read, so a flood is shed before it can pile up
+MAX_QUEUED_LINES = 64
+#The budget lines dropped that way are counted under
+QUEUE = "queue"
+
+#(scope, budget) -> number of commands or error replies dropped. Updated without a lock, like metrics.Counter
+SHED = collections.Counter()
+
+'''Allows rate events per second on average, and bursts of up to burst'''
+class TokenBucket(object):
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    '''Adds the tokens earned since the last call. Returns True if there is one to spend'''
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return self.tokens >= 1
+
+    '''Spends a token if there is one. Returns False if the bucket is empty'''
+    def take(self, now):
+        if not self.refill(now):
+            return False
+        self.tokens -= 1
+        return True
+
+'''
+The buckets of one connection or room. A bucket is only made once its budget is first used,
+so idle connections carry nothing but this object.
+'''
+class Limits(object):
+    __slots__ = ('scope', 'budgets', 'buckets')
+
+    def __init__(self, scope, budgets):
+        self.scope = scope
+        self.budgets = budgets
+        self.buckets = {}
+
+    '''Returns the bucket for budget, or None if this scope doesn't limit it'''
+    def bucket(self, budget, now):
+        bucket = self.buckets.get(budget)
+        if bucket is None:
+            if budget not in self.budgets:
+                return None
+            rate, burst = self.budgets[budget]
+            bucket = self.buckets[budget] = TokenBucket(rate, burst, now)
+        return bucket
+
+    '''Spends from budget, or counts the request as shed and returns False'''
+    def allow(self, budget, now):
+        bucket = self.bucket(budget, now)
+        if bucket is None or bucket.take(now):
+            return True
+        SHED[(self.scope, budget)] += 1
+        return False
+
+'''Limits that allow everything, for benchmarks and trusted connections'''
+class Unlimited(object):
+    def bucket(self, budget, now):
+        return None
+
+    def allow(self, budget, now):
+        return True
+
+'''
+Spends a token from budget in each of the given Limits if all of them have one, and from none of them otherwise,
+so a command refused by one scope doesn't use up another's budget. The scope that refused counts it as shed
+'''
+def allowAll(budget, now, *scopes):
+    buckets = []
+    for limits in scopes:
+        bucket = limits.bucket(budget, now)
+        if bucket is None:
+            continue
+        if not bucket.refill(now):
+            SHED[(limits.scope, budget)] += 1
+            return False
+        buckets.append(bucket)
+    for bucket in buckets:
+        bucket.tokens -= 1
+    return True
+
+UNLIMITED = Unlimited()
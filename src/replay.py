@@ -0,0 +1,140 @@
+#Replays recorded games through the rules engine with no sockets or timers, to catch rule changes and time the engine
+import marshal, random, sys, time
+import engine
+from error import CoupError
+from journal import Journal, frame, unframe
+
+#Cap on the length of a generated game, in case the bots never finish
+MAX_ACTIONS = 2000
+
+'''
+A corpus is a file of framed records (see journal.py), one per game:
+(name, initial state, actions, final state), with both states as returned by GameState.snapshot()
+'''
+def loadCorpus(path):
+    with open(path, 'rb') as f:
+        return unframe(f.read())
+
+def saveCorpus(path, games):
+    with open(path, 'wb') as f:
+        for game in games:
+            f.write(frame(marshal.dumps(game)))
+
+'''Builds the GameState described by a snapshot'''
+def restoreState(snapshot):
+    state = engine.GameState(snapshot[0])
+    state.restore(snapshot)
+    return state
+
+'''Plays actions from the initial state and returns the final state. Raises CoupError if an action is now illegal'''
+def playGame(initial, actions):
+    state = restoreState(initial)
+    for action in actions:
+        engine.apply(state, action)
+    return state.snapshot()
+
+'''
+Turns the games in a journal directory into a corpus. Rooms start from the journal's snapshot,
+or from their seed if they were created since; their final state is whatever the current rules produce.
+'''
+def capture(path):
+    generation, snapshot, records = Journal(path).load()
+    initial = dict(snapshot or [])
+    actions = dict((name, []) for name in initial)
+    games = []
+
+    def finish(name):
+        if actions.get(name):
+            games.append((name, initial[name], actions[name], playGame(initial[name], actions[name])))
+
+    for record in records:
+        kind, name = record[0], record[1]
+        if kind == 'create':
+            finish(name)
+            initial[name] = engine.GameState(record[2]).snapshot()
+            actions[name] = []
+        elif kind == 'close':
+            finish(name)
+            actions[name] = []
+        elif kind == 'action' and name in actions:
+            actions[name].append(record[2])
+    for name in sorted(actions):
+        finish(name)
+    return games
+
+'''Plays count games between bots that pick random legal moves'''
+def generate(count, seed=None):
+    rng = random.Random(seed)
+    games = []
+    for i in range(count):
+        state = engine.GameState(rng.getrandbits(64))
+        initial = state.snapshot()
+        actions = [('join', "bot{}".format(n), None) for n in range(rng.randint(2, 6))]
+        for action in actions:
+            engine.apply(state, action)
+
+        while state.winner is None and len(actions) < MAX_ACTIONS:
+            choices = []
+            for player in state.players.listPlayers():
+                choices.extend(engine.legalActions(state, player.name))
+            if choices:
+                action = rng.choice(choices)
+            elif state.players.getVote('challenge') is not None:
+                action = ('timeout', None, 'challenge')
+            else:
+                break
+            engine.apply(state, action)
+            actions.append(action)
+        games.append(("generated{}".format(i), initial, actions, state.snapshot()))
+    return games
+
+'''
+Replays every game repeat times. Returns the names of the games whose outcome changed,
+the number of actions replayed and the time taken.
+'''
+def check(games, repeat=1):
+    mismatched = set()
+    actions = 0
+    start = time.time()
+    for i in range(repeat):
+        for name, initial, moves, final in games:
+            try:
+                if playGame(initial, moves) != final:
+                    mismatched.add(name)
+            except CoupError:
+                mismatched.add(name)
+            actions += len(moves)
+    return sorted(mismatched), actions, time.time() - start
+
+def usage():
+    print "Usage: python replay.py capture [journal dir] [corpus]"
+    print "       python replay.py generate [games] [corpus] [seed]"
+    print "       python replay.py check [corpus] [repeat]"
+    sys.exit(2)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        usage()
+    COMMAND = sys.argv[1]
+
+    if COMMAND == "capture" and len(sys.argv) > 3:
+        games = capture(sys.argv[2])
+        saveCorpus(sys.argv[3], games)
+        print "Captured {0} games to {1}".format(len(games), sys.argv[3])
+    elif COMMAND == "generate" and len(sys.argv) > 3:
+        games = generate(int(sys.argv[2]), int(sys.argv[4]) if len(sys.argv) > 4 else None)
+        saveCorpus(sys.argv[3], games)
+        print "Generated {0} games to {1}".format(len(games), sys.argv[3])
+    elif COMMAND == "check":
+        games = loadCorpus(sys.argv[2])
+        repeat = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+        mismatched, actions, elapsed = check(games, repeat)
+        played = len(games) * repeat
+        print "Replayed {0} games ({1} actions) in {2:.3f} s: {3:.0f} games/s, {4:.0f} actions/s".format(
+            played, actions, elapsed, played / max(elapsed, 1e-9), actions / max(elapsed, 1e-9))
+        for name in mismatched:
+            print "MISMATCH:", name
+        if mismatched:
+            sys.exit(1)
+    else:
+        usage()
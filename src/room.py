@@ -0,0 +1,125 @@
+#Game rooms, so that one server process can host many tables at once
+import threading
+from ratelimit import Limits, ROOM_BUDGETS
+
+'''
+A single table. Each room owns its own CoupGame (deck, turn queue and treasury).
+members holds every connection currently in the room, registered or not.
+'''
+class Room(object):
+    def __init__(self, name, game):
+        self.name = name
+        self.game = game
+        self.members = set()
+        #Shared by every member, so a crowd can't flood the room any more than one client can
+        self.limits = Limits("room", ROOM_BUDGETS)
+
+    def numMembers(self):
+        return len(self.members)
+
+    '''A one-line summary used by /rooms'''
+    def describe(self):
+        return "{0} ({1} players, {2} connected)\n".format(self.name, self.game.players.numPlayers(), self.numMembers())
+
+'''
+Keeps track of every room on the server, keyed by name.
+gameFactory(scheduler, seed=, name=, journal=) builds the CoupGame for a new room on the shared TimerScheduler.
+The default room always exists; every other room closes when its last member leaves.
+If a Journal is given, rooms opening and closing are recorded in it, and each game records its actions.
+Once usePool() is called, each room's game gets a Mailbox from the WorkerPool (see workers.py)
+and all work on the game goes through it. Rooms are then opened, joined and closed from several workers,
+so the registry and the member sets are only changed under lock.
+'''
+class RoomManager(object):
+    DEFAULT_ROOM = "lobby"
+
+    def __init__(self, gameFactory, scheduler, journal=None):
+        self.gameFactory = gameFactory
+        self.scheduler = scheduler
+        self.journal = journal
+        self.pool = None
+        self.rooms = {}
+        #Reentrant: leave() closes rooms
+        self.lock = threading.RLock()
+        self.default = self.createRoom(self.DEFAULT_ROOM)
+
+    '''Returns the room with the given name, or None'''
+    def getRoom(self, name):
+        return self.rooms.get(name)
+
+    '''Creates a new empty room. Returns None if the name is taken'''
+    def createRoom(self, name, seed=None):
+        with self.lock:
+            if name in self.rooms:
+                return None
+            room = Room(name, self.gameFactory(self.scheduler, seed=seed, name=name, journal=self.journal))
+            if self.pool is not None:
+                room.game.mailbox = self.pool.mailbox()
+            self.rooms[name] = room
+            if self.journal is not None:
+                self.journal.record('create', name, room.game.seed)
+            return room
+
+    '''Runs every room, existing and future, on the workers of pool'''
+    def usePool(self, pool):
+        with self.lock:
+            self.pool = pool
+            for room in self.rooms.values():
+                room.game.mailbox = pool.mailbox()
+
+    '''Adds conn to room. Returns False if the room has been closed'''
+    def enter(self, room, conn):
+        with self.lock:
+            if self.rooms.get(room.name) is not room:
+                return False
+            room.members.add(conn)
+            return True
+
+    '''Removes conn from room, closing the room if it is now empty'''
+    def leave(self, room, conn):
+        with self.lock:
+            room.members.discard(conn)
+            if not room.members and room is not self.default:
+                self.closeRoom(room)
+
+    def closeRoom(self, room):
+        with self.lock:
+            if self.rooms.get(room.name) is room:
+                del self.rooms[room.name]
+                if self.journal is not None:
+                    self.journal.record('close', room.name)
+
+    '''Returns the state of every room. Only safe while nothing else is running them, as during a hot restart'''
+    def snapshot(self):
+        return [(room.name, room.game.snapshot()) for room in self.listRooms()]
+
+    '''
+    Starts a journal snapshot without stopping any room. The rooms are listed under the lock, so any room
+    created later is journaled after the snapshot began; each one's state is then taken by the thread that runs
+    the room, in order with its actions, so rooms don't wait on one another
+    '''
+    def beginSnapshot(self, journal):
+        with self.lock:
+            rooms = [self.rooms[name] for name in sorted(self.rooms)]
+            journal.begin([room.name for room in rooms])
+        for room in rooms:
+            room.game.post(self.captureRoom, room, journal)
+
+    def captureRoom(self, room, journal):
+        with self.lock:
+            current = self.rooms.get(room.name) is room
+        journal.capture(room.name, room.game.snapshot() if current else None)
+
+    '''Rebuilds the rooms from a journal snapshot'''
+    def restore(self, snapshot):
+        for name, state in snapshot:
+            room = self.getRoom(name) or self.createRoom(name)
+            room.game.restore(state)
+
+    '''Returns the rooms sorted by name for easy listing'''
+    def listRooms(self):
+        with self.lock:
+            return [self.rooms[name] for name in sorted(self.rooms)]
+
+    def numRooms(self):
+        return len(self.rooms)
@@ -1,479 +1,914 @@
 #Authors: Joe DiSabito, Ryan Hartman, Alec Benson
 import SocketServer
 from collections import deque
-import sys, threading, urllib
-from deck import Deck
-from vote import Vote
-from player import Player, PlayerQueue
+import hmac, json, os, signal, socket, sys, threading, time
+import handoff
+import engine, messages, protocol
+from engine import GameState
+from eventloop import CoupEventServer, raiseFileLimit, tuneClientSocket
+from outbound import SendPump, DEFAULT_LIMIT, DEFAULT_POLICY, POLICIES
+from room import RoomManager
+from timer import TimerScheduler
+from linebuffer import LineBuffer
+from command import CommandRegistry
+from journal import Journal
+from deck import ROLES
+from odds import deckOdds, exchangeOdds, claimOdds
+from metrics import MetricsRegistry, MetricsServer
+from profiling import RoomProfiler, Sampler, canWrite, installSignal, MAX_SECONDS, PROFILE_DIR
+from protocol import StructuredConnection
+from ratelimit import Limits, allowAll, CONNECTION_BUDGETS, SHED, CHAT, GAME, ERRORS, MAX_CHAT, MAX_QUEUED_LINES, QUEUE
+from statesync import StateTracker
+from workers import WorkerPool, DEFAULT_WORKERS
 from error import *
 
+#Telemetry for the metrics port. Gauges over the rooms are added by watchRooms()
+METRICS = MetricsRegistry()
+BROADCASTS = METRICS.counter("coup_broadcasts_total", "Messages broadcast to the players of a room")
+BROADCAST_BYTES = METRICS.counter("coup_broadcast_bytes_total", "Bytes handed to client connections by broadcasts")
+FANOUT_TIME = METRICS.histogram("coup_broadcast_fanout_seconds", "Time taken to hand the output of one action to every player in a room")
+
+#Clients that send "/admin [token]" with this token may use the admin commands. Unset, nobody can
+ADMIN_TOKEN = os.environ.get("COUP_ADMIN_TOKEN")
+
+#Clients that send nothing for this many seconds are disconnected, and seats restored from the journal
+#that nobody reclaims are given up after as long. 0 turns both off
+IDLE_TIMEOUT = float(os.environ.get("COUP_IDLE_TIMEOUT", 600))
+#JSON clients that are quiet this long are sent {"event": "ping"}, and are disconnected if they stay quiet
+#for HEARTBEAT_MISSES intervals. Text clients can send /ping to stay connected. 0 turns heartbeats off
+HEARTBEAT_INTERVAL = float(os.environ.get("COUP_HEARTBEAT", 30))
+HEARTBEAT_MISSES = 3
+
+#Bytes of unsent output a client may have queued, and what happens to one that goes past it:
+#drop, disconnect or coalesce (see outbound.py)
+OUTBOUND_LIMIT = int(os.environ.get("COUP_OUTBOUND_LIMIT", DEFAULT_LIMIT))
+OVERFLOW_POLICY = os.environ.get("COUP_OVERFLOW_POLICY", DEFAULT_POLICY)
+
+'''
+Thread-per-client server. Output to clients goes through a shared SendPump,
+so a slow client never blocks the thread that is broadcasting to it.
+'''
 class CoupServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
-    pass
+    #TCPServer only queues 5 connections, too few for a burst of clients
+    request_queue_size = socket.SOMAXCONN
+
+    def __init__(self, server_address, RequestHandlerClass, outboundLimit=DEFAULT_LIMIT, overflowPolicy=DEFAULT_POLICY):
+        SocketServer.TCPServer.__init__(self, server_address, RequestHandlerClass)
+        self.pump = SendPump(outboundLimit, overflowPolicy)
 
 class CoupRequestHandler(SocketServer.BaseRequestHandler):
     def __init__(self, callback, *args, **keys):
-        self.cg = callback
+        self.rooms = callback
         SocketServer.BaseRequestHandler.__init__(self, *args, **keys)
 
+    def setup(self):
+        tuneClientSocket(self.request)
+        self.request = self.server.pump.wrap(self.request)
+        self.initClient()
+
+    '''
+    Every client starts out in the default room
+    '''
+    def initClient(self):
+        self.lines = LineBuffer()
+        self.closed = False
+        self.admin = False
+        self.limits = Limits("connection", CONNECTION_BUDGETS)
+        #Lines posted to the room's mailbox by the reader thread, and lines run from it by the worker.
+        #Each has only one writer, so their difference is the backlog without a lock
+        self.linesPosted = 0
+        self.linesRun = 0
+        #True while a notice about dropped lines is waiting for the worker
+        self.shedNotice = False
+        self.enterRoom(self.rooms.default)
+        self.lastInput = time.time()
+        self.idleTimer = None
+        self.watchIdle()
+
     '''
     When a client connects, a thread is spawned for the client and handle() is called.
     handle() will, as the name suggests, handle the data that the client sends and act accordingly.
     '''
     def handle(self):
-        q = self.cg.players
         conn = self.request
 
         while True:
             try:
-                self.data = conn.recv(1024).strip()
-                player = q.getPlayer(conn)
-                self.parseRequest(player, self.data)
-                #If the player issuing the request is in the game...
-                if not q.isClientRegistered(conn):
-                    raise UnregisteredPlayerError(conn)
+                data = conn.recv(4096)
             except IOError:
+                data = ""
+            if not data:
+                #The client closed the connection, or it was closed for being idle
                 conn.close()
-                q.removePlayer(conn)
+                self.disconnect()
                 return
-            except UnregisteredPlayerError:
-                pass
+            self.processData(data)
 
     '''
-    Sends a chat message from player to all connected clients. If the user is unregistered, the message is Anonymous
+    Handles a chunk of data received from the client. Shared by the threaded and event loop servers.
+    Every complete line in the chunk is run as a command, in order: right away in the event loop,
+    or on the worker of the client's room in the threaded server. Either way a client may have at most
+    MAX_QUEUED_LINES waiting to run; any more are dropped on the spot, and the client is told so.
     '''
-    def chatMessage(self, player, parts):
-        if len(parts) >= 2:
-            if player is None:
-                self.broadcast_message("Anonymous: {0}\n".format(parts[1]))
-            else:
-                self.broadcast_message("{0}: {1}\n".format(player.name, parts[1]))
+    def processData(self, data):
+        self.lastInput = time.time()
+        #Clients may send any bytes, but everything past here (JSON output included) relies on UTF-8
+        lines = [line.decode('utf-8', 'replace').encode('utf-8') for line in self.lines.feed(data)]
+        #Read once: a worker may be moving the client to another room right now
+        room = self.room
+        mailbox = room.game.mailbox
+        waiting = self.linesPosted - self.linesRun if mailbox is not None else 0
+        space = max(MAX_QUEUED_LINES - waiting, 0)
+        shed = len(lines) > space
+        if shed:
+            SHED[("connection", QUEUE)] += len(lines) - space
+            lines = lines[:space]
+        if mailbox is not None:
+            if lines:
+                self.linesPosted += len(lines)
+                mailbox.post(self.processQueued, room, lines)
+            #One notice waiting at a time, so a flood can't fill the mailbox with them instead
+            if shed and not self.shedNotice:
+                self.shedNotice = True
+                mailbox.post(self.notifyShed, room)
+            return
+        for line in lines:
+            if self.closed:
+                return
+            self.processMessage(line)
+        if shed:
+            self.notifyShed(room)
+
+    '''Tells the client some of its input was dropped, charged to its error budget like any other notice'''
+    def notifyShed(self, room):
+        if self.room is not room:
+            return self.room.game.post(self.notifyShed, self.room)
+        self.shedNotice = False
+        if not self.closed:
+            self.sendError(RateLimitedError.message)
 
-    '''Broadcasts message to all connected players'''
-    def broadcast_message(self, message):
-        for player in self.cg.players.listPlayers():
-            player.conn.sendall(message)
+    '''
+    Runs lines from room's mailbox. If a command moves the client to another room,
+    the rest are passed on to that room's mailbox so they never touch a game from the wrong worker.
+    '''
+    def processQueued(self, room, lines):
+        for i in range(len(lines)):
+            if self.room is not room:
+                return self.room.game.mailbox.post(self.processQueued, self.room, lines[i:])
+            self.linesRun += 1
+            if self.closed:
+                continue
+            self.processMessage(lines[i])
 
     '''
-    Boots a player from the server
+    Runs a single command line from the client
     '''
-    def kick(self, player, parts):
-        return player.conn.close()
+    def processMessage(self, message):
+        if message == protocol.SYNC:
+            return self.sync()
+        if self.request.structured:
+            return self.processStructured(message)
+        self.data = message.strip()
+        player = self.cg.players.getPlayer(self.request)
+        profiler = self.cg.profiler
+        if profiler is not None:
+            return profiler.run(self.parseRequest, player, self.data)
+        self.parseRequest(player, self.data)
 
     '''
-    Prints the target player's current hand, or display's the current player's hand if no name is provided
+    Answers the gateway's sync line with the client's room, protocol and whether it is an admin,
+    outside either protocol (see gateway.py)
     '''
-    def showHand(self, player, parts):
+    def sync(self):
+        reply = "{0} {1} {2} {3}\n".format(protocol.SYNC, self.room.name, "json" if self.request.structured else "text",
+                                          "admin" if self.admin else "player")
+        if self.request.structured:
+            self.request.sendLine(reply)
+        else:
+            self.request.sendall(reply)
+
+    '''
+    Runs a line from a client using the JSON protocol: one request {"id": 1, "cmd": "/steal", "args": "bob"},
+    or a list of them run in order as a batch. The replies, in the same shape, are sent as one line.
+    '''
+    def processStructured(self, line):
+        conn = self.request
         try:
-            if player is None:
-                raise UnregisteredPlayerError(self.request)
-
-            if len(parts) >= 2:
-                name = parts[1]
-                #If the player enters their own name
-                if name == player.name:
-                    return player.conn.sendall(player.getHand(True))
-
-                #If the player enters another player's name
-                target = self.cg.players.getPlayerByName(name)
-                if target == None:
-                    raise NoSuchPlayerError(self.request, name)
-                return player.conn.sendall(target.getHand(False))
+            requests = json.loads(line)
+        except ValueError:
+            if line.strip():
+                conn.sendLine(protocol.encode({"id": None, "ok": False, "error": "Malformed JSON.\n"}))
+            return
+        if isinstance(requests, list):
+            replies = []
+            for request in requests:
+                if self.closed:
+                    break
+                replies.append(self.runStructured(conn, request))
+            conn.sendLine(protocol.encode(replies))
+        else:
+            conn.sendLine(protocol.encode(self.runStructured(conn, requests)))
+
+    '''Runs one JSON request and returns its reply'''
+    def runStructured(self, conn, request):
+        if not isinstance(request, dict) or not isinstance(request.get("cmd"), basestring):
+            return {"id": None, "ok": False, "error": "A request needs a \"cmd\".\n"}
+        command = request["cmd"].encode('utf-8')
+        if not command.startswith("/"):
+            command = "/" + command
+        args = request.get("args")
+        if args is not None and not isinstance(args, basestring):
+            return {"id": request.get("id"), "ok": False, "error": "The \"args\" of a request must be a string.\n"}
+        if args is not None:
+            command += " " + args.encode('utf-8')
+
+        conn.beginReply()
+        self.data = command.strip()
+        player = self.cg.players.getPlayer(conn)
+        profiler = self.cg.profiler
+        ok = False
+        try:
+            if profiler is not None:
+                ok = profiler.run(self.parseRequest, player, self.data)
             else:
-                #The player enters no name (default)
-                return player.conn.sendall(player.getHand(True))
+                ok = self.parseRequest(player, self.data)
+        finally:
+            reply = conn.endReply(request.get("id"), ok)
+        return reply
 
-        except (UnregisteredPlayerError, NoSuchPlayerError) as e:
-            pass
+    '''
+    Answers the client: text for telnet clients, the typed fields for clients using the JSON protocol
+    '''
+    def reply(self, text, **fields):
+        if self.request.structured:
+            self.request.addReply(fields)
+        else:
+            self.request.sendall(text)
 
     '''
-    Prints the number of coins the player has
+    Cleans up after a client that has gone away
     '''
-    def showCoins(self, player, parts):
-        try:
-            if player is None:
-                raise UnregisteredPlayerError(self.request)
-            message = "Coins: {}\n".format(player.coins)
-            player.conn.sendall(message)
-        except UnregisteredPlayerError as e:
-            pass
+    def disconnect(self):
+        room = self.room
+        if room.game.mailbox is not None:
+            return room.game.mailbox.post(self.disconnectQueued, room)
+        self.disconnectQueued(room)
+
+    '''Returns how long the client may stay silent, or 0 for forever'''
+    def idleLimit(self):
+        limits = [IDLE_TIMEOUT] if IDLE_TIMEOUT else []
+        if self.request.structured and HEARTBEAT_INTERVAL:
+            limits.append(HEARTBEAT_INTERVAL * HEARTBEAT_MISSES)
+        return min(limits) if limits else 0
+
+    '''Checks on the client when its next deadline is due. One timer per client, not one per message received'''
+    def watchIdle(self):
+        limit = self.idleLimit()
+        if not limit:
+            self.idleTimer = None
+            return
+        idle = time.time() - self.lastInput
+        delay = limit - idle
+        if self.request.structured and HEARTBEAT_INTERVAL:
+            delay = min(delay, HEARTBEAT_INTERVAL - idle % HEARTBEAT_INTERVAL)
+        self.idleTimer = self.rooms.scheduler.schedule(max(delay, 0), self.idleDue)
+
+    '''Runs on the timer. The check itself runs on the room's worker, like the client's commands'''
+    def idleDue(self):
+        room = self.room
+        room.game.post(self.checkIdle, room)
+
+    '''Disconnects the client if it has been silent too long, and pings a quiet JSON client'''
+    def checkIdle(self, room):
+        if self.room is not room:
+            return self.room.game.post(self.checkIdle, self.room)
+        if self.closed:
+            return
+        idle = time.time() - self.lastInput
+        limit = self.idleLimit()
+        if limit and idle >= limit:
+            self.idleTimer = None
+            self.request.sendall("Disconnected after {:.0f} seconds without a word.\n".format(idle))
+            return self.request.close()
+        if self.request.structured and HEARTBEAT_INTERVAL and idle >= HEARTBEAT_INTERVAL:
+            self.request.sendLine(protocol.encode({"event": "ping"}))
+        self.watchIdle()
 
     '''
-    Lists all of the players and the number of coins that they have
+    Sends text to the client from the thread that serves it, for callers on other threads (such as the profilers).
+    Threaded clients are served by their room's worker
     '''
-    def listplayers(self, parts):
-        formatted_list = ""
+    def tell(self, text):
+        room = self.room
+        room.game.post(self.tellQueued, room, text)
+
+    def tellQueued(self, room, text):
+        if self.room is not room:
+            return self.room.game.post(self.tellQueued, self.room, text)
+        if not self.closed:
+            self.request.sendall(text)
+
+    def disconnectQueued(self, room):
+        if self.room is not room:
+            return self.room.game.mailbox.post(self.disconnectQueued, self.room)
+        if self.idleTimer is not None:
+            self.idleTimer.cancel()
+            self.idleTimer = None
+        self.closed = True
+        self.leaveRoom()
 
-        for player in self.cg.players.list():
-            formatted_list += "{0} ({1} Coins)\n".format(player.name, player.coins)
+    '''
+    Moves the client into room. self.cg always refers to the game of the client's current room
+    '''
+    def enterRoom(self, room):
+        self.room = room
+        self.cg = room.game
+        self.rooms.enter(room, self.request)
 
-        if not formatted_list:
-            return self.request.sendall("No registered players.\n")
+    '''
+    Takes the client out of its current room, returning the player's living cards to that room's deck
+    '''
+    def leaveRoom(self):
+        player = self.cg.players.getPlayer(self.request)
+        if player is not None:
+            self.cg.play(('leave', player.name, None))
+        self.cg.unsubscribe(self.request)
+        self.rooms.leave(self.room, self.request)
+
+    def switchRoom(self, room):
+        #Join before leaving, so the new room can't be closed by another worker in between
+        if not self.rooms.enter(room, self.request):
+            raise NoSuchRoomError(room.name)
+        self.leaveRoom()
+        self.room = room
+        self.cg = room.game
+        self.request.sendall("You are now in room {}.\n".format(room.name))
 
-        self.request.sendall(formatted_list)
+    '''
+    Lists every room on the server
+    '''
+    def listRooms(self, player, parts):
+        message = "ROOMS:\n"
+        for room in self.rooms.listRooms():
+            message += room.describe()
+        self.reply(message, rooms=[{"name": room.name, "players": room.game.players.numPlayers(), "connected": room.numMembers()}
+                                   for room in self.rooms.listRooms()])
 
     '''
-    Performs either a Duke tax, Foreign Aid, or Income.
+    Creates a new room and moves the client into it
     '''
-    def getCoins(self, player, parts, coins):
-        try:
-            if player is None:
-                raise UnregisteredPlayerError(self.request)
-            if not self.cg.players.isPlayersTurn(player):
-                raise NotYourTurnError(self.request)
-            if self.cg.treasury < coins:
-                raise NotEnoughTreasuryCoinsError(self.request)
-            if len(player.cards) > 2:
-                raise AlreadyExchangingError(self.request)
-            if player.coins >= 10:
-                raise MustCoupError(self.request)
-
-            return True
-        except (AlreadyExchangingError, UnregisteredPlayerError, NotYourTurnError, NotEnoughTreasuryCoinsError, MustCoupError) as e:
-            return False
-
-	'''
-	Functions (duke, foreignAid, income) using getCoins as helper function
-	'''
-    def tax(self, player, parts):
-        if self.getCoins(player, parts, 3):
-             
-            self.broadcast_message("{} called TAX, the Duke ability, and will get 3 coins. Other players type \"/challenge\" or \"/pass\" to continue.\n".format(player.name))
-            
-            def failFunc(handler, passers, player):
-                player.coins += 3
-                handler.cg.treasury -= 3
-		handler.broadcast_message("No challengers, {} has gained 3 coins.\n".format(player.name))
-                handler.broadcast_message(handler.cg.players.advanceTurn())
-
-	    
-            def successFunc(handler, challengers, player):
-
-                card = player.checkForCard('Duke')
-                if card != -1:
-                    #player exchanges Duke with deck
-                    handler.cg.deck.swapCard(player, card) 
-
-                    #player gets 3 coins
-                    player.coins += 3
-                    handler.cg.treasury -= 3
-
-                    #challenger loses a card
-                    target = challengers[0]
-                    handler.destroy(player, target, 0)
-                    handler.broadcast_message("Challenge failed! {0} reveals a Duke from his hand, exchanges it with the deck, and still gains 3 coins. {1} loses a card.\n".format(player.name, target.name)) 
-                else:
-                    #player loses a card
-                    handler.broadcast_message("Challenge succeeded! {0} loses a card.\n".format(player.name))
-                    handler.broadcast_message(handler.cg.players.advanceTurn())
-
-            #TODO: Challenge vote given Tax
-            voteQueue = PlayerQueue()
-            for voter in self.cg.players.listPlayers():
-                if not (voter.name == player.name):
-                     voteQueue.addPlayer(player)
-            passThreshold = (1 - self.cg.players.numPlayers()) * 100
-            successArgs = [player]
-            failArgs = [player]
-            challenge = Vote(self, voteQueue, "challenge", 20, passThreshold, successFunc, successArgs, failFunc, failArgs)
-            
- 
-    def foreignAid(self, player, parts):
-        if self.getCoins(player, parts, 2):
-            self.broadcast_message("{} receieved FOREIGN AID.\n".format(player.name))
+    def createRoom(self, player, parts):
+        name = parts[1].strip()
+        if len(name) <= 0 or len(name) >= 20:
+            raise InvalidCommandError("Room name must be between 1 and 20 characters in length.\n")
+        if not engine.isPrintableName(name):
+            raise InvalidCommandError("Room names can only use printable characters, without spaces.\n")
+        room = self.rooms.createRoom(name)
+        if room is None:
+            raise InvalidCommandError("A room named {} already exists.\n".format(name))
+        self.switchRoom(room)
 
-    def income(self, player, parts):
-        if self.getCoins(player, parts, 1):
-            self.broadcast_message("{} called INCOME.\n".format(player.name))
+    '''
+    Moves the client into an existing room
+    '''
+    def joinRoom(self, player, parts):
+        name = parts[1].strip()
+        room = self.rooms.getRoom(name)
+        if room is None:
+            raise NoSuchRoomError(name)
+        if room is self.room:
+            raise InvalidCommandError("You are already in room {}.\n".format(name))
+        self.switchRoom(room)
 
     '''
-    Stealing, CAPTAIN ability
+    Returns the client to the default room
     '''
-    def steal(self, player, parts):
-        try:
-            if player is None:
-                raise UnregisteredPlayerError(self.request)
+    def leave(self, player, parts):
+        if self.room is self.rooms.default:
+            raise InvalidCommandError("You are already in the {}.\n".format(self.room.name))
+        self.switchRoom(self.rooms.default)
 
-            if not self.cg.players.isPlayersTurn(player):
-                raise NotYourTurnError(self.request)
+    '''
+    Sends a chat message from player to all connected clients. If the user is unregistered, the message is Anonymous
+    '''
+    def chatMessage(self, player, parts):
+        text = parts[1][:MAX_CHAT]
+        if player is None:
+            self.cg.publish([('chat', None, text)])
+        else:
+            self.cg.publish([('chat', player.name, text)])
 
-            if player.coins >= 10:
-                raise MustCoupError(self.request)
+    '''Broadcasts message to all connected players'''
+    def broadcast_message(self, message):
+        self.cg.broadcast(message)
 
-            if len(player.cards) > 2:
-                raise AlreadyExchangingError(self.request)
+    '''
+    Boots a player from the server
+    '''
+    def kick(self, player, parts):
+        return self.request.close()
 
+    '''
+    Prints the target player's current hand, or display's the current player's hand if no name is provided
+    '''
+    def showHand(self, player, parts):
+        if len(parts) >= 2:
             name = parts[1]
+            #If the player enters their own name
             if name == player.name:
-                raise InvalidCommandError(self.request, "You cannot target yourself.\n")
+                return self.reply(player.getHand(True), player=name, cards=protocol.describeCards(player, True))
 
+            #If the player enters another player's name
             target = self.cg.players.getPlayerByName(name)
             if target == None:
-                raise NoSuchPlayerError(self.request, name)
+                raise NoSuchPlayerError(name)
+            return self.reply(target.getHand(False), player=name, cards=protocol.describeCards(target, False))
+        else:
+            #The player enters no name (default)
+            return self.reply(player.getHand(True), player=player.name, cards=protocol.describeCards(player, True))
 
-            if target.coins < 2:
-                raise NotEnoughCoinsError(self.request, target.name)
-
-            message = player.name + " is claiming CAPTAIN, stealing from " + target.name + ".\n"
-            self.broadcast_message(message)
-
-            #TODO:Challenge and block
-            player.coins += 2
-            target.coins -= 2
-            self.broadcast_message(self.cg.players.advanceTurn())
-        except (UnregisteredPlayerError, NotYourTurnError, InvalidCommandError, NoSuchPlayerError, NotEnoughCoinsError, MustCoupError, AlreadyExchangingError) as e:
-            pass
+    '''
+    Prints the number of coins the player has
+    '''
+    def showCoins(self, player, parts):
+        message = "Coins: {}\n".format(player.coins)
+        self.reply(message, coins=player.coins)
 
     '''
-    Exchanging cards with deck, AMBASSADOR ability
+    Lists all of the players and the number of coins that they have
     '''
-    def exchange(self, player, parts):
-        try:
-            if player is None:
-                raise UnregisteredPlayerError(self.request)
+    def listplayers(self, player, parts):
+        formatted_list = ""
 
-            if not self.cg.players.isPlayersTurn(player):
-                raise NotYourTurnError(self.request)
+        for player in self.cg.players.listPlayers():
+            formatted_list += "{0} ({1} Coins)\n".format(player.name, player.coins)
 
-            if len(player.cards) > 2:
-                raise AlreadyExchangingError(self.request)
+        if not formatted_list:
+            formatted_list = "No registered players.\n"
 
-            if player.coins >= 10:
-                raise MustCoupError(self.request)
+        self.reply(formatted_list, players=[{"name": player.name, "coins": player.coins, "cards": len(player.cards),
+                                             "alive": player.isAlive(), "ready": player.ready}
+                                            for player in self.cg.players.listPlayers()])
 
-            message = player.name + " is claiming AMBASSADOR, exchanging cards with the deck.\n"
-            self.broadcast_message(message)
+    '''
+    Gives the odds for a role from what the client can see: that the deck holds one, that an exchange draws one
+    and, if a player is named, that they hold one (say, before challenging their claim)
+    '''
+    def odds(self, player, parts):
+        args = parts[1].split()
+        role = args[0].capitalize()
+        if role not in ROLES:
+            raise InvalidCommandError("Unknown role {0}. The roles are {1}.\n".format(args[0], ", ".join(ROLES)))
+        fields = {"role": role, "deck": deckOdds(self.cg, player, role), "exchange": exchangeOdds(self.cg, player, role)}
+        message = "{0} in the deck: {1:.0%}\n{0} in an exchange: {2:.0%}\n".format(role, fields["deck"], fields["exchange"])
+        if len(args) > 1:
+            target = self.cg.players.getPlayerByName(args[1])
+            if target is None:
+                raise NoSuchPlayerError(args[1])
+            fields["player"] = target.name
+            fields["claim"] = claimOdds(self.cg, player, target, role)
+            message += "{0} in {1}'s hand: {2:.0%}\n".format(role, target.name, fields["claim"])
+        self.reply(message, **fields)
 
-            player.cards.append(cg.deck.deal())
-            player.cards.append(cg.deck.deal())
-            self.showHand(player, ["",player.name])
+    '''
+    Game moves. Each one hands an action to the room's game, which applies the rules and tells the players what happened.
+    '''
+    def tax(self, player, parts):
+        self.cg.play(('tax', player.name, None))
 
-            message = player.name + " has been dealt two cards to exchange.\n"
-            self.broadcast_message(message)
+    def foreignAid(self, player, parts):
+        self.cg.play(('aid', player.name, None))
 
-            player.conn.sendall("Select cards to remove (1 to {}, where 1 is the top card)" \
-                                "from least to greatest without a space. Ex. /remove 23\n".format(str(len(player.cards))))
-        except (AlreadyExchangingError, UnregisteredPlayerError, NotYourTurnError,
-                InvalidCommandError, NoSuchPlayerError, NotEnoughCoinsError, MustCoupError) as e:
-                pass
+    def income(self, player, parts):
+        self.cg.play(('income', player.name, None))
 
-    '''
-    Remove function to carry out the second half of Ambassador ability.
-    '''
-    def remove(self, player, parts):
-        try:
-            if player is None:
-                raise UnregisteredPlayerError(self.request)
+    def steal(self, player, parts):
+        self.cg.play(('steal', player.name, parts[1]))
 
-            if not self.cg.players.isPlayersTurn(player):
-                raise NotYourTurnError(self.request)
+    def exchange(self, player, parts):
+        self.cg.play(('exchange', player.name, None))
+
+    def remove(self, player, parts):
+        self.cg.play(('remove', player.name, parts[1]))
 
-            if len(player.cards) <= 2:
-                raise CannotRemoveError(self.request)
+    def assassinate(self, player, parts):
+        self.cg.play(('assassinate', player.name, parts[1]))
 
-            card1 = int(parts[1]) % 10 - 1
-            card2 = int(parts[1]) / 10 - 1
-            cg.deck.addCard(player.cards[card1])
-            cg.deck.addCard(player.cards[card2])
-            del player.cards[card1]
-            del player.cards[card2]
+    def coup(self, player, parts):
+        self.cg.play(('coup', player.name, parts[1]))
 
-            self.showHand(player, ["",player.name])
+    def endturn(self, player, parts):
+        self.cg.play(('endturn', player.name, None))
 
-            message = player.name + " has returned 2 cards to the deck.\n"
-            self.broadcast_message(message)
+    def ready(self, player, parts):
+        self.cg.play(('ready', player.name, None))
 
-            self.broadcast_message(self.cg.players.advanceTurn())
-            cg.deck.shuffle()
+    def challenge(self, player, parts):
+        self.cg.play(('challenge', player.name, None))
 
-        except (CannotRemoveError, UnregisteredPlayerError, NotYourTurnError,
-            InvalidCommandError, NoSuchPlayerError, NotEnoughCoinsError, MustCoupError, NotEnoughArguments) as e:
-            pass
+    def passChallenge(self, player, parts):
+        self.cg.play(('pass', player.name, None))
 
     '''
-    Performs card destruction (coup, assassination, challenge)
+    Registers the client with the name provided
     '''
-    def destroy(self, player, target, coins):
-        try:
-            if player is None:
-                raise UnregisteredPlayerError(self.request)
-
-            if not self.cg.players.isPlayersTurn(player) and coins != 0:
-                raise NotYourTurnError(self.request)
+    def register(self, player, parts):
+        if player is not None:
+            raise AlreadyRegisteredPlayerError()
+        seat = self.cg.players.getPlayerByName(parts[1])
+        if seat is not None and seat.conn is None:
+            #A player restored from the journal, waiting for their client to come back
+            self.cg.players.bindConnection(seat, self.request)
+            return self.broadcast_message("{} is back!\n".format(seat.name))
+        events = self.cg.apply(('join', parts[1], None))
+        #Bind the connection first so the new player sees their own welcome
+        self.cg.players.bindConnection(self.cg.players.getPlayerByName(parts[1]), self.request)
+        self.cg.publish(events)
 
-            if player.coins >= 10 and coins == 3:
-                raise MustCoupError(self.request)
-
-            if len(parts) < 2:
-                raise InvalidCommandError(self.request, "You need to specify a player (by name) that you want to target\n")
+    '''
+    Grants the client the admin commands if it knows the server's admin token
+    '''
+    def login(self, player, parts):
+        if ADMIN_TOKEN is None or not hmac.compare_digest(parts[1].strip(), ADMIN_TOKEN):
+            raise InvalidCommandError("Wrong admin token.\n")
+        self.admin = True
+        self.request.sendall("You are now an administrator.\n")
 
-            name = parts[1]
-            if name == player.name:
-                raise InvalidCommandError(self.request, "You cannot target yourself. Nice try.\n")
+    '''
+    Profiles the server for the given number of seconds: one room with cProfile if a room is named,
+    otherwise every thread in the process with the stack sampler. See profiling.py
+    '''
+    def profile(self, player, parts):
+        args = parts[1].split()
+        try:
+            seconds = float(args[0])
+        except ValueError:
+            raise InvalidCommandError("Usage: /profile <seconds> [room]\n")
+        if seconds <= 0 or seconds > MAX_SECONDS:
+            raise InvalidCommandError("Profiles can run for up to {} seconds.\n".format(MAX_SECONDS))
+        if not canWrite():
+            raise InvalidCommandError("Profiles can't be written to {}.\n".format(PROFILE_DIR))
+
+        if len(args) < 2:
+            sampler = Sampler(seconds, report=self.tell)
+            sampler.start()
+            return self.request.sendall("Profiling the process for {0:g} seconds into {1}\n".format(seconds, sampler.path))
+        room = self.rooms.getRoom(args[1])
+        if room is None:
+            raise NoSuchRoomError(args[1])
+        if room.game.profiler is not None:
+            raise InvalidCommandError("Room {} is already being profiled.\n".format(room.name))
+        profiler = RoomProfiler(room, seconds, report=self.tell)
+        profiler.start(self.rooms.scheduler)
+        self.request.sendall("Profiling room {0} for {1:g} seconds into {2}\n".format(room.name, seconds, profiler.path))
 
-            if player.coins < coins:
-                raise NotEnoughCoinsError(self.request, "")
+    '''
+    Prints a help message for clients
+    '''
+    def help(self, player, parts):
+        message = "\nCOMMANDS:\n" + "\n".join(COMMANDS.names()) + "\n"
+        self.reply(message, commands=COMMANDS.names())
 
-            target = self.cg.players.getPlayerByName(name)
-            if target == None:
-                raise NoSuchPlayerError(self.request, name)
+    '''
+    Switches the client between the telnet text ("text") and the JSON-lines protocol for bots ("json").
+    The connection is swapped for one that speaks the new protocol, so this has to happen before registering.
+    '''
+    def setProtocol(self, player, parts):
+        name = parts[1].strip()
+        if name not in ("text", "json"):
+            raise InvalidCommandError("Unknown protocol {}. Use text or json.\n".format(name))
+        if player is not None:
+            raise InvalidCommandError("Choose the protocol before you register.\n")
+        if (name == "json") == self.request.structured:
+            return
+        self.useProtocol(name == "json")
+        if name == "json":
+            self.request.sendLine(protocol.encode({"event": "protocol", "name": "json", "version": protocol.VERSION}))
+        else:
+            self.request.sendall("Protocol set to text.\n")
+
+    def useProtocol(self, structured):
+        old = self.request
+        self.cg.unsubscribe(old)
+        self.request = StructuredConnection(old) if structured else old.conn
+        self.rooms.enter(self.room, self.request)
+        self.rooms.leave(self.room, old)
+        #The new protocol may have a different idle limit
+        if self.idleTimer is not None:
+            self.idleTimer.cancel()
+        self.watchIdle()
 
-            player.coins -= coins
-            self.cg.treasury += coins
+    '''
+    Starts sending the client the changes to its room's state after every action (JSON protocol only).
+    With "[epoch] [version]" from an earlier state message, the reply holds the changes since then;
+    otherwise, or if they are too old, it holds the whole state.
+    '''
+    def subscribe(self, player, parts):
+        if not self.request.structured:
+            raise InvalidCommandError("Subscribing needs the JSON protocol: /protocol json\n")
+        epoch = version = None
+        if len(parts) > 1 and parts[1].strip():
+            try:
+                epoch, version = [int(arg) for arg in parts[1].split()]
+            except ValueError:
+                raise InvalidCommandError("Usage: /subscribe [epoch version]\n")
+        self.request.addReply(self.cg.subscribe(self.request, player, epoch, version))
 
-            #TODO: ADD CHALLENGE/PROTECTION CHANCE HERE
-            self.broadcast_message(".\n".format(player.name, target.name))
-            self.broadcast_message(target.killCardInHand())
-            self.broadcast_message(self.cg.players.advanceTurn())
-            return target
-        except (UnregisteredPlayerError, NotYourTurnError, InvalidCommandError, NoSuchPlayerError, NotEnoughCoinsError, MustCoupError) as e:
-            return None
+    def unsubscribe(self, player, parts):
+        self.cg.unsubscribe(self.request)
 
     '''
-    Assassination (using destroy as helper function), card destruction with loss of 3 coins
+    Does nothing but show the server the client is still there
     '''
-    def assassinate(self, player, parts):
-        target = self.cg.players.getPlayerByName(parts[1])
-        target = self.destroy(player, target, 3)
-        if target is not None:
-            self.broadcast_message("{0} will ASSASSINATE {1}.\n".format(player.name, target.name))
+    def ping(self, player, parts):
+        self.reply("PONG\n")
 
     '''
-    Coup (using destroy as helper function), card destruction with loss of 7 coins
-        '''
-    def coup(self,player,parts):
-        target = self.cg.players.getPlayerByName(parts[1])
-        target = self.destroy(player, parts, 7)
-        if target is not None:
-            self.broadcast_message("{0} called a COUP on {1}.\n".format(player.name, target.name))
+    Returns what a new server process needs to take over this client after a hot restart (see handoff.py):
+    the socket, address, room, seat, protocol, admin rights, unread input, unsent output and subscription
+    '''
+    def handoffState(self):
+        player = self.cg.players.getPlayer(self.request)
+        outbox = self.request.outbox
+        tracker = self.cg.tracker
+        subscribed = tracker is not None and self.request in tracker.subscribers
+        return (self.request.fileno(), self.client_address, self.room.name, player.name if player is not None else None,
+                self.request.structured, self.admin, self.lines.pending, "".join(outbox.chunks) if outbox else "",
+                subscribed)
 
     '''
-    Ends the player's turn, or raises a NotYourTurnError if it is not the player's turn to move
+    Puts a client handed over by the previous server process back where it was.
+    A subscriber is sent the whole state under the new process's epoch, since versions don't carry over
     '''
-    def endturn(self, player, parts):
-        try:
-            if player is None:
-                raise UnregisteredPlayerError(self.request)
+    def resumeClient(self, roomName, playerName, structured, admin, pending, output, subscribed=False):
+        room = self.rooms.getRoom(roomName)
+        if room is not None and room is not self.room:
+            self.rooms.leave(self.room, self.request)
+            self.enterRoom(room)
+        if output:
+            self.request.sendall(output)
+        if structured:
+            self.useProtocol(True)
+        seat = self.cg.players.getPlayerByName(playerName) if playerName is not None else None
+        if seat is not None and seat.conn is None:
+            self.cg.players.bindConnection(seat, self.request)
+        if subscribed and structured:
+            player = self.cg.players.getPlayer(self.request)
+            message = self.cg.subscribe(self.request, player)
+            message["event"] = "state"
+            self.request.sendLine(protocol.encode(message))
+        self.admin = admin
+        self.lines.pending = pending
 
-            if not self.cg.players.isPlayersTurn(player):
-                raise NotYourTurnError(self.request)
+    '''
+    Parses the client's request and dispatches to the correct function
+    '''
+    def parseRequest(self, player, message):
+        parts = message.split(' ',1)
+        command = COMMANDS.get(parts[0])
 
-            self.broadcast_message("{} ended his turn.\n".format(player.name))
-            self.broadcast_message(self.cg.players.advanceTurn())
-        except (UnregisteredPlayerError, NotYourTurnError) as e:
-            pass
+        if command is not None:
+            if not self.admit(command.budget):
+                self.sendError(RateLimitedError.message)
+                return False
+            return COMMANDS.dispatch(command, self, player, parts)
+        elif parts[0] != "":
+            self.sendError("Unrecognized command.\n")
+        return False
 
     '''
-    A helper to verify that a requested name is valid before it is registered
+    Spends a token from the client's and the room's budget before a command runs.
+    A command that finds either empty is dropped without running.
     '''
-    def isValidName(self, name):
-        try:
-            strname = str(name)
-            length = len(strname)
-            if length <= 0 or length >= 20:
-                raise InvalidCommandError(self.request, "Name must be between 1 and 20 characters in length.\n")
-            if self.cg.players.getPlayerByName(name):
-                raise InvalidCommandError(self.request, "A user with this name is already registered.\n")
-            return True
-        except (InvalidCommandError) as e:
-            return False
+    def admit(self, budget):
+        return allowAll(budget, time.time(), self.limits, self.room.limits)
 
     '''
-    Registers the client with the name provided
+    Sends an error to the client, unless it has already been sent too many.
+    Otherwise a client could keep the server busy writing errors back to it.
     '''
-    def register(self, parts):
-        try:
-            if len(parts) < 2:
-                raise InvalidCommandError(self.request, "Could not register: please provide a name.")
+    def sendError(self, text):
+        if self.limits.allow(ERRORS, time.time()):
+            self.request.sendall(text)
 
-            name = parts[1]
-            if self.cg.players.isClientRegistered(self.request):
-                raise AlreadyRegisteredPlayerError(self.request)
+'''
+Runs the CoupRequestHandler commands for one client of the CoupEventServer.
+The event loop feeds it data as it arrives instead of it blocking in handle().
+'''
+class CoupConnectionHandler(CoupRequestHandler):
+    def __init__(self, callback, conn):
+        self.rooms = callback
+        self.request = conn
+        self.client_address = conn.address
+        self.loop = conn.loop
+        self.initClient()
+
+    '''Sends text to the client from the loop thread'''
+    def tell(self, text):
+        self.loop.requestCall(lambda: self.tellQueued(self.room, text))
 
-            if self.isValidName(name):
-                newPlayer = Player(self.request, name, self.cg.deck.deal(), self.cg.deck.deal())
-                msg = self.cg.players.addPlayer(newPlayer)
-                self.broadcast_message(msg)
-        except (InvalidCommandError, AlreadyRegisteredPlayerError) as e:
-            pass
+'''
+Every command a client can send, with the preconditions the dispatcher checks before running it
+and the rate limit budget it spends from (commands without one share the general budget)
+'''
+COMMANDS = CommandRegistry()
+COMMANDS.add("/say", CoupRequestHandler.chatMessage, args=1, budget=CHAT)
+COMMANDS.add("/exit", CoupRequestHandler.kick)
+COMMANDS.add("/help", CoupRequestHandler.help)
+COMMANDS.add("/hand", CoupRequestHandler.showHand, registered=True)
+COMMANDS.add("/coins", CoupRequestHandler.showCoins, registered=True)
+COMMANDS.add("/players", CoupRequestHandler.listplayers)
+COMMANDS.add("/odds", CoupRequestHandler.odds, args=1)
+COMMANDS.add("/register", CoupRequestHandler.register, args=1, budget=GAME)
+COMMANDS.add("/ready", CoupRequestHandler.ready, registered=True, budget=GAME)
+COMMANDS.add("/tax", CoupRequestHandler.tax, myTurn=True, notExchanging=True, budget=GAME)
+COMMANDS.add("/income", CoupRequestHandler.income, myTurn=True, notExchanging=True, budget=GAME)
+COMMANDS.add("/aid", CoupRequestHandler.foreignAid, myTurn=True, notExchanging=True, budget=GAME)
+COMMANDS.add("/steal", CoupRequestHandler.steal, args=1, myTurn=True, notExchanging=True, budget=GAME)
+COMMANDS.add("/exchange", CoupRequestHandler.exchange, myTurn=True, notExchanging=True, budget=GAME)
+COMMANDS.add("/remove", CoupRequestHandler.remove, args=1, myTurn=True, budget=GAME)
+COMMANDS.add("/assassinate", CoupRequestHandler.assassinate, args=1, myTurn=True, notExchanging=True, budget=GAME)
+COMMANDS.add("/coup", CoupRequestHandler.coup, args=1, myTurn=True, notExchanging=True, budget=GAME)
+COMMANDS.add("/endturn", CoupRequestHandler.endturn, myTurn=True, budget=GAME)
+COMMANDS.add("/challenge", CoupRequestHandler.challenge, registered=True, budget=GAME)
+COMMANDS.add("/pass", CoupRequestHandler.passChallenge, registered=True, budget=GAME)
+COMMANDS.add("/rooms", CoupRequestHandler.listRooms)
+COMMANDS.add("/create", CoupRequestHandler.createRoom, args=1)
+COMMANDS.add("/join", CoupRequestHandler.joinRoom, args=1)
+COMMANDS.add("/leave", CoupRequestHandler.leave)
+COMMANDS.add("/admin", CoupRequestHandler.login, args=1)
+COMMANDS.add("/profile", CoupRequestHandler.profile, args=1, admin=True)
+COMMANDS.add("/protocol", CoupRequestHandler.setProtocol, args=1)
+COMMANDS.add("/subscribe", CoupRequestHandler.subscribe)
+COMMANDS.add("/unsubscribe", CoupRequestHandler.unsubscribe)
+COMMANDS.add("/ping", CoupRequestHandler.ping)
 
-    '''Sets a player as ready or unready and announces to all clients'''
-    def ready(self, player, parts):
-        try:
-            if player is None:
-                raise UnregisteredPlayerError(self.request)
-            self.broadcast_message(player.toggleReady())
-        except UnregisteredPlayerError:
-            pass
+'''
+The game of one room: the engine's GameState plus the connections and timers that bring it online.
+'''
+class CoupGame(GameState):
+    def __init__(self, scheduler, seed=None, name=None, journal=None):
+        GameState.__init__(self, seed)
+        self.scheduler = scheduler
+        self.name = name
+        self.journal = journal
+        #Timer that ends the open challenge vote
+        self.voteTimer = None
+        #The RoomProfiler while the room is being profiled
+        self.profiler = None
+        #Created by the first subscriber, so rooms nobody subscribes to don't track versions
+        self.tracker = None
+        #The room's Mailbox when rooms run on a WorkerPool (threaded server)
+        self.mailbox = None
+
+    '''Runs func(*args) on the room's worker, or right away if there is none'''
+    def post(self, func, *args):
+        if self.mailbox is None:
+            return func(*args)
+        self.mailbox.post(func, *args)
 
     '''
-    Prints a help message for clients
+    Applies action to the game, recording it in the journal, and returns the events.
+    Like every change to the game it runs on the room's worker, which is also where journal snapshots
+    of the room are taken, so none can fall between the two
     '''
-    def help(self, player, parts):
-        message = "\nCOMMANDS:\n/say\n/exit\n/help\n/hand\n/tax\n/register\n/exchange\n/income\n/aid\n/steal\n/assassinate\n/ready\n/endturn\n"
-        player.conn.sendall(message)
+    def apply(self, action):
+        events = engine.apply(self, action)
+        if self.journal is not None:
+            self.journal.record('action', self.name, action)
+        return events
+
+    '''Applies action and sends the resulting events to the players'''
+    def play(self, action):
+        self.publish(self.apply(action))
+
+    def publish(self, events):
+        output = {}
+        for event in events:
+            if event[0] == 'voteOpened':
+                self.voteTimer = self.scheduler.schedule(event[3], self.post, self.voteExpired, event[1],
+                                                         self.players.getVote(event[1]))
+            elif event[0] == 'voteClosed' and self.voteTimer is not None:
+                self.voteTimer.cancel()
+                self.voteTimer = None
+
+            text = messages.render(self, event)
+            if messages.isPrivate(event):
+                player = self.players.getPlayerByName(event[1])
+                if player is None or player.conn is None:
+                    continue
+                if player.conn.structured:
+                    output.setdefault(player.conn, []).append(protocol.encodeEvent(self, event))
+                elif text is not None:
+                    output.setdefault(player.conn, []).append(text)
+            else:
+                self.queueBroadcast(output, text, event)
+        if self.tracker is not None:
+            self.pushState(output)
+        self.flush(output)
 
     '''
-    Parses the client's request and dispatches to the correct function
+    Sends everything queued for each connection in a single write, so a client sees the whole
+    result of an action at once and every recipient costs one syscall per action, not one per message
     '''
-    def parseRequest(self, player, message):
-        parts = message.split(' ',1)
-        command = parts[0]
-
-        if command == "/say":
-            self.chatMessage(player, parts)
-        elif command == "/exit":
-            self.kick(player, parts)
-        elif command == "/help":
-            self.help(player,parts)
-        elif command == "/hand":
-            self.showHand(player, parts)
-        elif command == "/coins":
-            self.showCoins(player, parts)
-        elif command == "/tax":
-            self.tax(player, parts)
-        elif command == "/income":
-            self.income(player, parts)
-        elif command == "/aid":
-            self.foreignAid(player, parts)
-        elif command == "/coup":
-            self.coup(player, parts)
-        elif command == "/assassinate":
-            self.assassinate(player, parts)
-        elif command == "/exchange":
-            self.exchange(player, parts)
-        elif command == "/remove":
-            self.remove(player, parts)
-        elif command == "/steal":
-            self.steal(player, parts)
-        elif command == "/register":
-            self.register(parts)
-        elif command == "/ready":
-            self.ready(player, parts)
-        elif command == "/endturn":
-            self.endturn(player, parts)
-        elif command == "/players":
-            self.listplayers(parts)
-        elif command == "/challenge":
-            currentVote = self.players.getVote("challenge")
-            currentVote.vote(player, True)
-                 
-        elif command == "/pass":
-            currentVote = self.players.getVote("challenge")
-            currentVote.vote(player, False)
-        elif command != "":
-            self.request.sendall("Unrecognized command.\n")
-
-class CoupGame(object):
-    def __init__(self):
-        self.deck = Deck()
-        self.destroyedCards = []
-        self.players = PlayerQueue()
-
-        #coins dispersed
-        self.treasury = 50 - 2 * self.players.numPlayers() #50 is starting amt
-
-        #deck shuffled
-        self.deck.shuffle()
+    def flush(self, output):
+        start = time.time()
+        for conn, chunks in output.iteritems():
+            data = "".join(chunks)
+            if conn.structured:
+                conn.sendLine(data)
+            else:
+                conn.sendall(data)
+        FANOUT_TIME.observe(time.time() - start)
+
+    '''Adds conn to the subscribers and returns the state, or the changes since version, for its reply'''
+    def subscribe(self, conn, player, epoch=None, version=None):
+        if self.tracker is None:
+            self.tracker = StateTracker(self)
+        tracker = self.tracker
+        tracker.subscribers.add(conn)
+        reply = {"epoch": tracker.epoch, "version": tracker.version}
+        changes = tracker.since(epoch, version) if version is not None else None
+        if changes is None:
+            reply["state"] = tracker.view
+        else:
+            reply["changes"] = changes
+        if player is not None:
+            reply["hand"] = tracker.hands.get(player.name)
+        return reply
+
+    def unsubscribe(self, conn):
+        if self.tracker is not None:
+            self.tracker.subscribers.discard(conn)
+
+    '''Queues what the last action changed for the subscribers. A player whose hand changed also gets their new hand'''
+    def pushState(self, output):
+        tracker = self.tracker
+        update = tracker.update()
+        if update is None:
+            return
+        changes, changedHands = update
+        message = {"event": "state", "epoch": tracker.epoch, "version": tracker.version, "changes": changes}
+        line = protocol.encode(message)
+        for conn in list(tracker.subscribers):
+            player = self.players.getPlayer(conn)
+            if player is not None and player.name in changedHands:
+                message["hand"] = tracker.hands[player.name]
+                output.setdefault(conn, []).append(protocol.encode(message))
+                del message["hand"]
+            else:
+                output.setdefault(conn, []).append(line)
+
+    '''
+    Queues message for all connected players.
+    Clients using the JSON protocol get event with its fields named instead, or the message as a "message" event.
+    '''
+    def queueBroadcast(self, output, message, event=None):
+        sent = 0
+        line = None
+        for player in self.players.listPlayers():
+            conn = player.conn
+            if conn is None:
+                continue
+            if conn.structured:
+                if line is None:
+                    line = protocol.encodeEvent(self, event) if event is not None else protocol.encodeText(message)
+                output.setdefault(conn, []).append(line)
+                sent += len(line)
+            elif message is not None:
+                output.setdefault(conn, []).append(message)
+                sent += len(message)
+        BROADCASTS.add()
+        BROADCAST_BYTES.add(sent)
+
+    '''Broadcasts message to all connected players'''
+    def broadcast(self, message, event=None):
+        output = {}
+        self.queueBroadcast(output, message, event)
+        self.flush(output)
+
+    '''Restarts the deadline of a vote restored from the journal, and the wait for restored players to return'''
+    def resume(self):
+        vote = self.players.getVote('challenge')
+        if vote is not None and self.voteTimer is None:
+            self.voteTimer = self.scheduler.schedule(vote.timeout, self.post, self.voteExpired, vote.name, vote)
+        if IDLE_TIMEOUT:
+            self.scheduler.schedule(IDLE_TIMEOUT, self.post, self.releaseSeats)
+
+    '''Gives up the seats of restored players whose clients never came back'''
+    def releaseSeats(self):
+        for player in self.players.listPlayers():
+            if player.conn is None:
+                self.play(('leave', player.name, None))
+
+    def voteExpired(self, name, vote):
+        if self.players.getVote(name) is not vote:
+            #The vote ended while its deadline was waiting in the mailbox
+            return
+        self.voteTimer = None
+        if self.profiler is not None:
+            return self.profiler.run(self.play, ('timeout', None, name))
+        self.play(('timeout', None, name))
 
 '''
 handler_factory() creates a function called create_handler.
@@ -485,25 +920,168 @@ def handler_factory(callback):
         return CoupRequestHandler(callback, *args, **keys)
     return createHandler
 
+'''
+connection_factory() is the CoupEventServer equivalent of handler_factory().
+'''
+def connection_factory(callback):
+    def createHandler(conn):
+        return CoupConnectionHandler(callback, conn)
+    return createHandler
+
+'''
+Builds a server in the requested mode.
+"threaded" spawns a thread per client, "event" serves every client from a single non-blocking thread.
+outboundLimit and overflowPolicy bound the output buffered for each client (see outbound.py).
+listener is an already listening socket to serve instead of binding address (event mode only).
+In threaded mode, the commands and timers of each room run on one of workers threads (see workers.py).
+'''
+def make_server(mode, address, rooms, outboundLimit=DEFAULT_LIMIT, overflowPolicy=DEFAULT_POLICY, listener=None,
+                workers=DEFAULT_WORKERS):
+    if mode == "event":
+        return CoupEventServer(address, connection_factory(rooms), outboundLimit=outboundLimit,
+                               overflowPolicy=overflowPolicy, scheduler=rooms.scheduler, listener=listener)
+    server = CoupServer(address, handler_factory(rooms), outboundLimit, overflowPolicy)
+    rooms.usePool(WorkerPool(workers))
+    rooms.scheduler.start()
+    return server
+
+'''
+Adds the gauges that are read from the rooms and the command registry when the metrics are collected
+'''
+def watchRooms(registry, rooms):
+    def roomList():
+        return list(rooms.rooms.values())
+    registry.gauge("coup_connected_clients", "Clients connected, registered or not",
+                   lambda: sum(room.numMembers() for room in roomList()))
+    registry.gauge("coup_registered_players", "Players registered in a game",
+                   lambda: sum(room.game.players.numPlayers() for room in roomList()))
+    registry.gauge("coup_rooms", "Rooms open", rooms.numRooms)
+    registry.gauge("coup_open_votes", "Votes waiting for their result",
+                   lambda: sum(len(room.game.players.ongoingVotes) for room in roomList()))
+
+    def sendQueues():
+        depths = []
+        for room in roomList():
+            for conn in list(room.members):
+                if conn.outbox:
+                    depths.append(len(conn.outbox))
+        return [("coup_send_queue_bytes", "gauge", "Output queued for slow clients", [("coup_send_queue_bytes", (), sum(depths))]),
+                ("coup_send_queue_max_bytes", "gauge", "Largest output queue of any client", [("coup_send_queue_max_bytes", (), max(depths or [0]))]),
+                ("coup_send_queue_clients", "gauge", "Clients with output queued", [("coup_send_queue_clients", (), len(depths))])]
+
+    def commands():
+        counts, errors, latency = [], [], []
+        for name in COMMANDS.names():
+            stats = COMMANDS.stats[name]
+            label = (("command", name),)
+            counts.append(("coup_commands_total", label, stats.count))
+            errors.append(("coup_command_errors_total", label, stats.errors))
+            latency.extend(stats.latency.samples("coup_command_seconds", label))
+        return [("coup_commands_total", "counter", "Commands dispatched", counts),
+                ("coup_command_errors_total", "counter", "Commands rejected with an error", errors),
+                ("coup_command_seconds", "histogram", "Time taken to run a command", latency)]
+
+    def shedding():
+        shed = [("coup_shed_total", (("scope", scope), ("budget", budget)), count)
+                for (scope, budget), count in sorted(SHED.items())]
+        return [("coup_shed_total", "counter", "Commands and error replies dropped by rate limits", shed)]
+
+    registry.addCollector(sendQueues)
+    registry.addCollector(commands)
+    registry.addCollector(shedding)
+
+'''
+Returns the address of the interface that outgoing traffic would leave from, without touching the network:
+connecting a UDP socket only picks a route, nothing is sent. Falls back to the loopback address.
+'''
+def networkAddress():
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        #TEST-NET-1, reserved for documentation, so it is never actually contacted
+        probe.connect(("192.0.2.1", 9))
+        return probe.getsockname()[0]
+    except socket.error:
+        return "127.0.0.1"
+    finally:
+        probe.close()
+
+'''
+Runs a single-threaded event loop server with its own rooms. Used for gateway workers.
+'''
+def serve_worker(address):
+    server = make_server("event", address, RoomManager(CoupGame, TimerScheduler()), OUTBOUND_LIMIT, OVERFLOW_POLICY)
+    raiseFileLimit()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
 if __name__ == "__main__":
     print "Welcome to COUP!\n"
     HOST, PORT = sys.argv[1], int(sys.argv[2])
+    MODE = sys.argv[3] if len(sys.argv) > 3 else "threaded"
+    JOURNAL = sys.argv[4] if len(sys.argv) > 4 and sys.argv[4] != "-" else None
+    METRICS_PORT = int(sys.argv[5]) if len(sys.argv) > 5 else None
+    if OVERFLOW_POLICY not in POLICIES:
+        print "COUP_OVERFLOW_POLICY must be one of:", ", ".join(POLICIES)
+        sys.exit(1)
 
     if sys.argv[1] == "external":
-        HOST = urllib.urlopen('http://canihazip.com/s').read()
-        print "Network-facing IP:", HOST
-
-    cg = CoupGame()
-
-    try:
-        server = CoupServer((HOST, PORT), handler_factory(cg) )
-    except Exception as e:
-	server = CoupServer(('localhost', PORT), handler_factory(cg) )
-        print "External binding FAILED. Running LOCALLY on port", PORT
+        #Listen on every interface; the address is only for telling players where to connect
+        HOST = "0.0.0.0"
+        print "Network-facing IP:", networkAddress()
+
+    #Set if this process was started by a hot restart of a previous one
+    HANDOFF = handoff.load()
+
+    journal = Journal(JOURNAL) if JOURNAL else None
+    rooms = RoomManager(CoupGame, TimerScheduler(), journal)
+    if journal is not None:
+        start = time.time()
+        replayed = journal.recover(rooms)
+        print "Restored {0} rooms from {1} ({2} actions replayed) in {3:.1f} ms".format(rooms.numRooms(), JOURNAL,
+                                                                                        replayed, (time.time() - start) * 1000)
+    elif HANDOFF is not None and HANDOFF["rooms"]:
+        rooms.restore(HANDOFF["rooms"])
+        for room in rooms.listRooms():
+            room.game.resume()
+
+    if HANDOFF is not None:
+        server = make_server(MODE, (HOST, PORT), rooms, OUTBOUND_LIMIT, OVERFLOW_POLICY, listener=handoff.listener(HANDOFF))
+        handoff.resume(server, HANDOFF)
+        print "Took over {0} clients and {1} rooms from the previous process".format(len(HANDOFF["clients"]), rooms.numRooms())
+    else:
+        try:
+            server = make_server(MODE, (HOST, PORT), rooms, OUTBOUND_LIMIT, OVERFLOW_POLICY)
+        except Exception as e:
+            server = make_server(MODE, ('localhost', PORT), rooms, OUTBOUND_LIMIT, OVERFLOW_POLICY)
+            print "External binding FAILED. Running LOCALLY on port", PORT
 
     ip, port = server.server_address
+    installSignal(signal.SIGUSR1)
+    if MODE == "event":
+        #"kill -HUP [pid]" restarts the server in place, e.g. to pick up a new build
+        restart = lambda: handoff.restart(server, rooms, journal)
+        signal.signal(signal.SIGHUP, lambda signum, frame: server.requestCall(restart))
 
-    server_thread = threading.Thread(target=server.serve_forever)
-    server_thread.daemon = True
-    server_thread.start()
-    server_thread.join()
+    if METRICS_PORT:
+        watchRooms(METRICS, rooms)
+        MetricsServer(('localhost', METRICS_PORT), METRICS).start()
+        print "Metrics on http://localhost:{}/metrics".format(METRICS_PORT)
+
+    try:
+        if MODE == "event":
+            print "Open file limit:", raiseFileLimit()
+            server.serve_forever()
+        else:
+            server_thread = threading.Thread(target=server.serve_forever)
+            server_thread.daemon = True
+            server_thread.start()
+            while server_thread.is_alive():
+                server_thread.join(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if journal is not None:
+            journal.close()
@@ -0,0 +1,98 @@
+#Versioned views of a game's state, so subscribed clients are sent what changed instead of polling
+import copy, random
+from collections import deque
+from deck import isAlive, roleName
+
+#Versions of changes kept for clients catching up after a reconnect
+HISTORY = 256
+
+def playerView(player):
+    return {"coins": player.coins, "cards": sum(1 for card in player.cards if isAlive(card)),
+            "dead": [roleName(card) for card in player.cards if not isAlive(card)], "ready": player.ready}
+
+'''Returns the public state of a game: what any player could see at the table'''
+def publicView(state):
+    current = state.players.getCurrentPlayer()
+    return {"treasury": state.treasury, "turn": current.name if current is not None else None, "winner": state.winner,
+            "players": dict((player.name, playerView(player)) for player in state.players.listPlayers())}
+
+'''Returns every player's living cards, which only they get to see'''
+def handViews(state):
+    return dict((player.name, [roleName(card) for card in player.cards if isAlive(card)])
+                for player in state.players.listPlayers())
+
+'''
+Returns the fields of new that differ from old. Nested dicts are compared field by field,
+and a field that has gone is given as None.
+'''
+def diff(old, new):
+    changes = {}
+    for key, value in new.iteritems():
+        previous = old.get(key)
+        if isinstance(value, dict) and isinstance(previous, dict):
+            nested = diff(previous, value)
+            if nested:
+                changes[key] = nested
+        elif value != previous or key not in old:
+            changes[key] = value
+    for key in old:
+        if key not in new:
+            changes[key] = None
+    return changes
+
+'''Applies the changes returned by diff() to view, in place'''
+def merge(view, changes):
+    for key, value in changes.iteritems():
+        if isinstance(value, dict) and isinstance(view.get(key), dict):
+            merge(view[key], value)
+        else:
+            view[key] = value
+    return view
+
+'''
+Tracks one game's state for its subscribers. Every action that changes the public view or
+a hand gets a new version, and the changes of the last HISTORY versions are kept so a client
+can ask for everything since the version it last saw. epoch changes whenever a tracker is
+created (a new game or a restarted server), so versions from an earlier one are never trusted.
+'''
+class StateTracker(object):
+    def __init__(self, state):
+        self.state = state
+        self.epoch = random.SystemRandom().getrandbits(32)
+        self.version = 0
+        self.view = publicView(state)
+        self.hands = handViews(state)
+        self.history = deque(maxlen=HISTORY)
+        #Connections of the clients being sent changes
+        self.subscribers = set()
+
+    '''
+    Brings the view up to date. Returns None if nothing changed, otherwise the public changes
+    and the names of the players whose hands changed.
+    '''
+    def update(self):
+        view = publicView(self.state)
+        hands = handViews(self.state)
+        changes = diff(self.view, view)
+        changedHands = [name for name, hand in hands.iteritems() if self.hands.get(name) != hand]
+        if not changes and not changedHands:
+            return None
+        self.version += 1
+        self.view, self.hands = view, hands
+        self.history.append((self.version, changes))
+        return changes, changedHands
+
+    '''Returns the public changes since version, or None if they are no longer known'''
+    def since(self, epoch, version):
+        if epoch != self.epoch or version > self.version:
+            return None
+        if version == self.version:
+            return {}
+        if not self.history or self.history[0][0] > version + 1:
+            return None
+        changes = {}
+        for number, step in self.history:
+            if number > version:
+                #Copied so that merging never alters the history
+                merge(changes, copy.deepcopy(step))
+        return changes
@@ -0,0 +1,115 @@
+#One shared timer facility for vote deadlines and other delayed actions
+import fcntl, heapq, itertools, os, threading, time, traceback
+from poller import Poller, WOULD_BLOCK
+
+'''
+A pending call made by a TimerScheduler. cancel() stops it from running.
+'''
+class Timer(object):
+    __slots__ = ('scheduler', 'deadline', 'func', 'args', 'cancelled')
+
+    def __init__(self, scheduler, deadline, func, args):
+        self.scheduler = scheduler
+        self.deadline = deadline
+        self.func = func
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        #Under the scheduler's lock, so the count can't drift from the heap while runDue() or compaction reads it
+        with self.scheduler.lock:
+            if not self.cancelled:
+                self.cancelled = True
+                self.scheduler.cancelledCount += 1
+
+'''
+Runs delayed calls for every room from a heap of deadlines, so pending timers cost no threads.
+An event loop drives it with nextTimeout() and runDue(); otherwise start() runs it on one background thread.
+Cancelled timers are skipped when they reach the top of the heap, and the heap is compacted if they pile up.
+'''
+class TimerScheduler(object):
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.heap = []
+        self.counter = itertools.count()
+        self.cancelledCount = 0
+        self.lock = threading.Lock()
+        self.thread = None
+        self.wakeRead = self.wakeWrite = None
+
+    '''Calls func(*args) after delay seconds. Returns the Timer'''
+    def schedule(self, delay, func, *args):
+        timer = Timer(self, self.clock() + delay, func, args)
+        with self.lock:
+            heapq.heappush(self.heap, (timer.deadline, next(self.counter), timer))
+            earliest = self.heap[0][2] is timer
+        if earliest:
+            self.wake()
+        return timer
+
+    '''Returns the number of seconds until the next timer is due, or None if there are none'''
+    def nextTimeout(self):
+        with self.lock:
+            self.discardCancelled()
+            if not self.heap:
+                return None
+            return max(0.0, self.heap[0][0] - self.clock())
+
+    '''Runs every timer whose deadline has passed. A timer that raises is logged, and the others still run'''
+    def runDue(self):
+        now = self.clock()
+        while True:
+            with self.lock:
+                if not self.heap or self.heap[0][0] > now:
+                    return
+                timer = heapq.heappop(self.heap)[2]
+                if timer.cancelled:
+                    self.cancelledCount -= 1
+                    continue
+                #A timer that has fired can no longer be cancelled
+                timer.cancelled = True
+            try:
+                timer.func(*timer.args)
+            except Exception:
+                traceback.print_exc()
+
+    '''Returns the number of timers still waiting to run'''
+    def pending(self):
+        return len(self.heap) - self.cancelledCount
+
+    def discardCancelled(self):
+        while self.heap and self.heap[0][2].cancelled:
+            heapq.heappop(self.heap)
+            self.cancelledCount -= 1
+        if self.cancelledCount > 64 and self.cancelledCount * 2 > len(self.heap):
+            self.heap = [entry for entry in self.heap if not entry[2].cancelled]
+            heapq.heapify(self.heap)
+            self.cancelledCount = 0
+
+    '''Runs the scheduler on its own background thread'''
+    def start(self):
+        if self.thread is not None:
+            return
+        self.wakeRead, self.wakeWrite = os.pipe()
+        fcntl.fcntl(self.wakeWrite, fcntl.F_SETFL, fcntl.fcntl(self.wakeWrite, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        poller = Poller()
+        poller.register(self.wakeRead, poller.READ)
+        while True:
+            if poller.poll(self.nextTimeout()):
+                os.read(self.wakeRead, 4096)
+            self.runDue()
+
+    '''Interrupts the background thread's wait so it picks up an earlier deadline'''
+    def wake(self):
+        if self.wakeWrite is None or threading.current_thread() is self.thread:
+            return
+        try:
+            os.write(self.wakeWrite, "x")
+        except OSError as e:
+            if e.errno not in WOULD_BLOCK:
+                raise
@@ -1,101 +1,64 @@
 from error import *
-import threading, urllib, time
-from deck import Deck
-from player import Player, PlayerQueue
+
+#Outcomes returned by Vote.checkResults
+PASSED = "passed"
+FAILED = "failed"
 
 '''
-timeout - number of seconds the vote lasts for
-options - a list of voteOptions that players can vote for
-successFunction - the function that runs if the vote passes
-failFunction - the function that runs if the vote fails
-eligiblePlayers - the players that are able to vote in this vote
+name - the name the vote is filed under in the PlayerQueue's ongoingVotes
+voters - the players that are able to vote in this vote
+passThreshold - percentage of YES votes needed for the vote to pass
+timeout - number of seconds the vote lasts for; the caller fails it when they run out
+claim - whatever the vote is about, for the code that acts on the outcome
 '''
 class Vote(object):
-    def __init__(self, handler, playerQueue, name, timeout, passThreshold, successFunc, successArgs, failFunc, failArgs):
-        #Votes is a list of players that have voted in favor
-        self.handler = handler
-        self.timeout = timeout
+    def __init__(self, name, voters, passThreshold, timeout, claim=None):
         self.name = name
-        self.playerQueue = playerQueue
-        self.playerList = self.playerQueue.listPlayers()
+        self.timeout = timeout
+        self.playerList = list(voters)
 
+        #Players that have voted YES and NO
         self.yesList = []
         self.noList = []
         self.passThreshold = passThreshold
 
-        self.successFunc = successFunc
-        self.successArgs = successArgs
-        self.failFunc = failFunc
-        self.failArgs = failArgs
-
-        self.voteThread = threading.Thread( target = self.startVote )
-        self.voteThread.start()
+        self.claim = claim
         self.concluded = False
 
     '''
-    Initiates a vote that lasts for timeout seconds
-    '''
-    def startVote(self):
-        self.playerQueue.ongoingVotes[self.name] = self
-        timer = 0
-        while timer <= self.timeout:
-            time.sleep(1)
-            timer += 1
-            if timer % 10 == 0:
-                 print "{} seconds left...\n".format(self.timeout - timer)
-            if self.concluded:
-		self.votePass()
-                return
-        if not self.concluded:
-            self.voteFail()
-            return
-
-    '''
-    Checks to see if the vote has reached a conclusion
+    Checks to see if the vote has reached a conclusion.
+    Returns PASSED or FAILED once it has, None while it is still open.
     '''
     def checkResults(self):
         #Number of people eligible to vote
         eligibleVotes = float(len(self.playerList))
-        #Number of people voting YES
-        yesVotes = float(len(self.yesList))
+        if eligibleVotes == 0:
+            return None
         #Percentage of eligible voters voting YES
-        yesPercent = (yesVotes/eligibleVotes)*100
+        yesPercent = (len(self.yesList)/eligibleVotes)*100
         #Percentage of eligible voters voting NO
-        noPercent = 100 - yesPercent
-        print "yes percent is {0}, eligible votes is {1}".format(yesPercent, eligibleVotes)
+        noPercent = (len(self.noList)/eligibleVotes)*100
 
         if yesPercent >= self.passThreshold:
-            self.votePass()
-        elif noPercent >= (100 - self.passThreshold):
-            self.voteFail()
+            self.concluded = True
+            return PASSED
+        elif noPercent > (100 - self.passThreshold):
+            self.concluded = True
+            return FAILED
+        return None
 
     '''
-    Allows a player to vote for a particular option
+    Allows a player to vote for a particular option. Returns the result of checkResults.
     '''
     def vote(self, player, vote):
-        try:
-            if player in self.playerList:
-                if player not in self.yesList or player not in self.noList:
-                    if vote:
-                        self.yesList.append(player)
-                    else:
-                        self.noList.append(player)
-                    self.checkResults()
-                else:
-                    raise InvalidCommandError(player.conn, "You already voted in this poll")
-            else:
-                raise InvalidCommandError(player.conn, "You are not eligible to vote in this poll")
-        except InvalidCommandError:
-            pass
-
-    def votePass(self):
-        del self.playerQueue.ongoingVotes[self.name]
-        self.concluded = True
-        self.successFunc(self.handler, self.noList, *self.successArgs)
-        print "PASSED"
-
-    def voteFail(self):
-        del self.playerQueue.ongoingVotes[self.name]
-        self.concluded = True
-        self.failFunc(self.handler, self.noList, *self.failArgs)
-        print "FAILED"
+        if self.concluded:
+            raise InvalidCommandError("This vote has already ended.\n")
+        if player not in self.playerList:
+            raise InvalidCommandError("You are not eligible to vote in this poll.\n")
+        if player in self.yesList or player in self.noList:
+            raise InvalidCommandError("You already voted in this poll.\n")
+        if vote:
+            self.yesList.append(player)
+        else:
+            self.noList.append(player)
+        return self.checkResults()
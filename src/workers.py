@@ -0,0 +1,71 @@
+#Per-room command mailboxes, run by a bounded pool of worker threads
+import Queue, threading, traceback
+from collections import deque
+
+DEFAULT_WORKERS = 4
+#Tasks a worker runs from one mailbox before letting other rooms have a turn
+BATCH = 32
+
+'''
+The queue of work for one room. Whoever posts a task never runs it: the mailbox is handed
+to the pool when it gets work, and only one worker drains it at a time, so everything that
+touches the room's game runs one task after another without any lock on the game itself.
+'''
+class Mailbox(object):
+    __slots__ = ('pool', 'tasks', 'lock', 'scheduled')
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.tasks = deque()
+        self.lock = threading.Lock()
+        #True while the mailbox is waiting for, or held by, a worker
+        self.scheduled = False
+
+    '''Queues func(*args) to run on the room's worker'''
+    def post(self, func, *args):
+        with self.lock:
+            self.tasks.append((func, args))
+            if self.scheduled:
+                return
+            self.scheduled = True
+        self.pool.ready.put(self)
+
+    '''Runs up to BATCH tasks. Called by a worker'''
+    def run(self):
+        for i in range(BATCH):
+            with self.lock:
+                if not self.tasks:
+                    self.scheduled = False
+                    return
+                func, args = self.tasks.popleft()
+            try:
+                func(*args)
+            except Exception:
+                traceback.print_exc()
+        with self.lock:
+            if not self.tasks:
+                self.scheduled = False
+                return
+        #Still busy: go to the back of the line
+        self.pool.ready.put(self)
+
+'''
+A fixed number of worker threads shared by every room. Rooms run in parallel with each other,
+but no room ever runs on two workers at once.
+'''
+class WorkerPool(object):
+    def __init__(self, size=DEFAULT_WORKERS):
+        self.ready = Queue.Queue()
+        self.threads = []
+        for i in range(size):
+            thread = threading.Thread(target=self.work, name="room-worker-{}".format(i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def mailbox(self):
+        return Mailbox(self)
+
+    def work(self):
+        while True:
+            self.ready.get().run()